@@ -0,0 +1,35 @@
+import argparse
+import os
+import tempfile
+import time
+
+from benchmarks.synthetic_dump import write_synthetic_dump
+from src.data_processing import ol_read_manipulate_files
+
+"""
+    Parse benchmark
+
+    Generates a synthetic editions dump and reports the throughput of
+    'ol_read_manipulate_files' in rows per second.
+
+    Usage:
+    python -m benchmarks.bench_parse [--rows N] [--workers N]
+"""
+
+parser = argparse.ArgumentParser(description='Benchmark the editions dump parser')
+parser.add_argument('--rows', type=int, default=200000, help='Number of synthetic rows.')
+parser.add_argument('--workers', type=int, default=1, help='Number of parser processes.')
+args = parser.parse_args()
+
+with tempfile.TemporaryDirectory() as tmp:
+    dump_path = os.path.join(tmp, 'ol_dump_editions.txt')
+    output_folder = os.path.join(tmp, 'processed')
+    os.mkdir(output_folder)
+    size = write_synthetic_dump(dump_path, args.rows)
+
+    start = time.perf_counter()
+    books = ol_read_manipulate_files(dump_path, output_folder, workers=args.workers)
+    elapsed = time.perf_counter() - start
+
+print(f"Parsed {args.rows} rows with {args.workers} worker(s) ({size / 2 ** 20:.1f} MiB) into {books} books in {elapsed:.2f}s")
+print(f"{args.rows / elapsed:,.0f} rows/sec, {size / 2 ** 20 / elapsed:.1f} MiB/sec")
@@ -0,0 +1,96 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.synthetic_dump import write_synthetic_dump
+from src.data_processing import ol_read_manipulate_files
+from src.inverted_index import build_inverted_index
+
+"""
+    Startup benchmark
+
+    Reports how long 'search_books.py' takes to start and answer small requests that do
+    almost no work, so the time is dominated by the interpreter startup and the imports:
+    - help: 'search_books.py --help'.
+    - client: a search sent to a local query service with '--server', which answers with
+      no books.
+    - local_search: a search of the local index of a small synthetic dump with '--limit 0',
+      which fetches no book.
+    - all_imports: importing every module of 'src', as the script did before the commands
+      imported their modules lazily.
+
+    Every command runs in a new interpreter '--repeat' times. The heavy dependencies
+    (pyarrow, pymongo, requests) each command imports are listed from 'python -X importtime'.
+
+    Usage:
+    python -m benchmarks.bench_startup [--repeat N] [--rows N]
+"""
+
+HEAVY_MODULES = ('pyarrow', 'pymongo', 'requests')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'search_books.py')
+
+
+class EmptyServiceHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def heavy_imports(command: list, cwd: str) -> list:
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + command, cwd=cwd,
+                            capture_output=True, text=True)
+    imported = {line.rsplit('|', 1)[-1].strip() for line in result.stderr.splitlines()}
+    return [name for name in HEAVY_MODULES if name in imported]
+
+
+parser = argparse.ArgumentParser(description='Benchmark the startup time of search_books.py')
+parser.add_argument('--repeat', type=int, default=10, help='Number of runs of each command.')
+parser.add_argument('--rows', type=int, default=1000, help='Number of synthetic rows of the local index.')
+args = parser.parse_args()
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), EmptyServiceHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+
+with tempfile.TemporaryDirectory() as tmp:
+    # The script reads its data from '../data', relative to its working directory
+    data = os.path.join(tmp, 'data')
+    cwd = os.path.join(tmp, 'run')
+    os.makedirs(os.path.join(data, 'processed'))
+    os.mkdir(cwd)
+    dump_path = os.path.join(data, 'ol_dump_editions.txt')
+    write_synthetic_dump(dump_path, args.rows)
+    ol_read_manipulate_files(dump_path, os.path.join(data, 'processed'))
+    build_inverted_index(os.path.join(data, 'processed'), os.path.join(data, 'index'))
+
+    common = ['--consoleoutput', '--no-cache']
+    commands = {
+        'help': [SCRIPT, '--help'],
+        'client': [SCRIPT, 'search', '--server', f'http://127.0.0.1:{server.server_port}'] + common + ['science'],
+        'local_search': [SCRIPT, 'search', '--backend', 'local', '--limit', '0'] + common + ['science'],
+        'all_imports': ['-c', 'import sys; sys.path.insert(0, sys.argv[1]); '
+                              'import src.pipeline, src.query_service, src.download_data', ROOT],
+    }
+
+    print(f"{'command':<14}{'min ms':>9}{'median ms':>11}  heavy imports")
+    for name, command in commands.items():
+        samples = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable] + command, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+            samples.append((time.perf_counter() - start) * 1000)
+        heavy = ', '.join(heavy_imports(command, cwd)) or '-'
+        print(f"{name:<14}{min(samples):>9.0f}{statistics.median(samples):>11.0f}  {heavy}")
+
+server.shutdown()
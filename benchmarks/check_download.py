@@ -0,0 +1,225 @@
+import argparse
+import hashlib
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.download_data import ol_download_dumb_files
+
+"""
+    Download check
+
+    Runs 'ol_download_dumb_files' against a local HTTP server that serves a random file,
+    answers Range requests and drops the connection partway through the body of the first
+    responses, and checks the downloaded file in each scenario:
+    - resume: a single stream whose connection drops several times, resumed with Range
+      requests from the bytes already on disk.
+    - partial: a '.part' file left by a run interrupted without retries, of which only the
+      missing bytes are requested.
+    - segmented: '--segments' byte ranges fetched in parallel, each dropped once.
+    - no_ranges: a server without range support, so the file is fetched again from the
+      start after a drop.
+    - size_mismatch: an expected size larger, then smaller, than the file. The download
+      fails, the short '.part' is kept for a later resume and the oversized one is removed.
+    - md5_mismatch: a wrong then a right expected checksum. The download fails and the
+      '.part' is removed, then succeeds.
+    - changed_file: a run interrupted on one file, then run again once the server serves
+      another one (new ETag). The old '.part' is discarded instead of being completed.
+    - segment_layout: a run interrupted with '--segments' segments, then run again with
+      half as many. The old '.partN' files are discarded instead of being resumed.
+    - if_range: a run interrupted on one file, then run again while the HEAD request still
+      reports it but the file changed. The server answers the If-Range request with the
+      whole new file.
+
+    Every scenario prints whether it passed, the number of requests and the bytes served.
+    The command exits with status 1 when a scenario fails.
+
+    Usage:
+    python -m benchmarks.check_download [--size MB] [--segments N] [--drops N]
+"""
+
+
+class DroppingFileHandler(BaseHTTPRequestHandler):
+    # Shared by all the requests of a scenario, see 'reset'
+    payload = b''
+    etag = '"0"'
+    # The ETag reported by HEAD, when it is not the one of the payload
+    head_etag = None
+    accept_ranges = True
+    drops = 0
+    requests = []
+    served = 0
+    lock = threading.Lock()
+
+    @classmethod
+    def reset(cls, drops: int = 0, accept_ranges: bool = True):
+        cls.head_etag = None
+        cls.drops = drops
+        cls.accept_ranges = accept_ranges
+        cls.requests = []
+        cls.served = 0
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.payload)))
+        self.send_header('ETag', self.head_etag or self.etag)
+        if self.accept_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        size = len(self.payload)
+        start, end = 0, size - 1
+        header = self.headers.get('Range')
+        with self.lock:
+            self.requests.append(header)
+            drop = DroppingFileHandler.drops > 0
+            DroppingFileHandler.drops -= drop
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', header or '')
+        # A Range request whose If-Range does not match the current file gets all of it
+        if_range = self.headers.get('If-Range')
+        if match and self.accept_ranges and (if_range is None or if_range == self.etag):
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        # A dropped response sends a third of its body, then closes the connection
+        body = self.payload[start:end + 1]
+        if drop:
+            body = body[:len(body) // 3]
+            self.close_connection = True
+        self.wfile.write(body)
+        with self.lock:
+            DroppingFileHandler.served += len(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run(name: str, url: str, path: str, expected, **options) -> bool:
+    start = time.perf_counter()
+    result = ol_download_dumb_files(url, path, **options)
+    elapsed = time.perf_counter() - start
+    passed = expected(result)
+    print(f"{name:<16}{'ok' if passed else 'FAILED':<8}{len(DroppingFileHandler.requests):>9}"
+          f"{DroppingFileHandler.served / 2 ** 20:>12.2f}{elapsed:>9.1f}")
+    return passed
+
+
+def serve_payload(data: bytes, etag: str):
+    DroppingFileHandler.payload = data
+    DroppingFileHandler.etag = etag
+
+
+def clean(path: str):
+    for leftover in (path, path + '.part', path + '.part.json'):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+
+def same_file(path: str, payload: bytes) -> bool:
+    with open(path, 'rb') as f:
+        return f.read() == payload
+
+
+parser = argparse.ArgumentParser(description='Check the resumable downloads against a local server')
+parser.add_argument('--size', type=float, default=4, help='Size of the served file in MiB.')
+parser.add_argument('--segments', type=int, default=4, help='Number of segments of the segmented download.')
+parser.add_argument('--drops', type=int, default=3, help='Number of dropped connections of the resumed download.')
+args = parser.parse_args()
+
+payload = random.Random(0).randbytes(int(args.size * 2 ** 20))
+md5 = hashlib.md5(payload).hexdigest()
+serve_payload(payload, '"0"')
+server = ThreadingHTTPServer(('127.0.0.1', 0), DroppingFileHandler)
+server.daemon_threads = True
+threading.Thread(target=server.serve_forever, daemon=True).start()
+url = f'http://127.0.0.1:{server.server_port}/ol_dump_editions_latest.txt.gz'
+
+results = []
+with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, 'ol_dump_editions.txt.gz')
+    print(f"{'scenario':<16}{'result':<8}{'requests':>9}{'MiB served':>12}{'seconds':>9}")
+
+    DroppingFileHandler.reset(drops=args.drops)
+    results.append(run('resume', url, path, lambda ok: ok and same_file(path, payload), expected_md5=md5)
+                   and all(DroppingFileHandler.requests[1:]))
+    clean(path)
+
+    DroppingFileHandler.reset(drops=1)
+    run('interrupted', url, path, lambda ok: not ok, retries=0, chunk_size=2 ** 16)
+    done = os.path.getsize(path + '.part')
+    DroppingFileHandler.reset()
+    results.append(run('partial', url, path, lambda ok: ok and same_file(path, payload))
+                   and DroppingFileHandler.served == len(payload) - done)
+    clean(path)
+
+    DroppingFileHandler.reset(drops=args.segments)
+    results.append(run('segmented', url, path, lambda ok: ok and same_file(path, payload),
+                       segments=args.segments, expected_md5=md5)
+                   and not any(os.path.exists(f'{path}.part{i}') for i in range(args.segments)))
+    clean(path)
+
+    DroppingFileHandler.reset(drops=1, accept_ranges=False)
+    results.append(run('no_ranges', url, path, lambda ok: ok and same_file(path, payload)))
+    clean(path)
+
+    DroppingFileHandler.reset()
+    results.append(run('size_mismatch', url, path, lambda ok: not ok, expected_size=len(payload) + 1)
+                   and os.path.getsize(path + '.part') == len(payload) and not os.path.exists(path))
+    clean(path)
+    DroppingFileHandler.reset()
+    results.append(run('size_mismatch', url, path, lambda ok: not ok, expected_size=len(payload) - 1)
+                   and not os.path.exists(path + '.part') and not os.path.exists(path))
+
+    DroppingFileHandler.reset()
+    results.append(run('md5_mismatch', url, path, lambda ok: not ok, expected_md5='0' * 32)
+                   and not os.path.exists(path + '.part') and not os.path.exists(path))
+    DroppingFileHandler.reset()
+    results.append(run('md5_match', url, path, lambda ok: ok and same_file(path, payload), expected_md5=md5))
+    clean(path)
+
+    newer = random.Random(1).randbytes(len(payload))
+    DroppingFileHandler.reset(drops=1)
+    run('interrupted', url, path, lambda ok: not ok, retries=0, chunk_size=2 ** 16)
+    serve_payload(newer, '"1"')
+    DroppingFileHandler.reset()
+    results.append(run('changed_file', url, path, lambda ok: ok and same_file(path, newer)))
+    clean(path)
+
+    serve_payload(payload, '"0"')
+    DroppingFileHandler.reset(drops=args.segments)
+    run('interrupted', url, path, lambda ok: not ok, segments=args.segments, retries=0,
+        chunk_size=2 ** 16)
+    DroppingFileHandler.reset()
+    results.append(run('segment_layout', url, path, lambda ok: ok and same_file(path, payload),
+                       segments=max(1, args.segments // 2))
+                   and not any(os.path.exists(f'{path}.part{i}') for i in range(args.segments)))
+    clean(path)
+
+    DroppingFileHandler.reset(drops=1)
+    run('interrupted', url, path, lambda ok: not ok, retries=0, chunk_size=2 ** 16)
+    serve_payload(newer, '"1"')
+    DroppingFileHandler.reset()
+    DroppingFileHandler.head_etag = '"0"'
+    results.append(run('if_range', url, path, lambda ok: ok and same_file(path, newer)))
+
+server.shutdown()
+print(f"{sum(results)}/{len(results)} scenarios passed")
+sys.exit(0 if all(results) else 1)
@@ -0,0 +1,340 @@
+import argparse
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import get_context
+
+from benchmarks.synthetic_dump import write_synthetic_dump
+
+"""
+    Benchmark suite
+
+    Generates a synthetic editions dump and measures every stage of the pipeline against
+    local stand-ins, then compares the results with a stored baseline:
+    - parse: 'ol_read_manipulate_files' throughput.
+    - load: 'write_to_mongodb' throughput, against a local mongod ('--mongo-uri') or the
+      in-process 'mongomock' client.
+    - index: 'build_inverted_index' throughput and local topic search latency.
+    - mongo_search: 'read_from_mongodb' topic search latency on the loaded collection.
+    - retrieval: 'iter_books_by_key' throughput against a local HTTP server answering like
+      the Open Library API, with an artificial latency.
+
+    Each suite runs in its own process, so its peak resident memory ('max_rss_mib') is not
+    mixed with the other suites. Latencies are reported as percentiles in milliseconds.
+    Every suite runs '--repeat' times, and the median of each metric is reported and
+    compared, so a single noisy run does not fail the comparison.
+
+    The searched topics are whole words or whole subjects of the vocabulary, each matching
+    at most a '--selectivity' fraction of the subjects, as a user searching for a subject
+    does. Prefixes like 'subj' would match every synthetic subject and measure scans of the
+    whole collection instead.
+
+    Usage:
+    python -m benchmarks.run_benchmarks [--rows N] [--vocabulary N] [--max-subjects N] [--zipf S]
+        [--seed N] [--workers N] [--writers N] [--batch-size N] [--mongo-uri URI] [--queries N]
+        [--mongo-queries N] [--selectivity F] [--books N] [--concurrency N] [--http-latency MS]
+        [--suites NAME [NAME ...]] [--repeat N]
+        [--baseline PATH] [--save-baseline] [--tolerance F] [--output PATH]
+
+    The exit status is 1 when a metric is worse than the baseline by more than the tolerance.
+"""
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+SUITES = ['parse', 'load', 'index', 'mongo_search', 'retrieval']
+
+
+def percentiles(samples: list) -> dict:
+    """
+        Returns the p50, p95 and p99 of latency samples in seconds, in milliseconds.
+    """
+    cuts = statistics.quantiles(samples, n=100, method='inclusive')
+    return {'p50_ms': cuts[49] * 1000, 'p95_ms': cuts[94] * 1000, 'p99_ms': cuts[98] * 1000}
+
+
+def max_rss_mib() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak * unit / 2 ** 20
+
+
+def sample_topics(vocabulary: list, queries: int, seed: int, selectivity: float = 0.01) -> list:
+    """
+        Draws 'queries' topic lists of one to three topics, the popular subjects being drawn
+        more often, as users do.
+
+        A topic is either a whole drawn subject or one of its words matching (as a substring,
+        like the searches) at most a 'selectivity' fraction of the vocabulary, and at least
+        one subject. Words shared by many subjects, like 'subject' or 'fiction' in the
+        synthetic dump, are never drawn.
+    """
+    rng = random.Random(seed)
+    weights = [1.0 / (rank + 1) for rank in range(len(vocabulary))]
+    lowered = [subject.lower() for subject in vocabulary]
+    limit = max(1, int(selectivity * len(vocabulary)))
+    matches = {}
+
+    def selective(word: str) -> bool:
+        if word not in matches:
+            matches[word] = sum(word in subject for subject in lowered)
+        return matches[word] <= limit
+
+    topics = []
+    for _ in range(queries):
+        subjects = rng.choices(vocabulary, weights, k=rng.randint(1, 3))
+        query = []
+        for subject in subjects:
+            words = [word for word in dict.fromkeys(subject.lower().split()) if selective(word)]
+            query.append(rng.choice(words + [subject]))
+        topics.append(query)
+    return topics
+
+
+def mongo_client(uri: str):
+    if uri:
+        from pymongo import MongoClient
+        return MongoClient(uri)
+    import mongomock
+    return mongomock.MongoClient()
+
+
+def bench_parse(options, dump_path: str, processed: str) -> dict:
+    from src.data_processing import ol_read_manipulate_files
+
+    size = os.path.getsize(dump_path)
+    start = time.perf_counter()
+    books = ol_read_manipulate_files(dump_path, processed, workers=options.workers)
+    elapsed = time.perf_counter() - start
+    return {'books': books, 'seconds': elapsed, 'rows_per_sec': options.rows / elapsed,
+            'mib_per_sec': size / 2 ** 20 / elapsed}
+
+
+def bench_load(options, dump_path: str, processed: str) -> dict:
+    from src.database_manipulation import write_to_mongodb
+
+    client = mongo_client(options.mongo_uri)
+    try:
+        stats = write_to_mongodb(processed, options.writers, options.batch_size, client=client)
+    finally:
+        client.close()
+    return {'books': stats['inserted'], 'failed': stats['failed'], 'seconds': stats['seconds'],
+            'docs_per_sec': stats['docs_per_sec']}
+
+
+def bench_index(options, dump_path: str, processed: str) -> dict:
+    from src.inverted_index import InvertedIndex, build_inverted_index
+
+    index_path = os.path.join(os.path.dirname(processed), 'index')
+    start = time.perf_counter()
+    books = build_inverted_index(processed, index_path)
+    elapsed = time.perf_counter() - start
+    latencies = []
+    matches = 0
+    with InvertedIndex(index_path) as index:
+        for topics in sample_topics(index.subjects, options.queries, options.seed, options.selectivity):
+            start = time.perf_counter()
+            matches += len(index.search(topics))
+            latencies.append(time.perf_counter() - start)
+    result = {'books': books, 'build_seconds': elapsed, 'build_rows_per_sec': books / elapsed,
+              'queries_per_sec': len(latencies) / sum(latencies), 'matches': matches}
+    result.update(percentiles(latencies))
+    return result
+
+
+def bench_mongo_search(options, dump_path: str, processed: str) -> dict:
+    from src.data_processing import read_subject_dictionary
+    from src.database_manipulation import read_from_mongodb, write_to_mongodb
+
+    client = mongo_client(options.mongo_uri)
+    try:
+        # The collection of the load suite only lives in its process with mongomock
+        if not options.mongo_uri:
+            write_to_mongodb(processed, options.writers, options.batch_size, client=client)
+        latencies = []
+        matches = 0
+        vocabulary = read_subject_dictionary(processed)
+        for topics in sample_topics(vocabulary, options.mongo_queries, options.seed, options.selectivity):
+            start = time.perf_counter()
+            matches += len(read_from_mongodb(topics, client))
+            latencies.append(time.perf_counter() - start)
+    finally:
+        client.close()
+    result = {'queries_per_sec': len(latencies) / sum(latencies), 'matches': matches}
+    result.update(percentiles(latencies))
+    return result
+
+
+class WorksHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        book_key = self.path.rsplit('/', 1)[-1].replace('.json', '')
+        body = json.dumps({'key': '/works/' + book_key, 'title': 'Synthetic work ' + book_key,
+                           'subjects': ['Synthetic']}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def bench_retrieval(options, dump_path: str, processed: str) -> dict:
+    from src.books_retieve import iter_books_by_key
+
+    handler = type('LatencyWorksHandler', (WorksHandler,), {'latency': options.http_latency / 1000})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    keys = ['https://openlibrary.org/works/OL%dW' % (i + 1) for i in range(options.books)]
+    try:
+        start = time.perf_counter()
+        arrivals = []
+        for _ in iter_books_by_key(keys, options.concurrency, rate=0,
+                                   base_url=f'http://127.0.0.1:{server.server_port}'):
+            arrivals.append(time.perf_counter() - start)
+    finally:
+        server.shutdown()
+        server.server_close()
+    elapsed = arrivals[-1] if arrivals else time.perf_counter() - start
+    return {'books': len(arrivals), 'seconds': elapsed, 'books_per_sec': len(arrivals) / elapsed,
+            'first_book_ms': arrivals[0] * 1000 if arrivals else 0.0}
+
+
+def run_suite(name: str, options, work_dir: str) -> dict:
+    """
+        Runs one suite in the current (fresh) process and adds its peak memory.
+    """
+    # The modules write '../data/...' paths relative to the working directory
+    os.chdir(work_dir)
+    dump_path = os.path.join(os.path.dirname(work_dir), 'ol_dump_editions.txt')
+    processed = os.path.join(os.path.dirname(work_dir), 'processed')
+    result = globals()['bench_' + name](options, dump_path, processed)
+    result['max_rss_mib'] = max_rss_mib()
+    return result
+
+
+def median_results(runs: list) -> dict:
+    """
+        Returns the median of every metric over the results of repeated runs of a suite.
+    """
+    return {metric: statistics.median(run[metric] for run in runs) for metric in runs[0]}
+
+
+def higher_is_better(metric: str) -> bool:
+    return metric.endswith('_per_sec')
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+        Compares the throughput, latency and memory metrics with the baseline.
+
+        Returns:
+        list: (suite, metric, baseline value, value, change ratio, regressed) for every metric
+        present in both, where 'regressed' tells whether the metric is worse than the baseline
+        by more than 'tolerance' (0.2 for 20%).
+    """
+    rows = []
+    for suite, metrics in results.items():
+        for metric, value in metrics.items():
+            reference = baseline.get(suite, {}).get(metric)
+            if not reference or not (higher_is_better(metric) or metric.endswith(('_ms', '_mib'))):
+                continue
+            change = value / reference - 1
+            worse = -change if higher_is_better(metric) else change
+            rows.append((suite, metric, reference, value, change, worse > tolerance))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline on a synthetic dump')
+    parser.add_argument('--rows', type=int, default=50000, help='Number of synthetic editions.')
+    parser.add_argument('--vocabulary', type=int, default=1000, help='Number of distinct subjects.')
+    parser.add_argument('--max-subjects', type=int, default=5, help='Maximum subjects per edition.')
+    parser.add_argument('--zipf', type=float, default=1.0, help='Exponent of the subject distribution, 0 for uniform.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data and queries.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of parser processes.')
+    parser.add_argument('--writers', type=int, default=4, help='Number of MongoDB writer threads.')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Number of books per bulk insert.')
+    parser.add_argument('--mongo-uri', help='URI of a local mongod, mongomock is used otherwise.')
+    parser.add_argument('--queries', type=int, default=200, help='Number of local index searches.')
+    parser.add_argument('--mongo-queries', type=int, default=20, help='Number of MongoDB searches.')
+    parser.add_argument('--selectivity', type=float, default=0.01,
+                        help='Largest fraction of the subjects a searched topic may match.')
+    parser.add_argument('--books', type=int, default=500, help='Number of books retrieved over HTTP.')
+    parser.add_argument('--concurrency', type=int, default=8, help='Number of concurrent HTTP requests.')
+    parser.add_argument('--http-latency', type=float, default=20, help='Latency of the local HTTP server, in ms.')
+    parser.add_argument('--suites', nargs='+', choices=SUITES, default=SUITES, help='Suites to run.')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs of each suite, compared by median.')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='Baseline results to compare with.')
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as the new baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed regression, 0.2 for 20%%.')
+    parser.add_argument('--output', help='File where the results are written as JSON.')
+    options = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = os.path.join(tmp, 'run')
+        os.makedirs(work_dir)
+        os.makedirs(os.path.join(tmp, 'data'))
+        os.makedirs(os.path.join(tmp, 'processed'))
+        write_synthetic_dump(os.path.join(tmp, 'ol_dump_editions.txt'), options.rows,
+                             vocabulary_size=options.vocabulary, max_subjects=options.max_subjects,
+                             seed=options.seed, zipf=options.zipf)
+        suites = [name for name in SUITES if name in options.suites]
+        if 'parse' not in suites:
+            suites.insert(0, 'parse')
+        for name in suites:
+            runs = []
+            for _ in range(options.repeat):
+                # spawn a fresh interpreter, so the peak memory is the suite's own
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                    runs.append(executor.submit(run_suite, name, options, work_dir).result())
+            results[name] = median_results(runs)
+            print(f"{name}: " + ', '.join(f"{metric}={value:,.2f}" if isinstance(value, float)
+                                          else f"{metric}={value}"
+                                          for metric, value in results[name].items()))
+
+    results['settings'] = {name: getattr(options, name) for name in
+                           ('rows', 'vocabulary', 'max_subjects', 'zipf', 'seed', 'workers', 'writers',
+                            'batch_size', 'queries', 'mongo_queries', 'selectivity', 'books', 'concurrency',
+                            'http_latency', 'repeat')}
+    results['settings']['mongo'] = 'mongod' if options.mongo_uri else 'mongomock'
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    regressions = 0
+    if os.path.exists(options.baseline) and not options.save_baseline:
+        with open(options.baseline, 'r', encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('settings') != results['settings']:
+            print('Warning: the baseline was recorded with different settings', file=sys.stderr)
+        print(f"\n{'suite':<14}{'metric':<20}{'baseline':>12}{'current':>12}{'change':>9}")
+        for suite, metric, reference, value, change, regressed in compare(results, baseline,
+                                                                          options.tolerance):
+            regressions += regressed
+            print(f"{suite:<14}{metric:<20}{reference:>12,.2f}{value:>12,.2f}{change:>+9.1%}"
+                  + ('  REGRESSION' if regressed else ''))
+    if options.save_baseline:
+        with open(options.baseline, 'w', encoding='utf-8') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print(f"Baseline saved to {options.baseline}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
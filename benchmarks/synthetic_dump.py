@@ -0,0 +1,51 @@
+import json
+import random
+
+
+def synthetic_edition_lines(rows: int, vocabulary_size: int = 1000, max_subjects: int = 5,
+                            seed: int = 0, zipf: float = 1.0):
+    """
+        Generates lines in the 'ol_dump_editions' TSV format.
+
+        Args:
+        - rows (int): The number of lines to generate.
+        - vocabulary_size (int): The number of distinct subjects.
+        - max_subjects (int): The maximum number of subjects of each edition.
+        - seed (int): The seed of the random generator, so runs are reproducible.
+        - zipf (float): The exponent of the subject distribution. The subject of rank r is
+          drawn with a weight of 1 / r ** zipf: with 1, a few subjects are very common and
+          most of them are rare, and with 0 all the subjects are equally likely.
+
+        Yields:
+        str: A dump line terminated by a newline.
+    """
+    rng = random.Random(seed)
+    vocabulary = ['Subject %d %s' % (i, rng.choice(['Fiction', 'History', 'Science', 'Art']))
+                  for i in range(vocabulary_size)]
+    weights = [1.0 / (rank + 1) ** zipf for rank in range(vocabulary_size)]
+    for i in range(rows):
+        key = '/books/OL%dM' % (i + 1)
+        book = {
+            'key': key,
+            'title': 'Synthetic title %d' % i,
+            'type': {'key': '/type/edition'},
+            'works': [{'key': '/works/OL%dW' % (i // 2 + 1)}],
+            'number_of_pages': rng.randint(20, 900),
+            'latest_revision': 3,
+            'revision': 3,
+            'last_modified': {'type': '/type/datetime', 'value': '2023-01-01T00:00:00.000000'},
+        }
+        subject_count = rng.randint(0, max_subjects)
+        if subject_count:
+            book['subjects'] = list(dict.fromkeys(rng.choices(vocabulary, weights, k=subject_count)))
+        yield '\t'.join(['/type/edition', key, '3', '2023-01-01T00:00:00.000000',
+                         json.dumps(book)]) + '\n'
+
+
+def write_synthetic_dump(path: str, rows: int, **kwargs) -> int:
+    """
+        Writes a synthetic editions dump to 'path' and returns its size in bytes.
+    """
+    with open(path, 'w', encoding='utf-8') as dump_file:
+        dump_file.writelines(synthetic_edition_lines(rows, **kwargs))
+        return dump_file.tell()
@@ -1,9 +1,6 @@
 import argparse
-from src.download_data import thread_download
-from src.data_processing import ol_read_manipulate_files
-from src.database_manipulation import write_to_mongodb, read_from_mongodb
-from src.books_retieve import books_request_by_key
-import json
+import os
+import sys
 
 """
     OpenLibrary Book Search Script
@@ -16,12 +13,50 @@ import json
     - Retrieve books based on specified topics
     
     Usage:
-    python search_books.py [--updatedata] [--consoleoutput] [topics [topics ...]]
+    python search_books.py update [--backend {mongodb,local}] [--workers N] [--segments N] [--stream] [--dumpfile PATH] [--pipeline] [--writers N] [--batch-size N] [--incremental] [--works] [--profile] [--profile-json PATH] [--cprofile DIR]
+    python search_books.py search [--backend {mongodb,local}] [--fuzzy] [--limit N] [--offset N] [--concurrency N] [--rate R] [--works] [--no-cache] [--cache-ttl DAYS] [--cache-size MB] [--server URL] [--consoleoutput] [--output PATH] [--profile] [--profile-json PATH] [--cprofile DIR] topics [topics ...]
+    python search_books.py serve [--backend {mongodb,local}] [--concurrency N] [--rate R] [--works] [--no-cache] [--cache-ttl DAYS] [--cache-size MB] [--host HOST] [--port N] [--result-cache MB] [--profile] [--profile-json PATH] [--cprofile DIR]
+    python search_books.py [--updatedata] [--serve] [options of the three commands] [topics [topics ...]]
+    
+    Each command only imports the modules it uses: a search does not load pyarrow, a search on the local
+    index does not load pymongo, and a search sent to a query service with '--server' only loads the
+    standard library. The last form, without a command, is the original interface: it updates the data
+    with '--updatedata', then serves the searches with '--serve' or searches the topics.
     
     Arguments:
+    - update: Command to download data, process it and update the database or the local index.
+    - search: Command to retrieve the books matching the topics.
+    - serve: Command to run the query service.
     - --updatedata: Optional argument to download data, update the database, and process the data.
+    - --backend: Optional storage used to search books, 'mongodb' (default) or 'local'.
+    - --workers: Optional number of processes used to parse the dump.
+    - --segments: Optional number of byte ranges of the dump downloaded in parallel.
+    - --stream: Optional argument to decompress and parse the dump while it downloads.
+    - --dumpfile: Optional path of an already downloaded .txt.gz dump to process offline.
+    - --pipeline: Optional argument to download, parse and load the dump at the same time through bounded queues.
+    - --writers: Optional number of threads loading the books into the database.
+    - --batch-size: Optional number of books sent to the database in each bulk write.
+    - --incremental: Optional argument to update only new, changed or removed books in the database.
+    - --fuzzy: Optional argument to also search the subjects that approximately match the topics.
+    - --limit: Optional number of best matching books to retrieve, ranked by matched topics and subject specificity.
+    - --offset: Optional number of best matching books to skip, to retrieve the following pages.
+    - --concurrency: Optional maximum number of book details requested at the same time.
+    - --rate: Optional maximum number of book details requested per second.
+    - --works: Optional argument to download and index the works dump, and read book details from it. It cannot be used with --stream, --dumpfile or --pipeline.
+    - --no-cache: Optional argument to fetch every book from the API without the local cache.
+    - --cache-ttl: Optional number of days cached books are used without revalidation.
+    - --cache-size: Optional disk budget of the cache, in MB.
+    - --serve: Optional argument to run the query service, keeping connections and indexes open.
+    - --host: Optional address the query service listens on.
+    - --port: Optional port the query service listens on.
+    - --result-cache: Optional memory budget of the search results cached by the query service, in MB.
+    - --profile: Optional argument to print the time, rows, bytes and peak memory of every stage.
+    - --profile-json: Optional file where the profiling report is written as JSON, '-' for the console.
+    - --cprofile: Optional folder where the hot stages dump their cProfile statistics.
+    - --server: Optional URL of a running query service that answers the search.
     - --consoleoutput: Optional argument to display obtained books in the console. If not specified,
       the output will be saved as a JSON file in the '/output/output.json' directory.
+    - --output: Optional output file. A path ending with '.gz' is gzip-compressed, and '-' is the console.
     - topics: The topics by which to search for books in OpenLibrary.
     
     The script uses command-line arguments to specify whether to update data, display output in
@@ -29,58 +64,452 @@ import json
     downloads data from OpenLibrary, processes it, and updates the database. Subsequently, it retrieves
     books based on the specified topics and provides output according to the specified options.
     
-    This script requires the following modules and functions:
+    This script requires the following modules and functions, imported by the commands that use them:
     - argparse: For parsing command-line arguments.
     - src.download_data.thread_download: Function to download data from OpenLibrary.
+    - src.download_data.stream_dump_lines: Function to stream and decompress the dump from OpenLibrary.
+    - src.download_data.read_dump_lines: Function to decompress an already downloaded dump.
     - src.data_processing.ol_read_manipulate_files: Function to process downloaded data.
+    - src.data_processing.ol_process_dump_lines: Function to process streamed dump lines.
     - src.database_manipulation.write_to_mongodb: Function to update the database.
+    - src.database_manipulation.sync_to_mongodb: Function to apply only the changes to the database.
     - src.database_manipulation.read_from_mongodb: Function to retrieve book keys from the database.
-    - src.books_retieve.books_request_by_key: Function to retrieve book details based on keys.
-    - json: For handling JSON data.
+    - src.inverted_index.build_inverted_index: Function to build the local topic index.
+    - src.inverted_index.iter_from_index: Function to stream book keys from the local topic index.
+    - src.database_manipulation.read_ranked_from_mongodb: Function to retrieve a page of the best matching book keys from the database.
+    - src.inverted_index.read_ranked_from_index: Function to retrieve a page of the best matching book keys from the local topic index.
+    - src.database_manipulation.read_subject_vocabulary: Function to retrieve the distinct subjects from the database.
+    - src.inverted_index.read_vocabulary: Function to retrieve the distinct subjects from the local topic index.
+    - src.fuzzy_match.SubjectMatcher: Class to find the subjects close to misspelled topics.
+    - src.fuzzy_match.open_subject_matcher: Function to open the fuzzy matcher saved by the update.
+    - src.books_retieve.iter_books_by_key: Function to retrieve book details based on keys, as they arrive.
+    - src.work_cache.WorkCache: Persistent cache of the book details.
+    - src.works_dump.build_works_index: Function to index the local works dump.
+    - src.works_dump.WorksDump: Class to read book details from the local works dump.
+    - src.output_writer.write_jsonl: Function to write the books as JSON lines while they are retrieved.
+    - src.query_service.QueryService: Class answering searches with warm connections and indexes.
+    - src.query_service.serve: Function to serve the searches over HTTP.
+    - src.result_cache.ResultCache: In-memory cache of the search results of the query service.
+    - src.pipeline.pipelined_update: Function to download, parse and load the dump in overlapping stages.
+    - src.profiling: Stage timers, counters and memory peaks of the '--profile' report.
+    - src.query_client.iter_remote_books: Function to retrieve books from a running query service.
     
     To use this script, provide the desired options and topics as command-line arguments when executing
     the script. For example:
-    python search_books.py --updatedata --consoleoutput science fiction fantasy
+    python search_books.py update
+    python search_books.py search --consoleoutput science fiction fantasy
 """
 
-parser = argparse.ArgumentParser(description='Search for books in OpenLibrary by topics')
-parser.add_argument(
-    '--updatedata',
-    action='store_true',
-    help='Download data and update the database(optional).')
-parser.add_argument(
-    '--consoleoutput',
-    action='store_true',
-    help='Displays all books obtained, by console. if not specified, the output will be a json file in /output/output.json')
-parser.add_argument(
-    'topics',
-    nargs='*',
-    help='The topics you want to search by.')
-
-args = parser.parse_args()
-
-if args.updatedata:
+
+COMMANDS = ('update', 'search', 'serve')
+
+
+def open_book_sources(args):
+    """
+        Opens the cache of book details and the local works dump selected by the options.
+        Books are fetched without the cache, with a warning, when it cannot be opened. The
+        command stops when the works dump asked by '--works' cannot be opened.
+    """
+    import sqlite3
+    from src.work_cache import CACHE_PATH, WorkCache
+    from src.works_dump import WorksDump
+    works = None
+    if args.works:
+        try:
+            works = WorksDump()
+        except (OSError, sqlite3.Error) as e:
+            sys.exit(f"The works dump could not be opened ({e}), run 'search_books.py update --works' "
+                     "to download and index it")
+    cache = None
+    if not args.no_cache:
+        try:
+            cache = WorkCache(ttl=args.cache_ttl * 24 * 3600, max_bytes=args.cache_size * 2 ** 20)
+        except (OSError, sqlite3.Error) as e:
+            print(f'Warning: the cache {CACHE_PATH} could not be opened ({e}), books are fetched without it',
+                  file=sys.stderr)
+    return cache, works
+
+
+def run_update(args):
+    """
+        Downloads and processes the dump, then loads the database or builds the local index.
+    """
+    from src import profiling
+    from src.download_data import stream_dump_lines, read_dump_lines
+
+    # Only the download of the files fetches the works dump
+    if args.works and (args.stream or args.dumpfile or args.pipeline):
+        sys.exit("'--works' downloads the dump files, it cannot be used with '--stream', '--dumpfile' "
+                 "or '--pipeline'")
     print('Update Data')
-    # Download data from OpenLibrary
-    thread_download()
-    ol_read_manipulate_files()
-    write_to_mongodb()
-
-topics_list = []
-books = []
-if args.topics:
+    if args.pipeline:
+        from src.pipeline import pipelined_update, format_pipeline_stats
+        lines = read_dump_lines(args.dumpfile) if args.dumpfile else stream_dump_lines()
+        # Without --incremental, the books are loaded into MongoDB while they are parsed
+        load_mongodb = args.backend == 'mongodb' and not args.incremental
+        with profiling.stage('pipeline'):
+            stats = pipelined_update(lines, load_mongodb=load_mongodb, parse_workers=args.workers,
+                                     writers=args.writers, batch_size=args.batch_size, report_every=10)
+        print(format_pipeline_stats(stats))
+        if args.backend == 'local':
+            from src.inverted_index import build_inverted_index
+            with profiling.stage('index_build', hot=True):
+                build_inverted_index()
+        elif args.incremental:
+            from src.database_manipulation import sync_to_mongodb
+            with profiling.stage('mongo_sync'):
+                sync_to_mongodb(batch_size=args.batch_size)
+        return
+
+    from src.data_processing import ol_read_manipulate_files, ol_process_dump_lines
+    if args.dumpfile:
+        with profiling.stage('process'):
+            ol_process_dump_lines(read_dump_lines(args.dumpfile))
+    elif args.stream:
+        # Stream data from OpenLibrary straight into the parser
+        with profiling.stage('process'):
+            ol_process_dump_lines(stream_dump_lines())
+    else:
+        from src.download_data import thread_download
+        # Download data from OpenLibrary
+        if not thread_download(segments=args.segments, include_works=args.works):
+            print('The dumps could not all be downloaded and decompressed, the data was not updated')
+            return
+        with profiling.stage('process'):
+            ol_read_manipulate_files(workers=args.workers)
+        if args.works:
+            from src.works_dump import build_works_index
+            with profiling.stage('works_index'):
+                build_works_index()
+    if args.backend == 'local':
+        from src.inverted_index import build_inverted_index
+        with profiling.stage('index_build', hot=True):
+            build_inverted_index()
+    elif args.incremental:
+        from src.database_manipulation import sync_to_mongodb
+        with profiling.stage('mongo_sync'):
+            sync_to_mongodb(batch_size=args.batch_size)
+    else:
+        from src.database_manipulation import write_to_mongodb
+        stats = write_to_mongodb(workers=args.writers, batch_size=args.batch_size)
+        if stats:
+            print('Loaded {inserted} books in {seconds:.1f}s ({docs_per_sec:.0f} docs/sec), '
+                  '{failed} failed'.format(**stats))
+
+
+def run_serve(args):
+    """
+        Runs the query service until interrupted.
+    """
+    from src.query_service import QueryService, serve
+    from src.result_cache import ResultCache
+
+    cache, works = open_book_sources(args)
+    print(f'Serving searches on http://{args.host}:{args.port}', file=sys.stderr)
+    results = ResultCache(args.result_cache * 2 ** 20) if args.result_cache else None
+    serve(QueryService(args.backend, max_workers=args.concurrency, rate=args.rate, cache=cache,
+                       works=works, results=results), args.host, args.port)
+    if works is not None:
+        works.close()
+    if cache is not None:
+        cache.close()
+
+
+def run_search(args):
+    """
+        Retrieves the books matching the topics and writes them as JSON lines.
+    """
+    from src.output_writer import write_jsonl
+
+    topics_list = []
+    if not args.topics:
+        print("No topics were provided.")
+        return
     for topic in args.topics:
         topics_list.append(topic)
 
-    keys = read_from_mongodb(topics_list)
-    books = books_request_by_key(keys)
-    if args.consoleoutput:
-        print(books)
+    if args.server:
+        # The service expands fuzzy topics and fetches the books
+        from src.query_client import iter_remote_books
+        write_jsonl(iter_remote_books(topics_list, args.fuzzy, args.server, args.limit, args.offset),
+                    '-' if args.consoleoutput else args.output)
+        return
+
+    from src.books_retieve import iter_books_by_key
+    from src import profiling
+    # Only the modules of the selected backend are imported
+    if args.backend == 'local':
+        from src.inverted_index import INDEX_PATH, iter_from_index, read_ranked_from_index, read_vocabulary
+    else:
+        from src.database_manipulation import read_from_mongodb, read_ranked_from_mongodb, read_subject_vocabulary
+
+    if args.fuzzy:
+        # The matcher saved by the update is opened, the vocabulary is only read without one
+        from src.fuzzy_match import MATCHER_PATH, open_subject_matcher
+        with profiling.stage('fuzzy_expand'):
+            if args.backend == 'local':
+                matcher = open_subject_matcher(os.path.join(INDEX_PATH, 'matcher'), read_vocabulary)
+            else:
+                matcher = open_subject_matcher(MATCHER_PATH, read_subject_vocabulary)
+            topics_list = matcher.expand(topics_list)
+            matcher.close()
+
+    # Only the page of the best matches is fetched with --limit or --offset
+    ranked = args.limit is not None or args.offset > 0
+    if args.backend == 'local' and ranked:
+        keys = read_ranked_from_index(topics_list, args.limit, args.offset)
+    elif args.backend == 'local':
+        keys = iter_from_index(topics_list)
+    elif ranked:
+        keys = read_ranked_from_mongodb(topics_list, args.limit, args.offset)
+    else:
+        keys = read_from_mongodb(topics_list)
+    cache, works = open_book_sources(args)
+    # A ranked page is written best match first
+    books = iter_books_by_key(keys, args.concurrency, args.rate, cache=cache, works=works, ordered=ranked)
+    books = profiling.timed_iter('fetch_books', books, hot=True)
+    # Books are written one by one while they are fetched
+    write_jsonl(books, '-' if args.consoleoutput else args.output)
+    if works is not None:
+        works.close()
+    if cache is not None:
+        print('Cache: {hits} hits, {misses} misses, {revalidated} revalidated'.format(**cache.stats()),
+              file=sys.stderr)
+        cache.close()
+
+
+def run(args):
+    """
+        Runs the update, the query service or the search selected by the options of the
+        original interface, without a command.
+    """
+    if args.updatedata:
+        run_update(args)
+    if args.serve:
+        run_serve(args)
     else:
-        with open("output/output.json", 'w') as json_file:
-            for elem in books:
-                json.dump(elem, json_file)
-                json_file.write('\n')
+        run_search(args)
+
+
+def add_backend_arguments(parser):
+    parser.add_argument(
+        '--backend',
+        choices=['mongodb', 'local'],
+        default='mongodb',
+        help='Where the books are stored and searched: the MongoDB database or a local inverted index (optional).')
+
+
+def add_update_arguments(parser):
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='Upsert only new or changed books and delete removed ones instead of reloading the database (optional).')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Number of processes used to parse the dump when updating data (optional).')
+    parser.add_argument(
+        '--segments',
+        type=int,
+        default=1,
+        help='Number of byte ranges of the dump downloaded in parallel when updating data (optional).')
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help='Decompress the dump while it downloads and parse it on the fly, without temporary files (optional).')
+    parser.add_argument(
+        '--dumpfile',
+        help='Process an already downloaded .txt.gz dump instead of downloading it (optional).')
+    parser.add_argument(
+        '--pipeline',
+        action='store_true',
+        help='Stream, parse and load the dump in stages running at the same time, connected by bounded queues (optional).')
+    parser.add_argument(
+        '--writers',
+        type=int,
+        default=4,
+        help='Number of threads loading the books into the database when updating data (optional).')
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=1000,
+        help='Number of books sent to the database in each bulk write when updating data (optional).')
+
+
+def add_works_arguments(parser):
+    parser.add_argument(
+        '--works',
+        action='store_true',
+        help='Download and index the works dump when updating data, and read book details from it (optional).')
+
+
+def add_fetch_arguments(parser):
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=8,
+        help='Maximum number of book details requested at the same time (optional).')
+    parser.add_argument(
+        '--rate',
+        type=float,
+        default=3.0,
+        help='Maximum number of book details requested per second (optional).')
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Do not use the local cache of book details in ../data/works_cache.sqlite (optional).')
+    parser.add_argument(
+        '--cache-ttl',
+        type=float,
+        default=7,
+        help='Number of days cached book details are used without revalidation (optional).')
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=512,
+        help='Disk budget of the cache of book details, in MB (optional).')
+
+
+def add_search_arguments(parser, topics_nargs: str = '*'):
+    parser.add_argument(
+        '--consoleoutput',
+        action='store_true',
+        help='Displays all books obtained, by console. if not specified, the output will be a json file in /output/output.json')
+    parser.add_argument(
+        '--output',
+        default='output/output.json',
+        help='File where the books are written as JSON lines, gzip-compressed if it ends with .gz (optional).')
+    parser.add_argument(
+        'topics',
+        nargs=topics_nargs,
+        help='The topics you want to search by.')
+    parser.add_argument(
+        '--fuzzy',
+        action='store_true',
+        help='Also search the subjects that approximately match the topics, such as misspelled ones (optional).')
+    parser.add_argument(
+        '--limit',
+        type=int,
+        help='Retrieve only the N best matching books, ranked by matched topics and subject specificity (optional).')
+    parser.add_argument(
+        '--offset',
+        type=int,
+        default=0,
+        help='Skip the N best matching books, to retrieve the following pages with --limit (optional).')
+    parser.add_argument(
+        '--server',
+        help='URL of a running query service to send the search to, such as http://127.0.0.1:8080 (optional).')
+
+
+def add_serve_arguments(parser):
+    parser.add_argument(
+        '--host',
+        default='127.0.0.1',
+        help='Address the query service listens on (optional).')
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=8080,
+        help='Port the query service listens on (optional).')
+    parser.add_argument(
+        '--result-cache',
+        type=int,
+        default=64,
+        help='Memory budget of the search results cached by the query service, in MB, 0 to disable it (optional).')
+
+
+def add_profile_arguments(parser):
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='Print the time, rows, bytes and peak memory of every stage on the console (optional).')
+    parser.add_argument(
+        '--profile-json',
+        help="File where the profiling report is written as JSON, '-' for the console (optional).")
+    parser.add_argument(
+        '--cprofile',
+        help='Folder where the hot stages (parsing, loading, index build, fetching) dump their cProfile statistics (optional).')
+
+
+def command_parser() -> argparse.ArgumentParser:
+    """
+        Returns the parser of the 'update', 'search' and 'serve' commands.
+    """
+    parser = argparse.ArgumentParser(
+        description='Search for books in OpenLibrary by topics',
+        epilog='Without a command, the options of all the commands are accepted as before, for example '
+               '"search_books.py --updatedata --consoleoutput science".')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    update = commands.add_parser('update', help='Download data and update the database or the local index.')
+    add_backend_arguments(update)
+    add_update_arguments(update)
+    add_works_arguments(update)
+    add_profile_arguments(update)
+    update.set_defaults(handler=run_update)
+
+    search = commands.add_parser('search', help='Search for books by topics.')
+    add_backend_arguments(search)
+    add_search_arguments(search, '+')
+    add_fetch_arguments(search)
+    add_works_arguments(search)
+    add_profile_arguments(search)
+    search.set_defaults(handler=run_search)
+
+    serve = commands.add_parser('serve', help='Run the query service, answering searches over HTTP.')
+    add_backend_arguments(serve)
+    add_fetch_arguments(serve)
+    add_works_arguments(serve)
+    add_serve_arguments(serve)
+    add_profile_arguments(serve)
+    serve.set_defaults(handler=run_serve)
+    return parser
+
+
+def legacy_parser() -> argparse.ArgumentParser:
+    """
+        Returns the parser of the original interface, with the options of all the commands.
+    """
+    parser = argparse.ArgumentParser(description='Search for books in OpenLibrary by topics')
+    parser.add_argument(
+        '--updatedata',
+        action='store_true',
+        help='Download data and update the database(optional).')
+    parser.add_argument(
+        '--serve',
+        action='store_true',
+        help='Run the query service, answering searches over HTTP with warm connections and indexes (optional).')
+    add_backend_arguments(parser)
+    add_update_arguments(parser)
+    add_search_arguments(parser)
+    add_fetch_arguments(parser)
+    add_works_arguments(parser)
+    add_serve_arguments(parser)
+    add_profile_arguments(parser)
+    parser.set_defaults(handler=run)
+    return parser
+
+
+def main(argv: list = None):
+    argv = sys.argv[1:] if argv is None else argv
+    # The original interface is used when the first argument is neither a command nor --help
+    if argv[:1] and argv[0] in COMMANDS + ('-h', '--help'):
+        args = command_parser().parse_args(argv)
+    else:
+        args = legacy_parser().parse_args(argv)
+
+    from src import profiling
+    if args.profile or args.profile_json or args.cprofile:
+        profiling.enable(cprofile_dir=args.cprofile)
+    try:
+        args.handler(args)
+    finally:
+        if args.profile:
+            print(profiling.format_report(profiling.report()), file=sys.stderr)
+        if args.profile_json:
+            profiling.write_report(args.profile_json)
+
 
-else:
-    print("No topics were provided.")
+if __name__ == '__main__':
+    main()
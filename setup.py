@@ -5,7 +5,7 @@ from setuptools import setup
 setup(
     name='openlibrarypoller',
     version='1.0',
-    install_requires=['pandas', 'pymongo[srv]'],
+    install_requires=['pymongo[srv]', 'pyarrow', 'requests'],
     packages=find_packages(exclude=['notebooks']),
     py_modules=['config'],
     include_package_data=True,
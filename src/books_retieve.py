@@ -1,7 +1,206 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import requests
+from requests.adapters import HTTPAdapter
+from src import profiling
+from src.work_cache import WorkCache
+from src.works_dump import WorksDump
 
+OPENLIBRARY_URL = 'https://openlibrary.org'
 
-def books_request_by_key(keys: list) -> list:
+# HTTP status codes worth retrying: rate limited or temporary server errors
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    """
+        Thread-safe limiter that spaces calls to at most 'rate' per second.
+
+        Every call to 'wait' reserves the next free slot and sleeps until it, so the limit
+        is global to all the threads that share the limiter.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def make_session(pool_size: int) -> requests.Session:
+    """
+        Creates a requests session whose connection pool keeps up to 'pool_size' connections
+        per host, so concurrent requests reuse open TLS connections.
+    """
+    session = requests.Session()
+    # Open Library asks API clients to identify themselves
+    session.headers['User-Agent'] = 'openlibrarypoller/1.0'
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch_book(session: requests.Session, key: str, limiter: RateLimiter = None,
+               base_url: str = OPENLIBRARY_URL, retries: int = 5, backoff: float = 1.0,
+               cache: WorkCache = None, works: WorksDump = None):
+    """
+        Fetches the details of one work from the Open Library API.
+
+        Args:
+        - session (requests.Session): The session used to send the request.
+        - key (str): A book key in the format 'https://openlibrary.org/works/{book_key}'.
+        - limiter (RateLimiter): The limiter shared by all the requests (optional).
+        - base_url (str): The URL of the Open Library API.
+        - retries (int): The number of retries on 429/5xx responses and connection errors.
+        - backoff (float): The first retry delay in seconds, doubled after every retry. A
+          'Retry-After' header sent by the server takes precedence.
+        - cache (WorkCache): The cache consulted before sending any request (optional). Fresh
+          entries are returned directly, stale ones are revalidated with a conditional
+          request, and fetched works are stored in it.
+        - works (WorksDump): The local works dump, consulted before the cache and the API
+          (optional). An edition key is first resolved to the key of its work, which is then
+          read from the dump, the cache or the API.
+
+        Returns:
+        dict: The book details, or None if the book could not be fetched.
+    """
+    book_key = key.split('/')[-1]
+    if works is not None:
+        book_key = works.work_id(book_key) or book_key
+        book = works.get(book_key)
+        if book is not None:
+            profiling.add('works_dump', 1)
+            return book
+    cached, headers = None, {}
+    if cache is not None:
+        cached, fresh, headers = cache.lookup(book_key)
+        if fresh:
+            profiling.add('work_cache', 1)
+            return cached
+    url = f"{base_url}/works/{book_key}.json"
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            with profiling.stage('rate_limit_wait'):
+                limiter.wait()
+        delay = backoff * 2 ** attempt
+        try:
+            with profiling.stage('http_get'):
+                response = session.get(url, headers=headers, timeout=30)
+            profiling.add('http_get', 1, len(response.content))
+        except (requests.ConnectionError, requests.Timeout):
+            response = None
+        if response is not None:
+            if response.status_code == 304 and cached is not None:
+                cache.refresh(book_key)
+                return cached
+            if response.status_code == 200:
+                book = response.json()
+                if cache is not None:
+                    cache.store(book_key, book, response.headers.get('ETag'),
+                                response.headers.get('Last-Modified'))
+                return book
+            if response.status_code not in RETRY_STATUS:
+                return None
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                delay = int(retry_after)
+        if attempt < retries:
+            time.sleep(delay)
+    return None
+
+
+def iter_books_by_key(keys, max_workers: int = 8, rate: float = 3.0,
+                      base_url: str = OPENLIBRARY_URL, retries: int = 5, cache: WorkCache = None,
+                      works: WorksDump = None, session: requests.Session = None,
+                      limiter: RateLimiter = None, ordered: bool = False):
+    """
+        Fetches book details concurrently and yields them as soon as they arrive, or in the
+        order of the keys with 'ordered'.
+
+        Args:
+        - keys (iterable): Book keys in the format 'https://openlibrary.org/works/{book_key}'.
+        - max_workers (int): The maximum number of requests in flight.
+        - rate (float): The maximum number of requests per second for all the workers, within
+          the limits Open Library asks identified clients to respect. Use 0 to disable the
+          limit, for example against a local server.
+        - base_url (str): The URL of the Open Library API.
+        - retries (int): The number of retries of each request, see 'fetch_book'.
+        - cache (WorkCache): The cache of fetched works, see 'fetch_book' (optional).
+        - works (WorksDump): The local works dump, see 'fetch_book' (optional).
+        - session (requests.Session): A session kept open by the caller, whose connections
+          are reused across calls (optional). It is not closed.
+        - limiter (RateLimiter): A limiter shared with other calls, used instead of 'rate'
+          (optional).
+        - ordered (bool): Yield the books in the order of 'keys', for example a ranked page,
+          instead of completion order. A window of 'max_workers' requests stays in flight,
+          and a slow book holds back the ones after it.
+
+        Yields:
+        dict: The details of each book that could be fetched, in completion order or in the
+        order of the keys.
+
+        Note:
+        - All the requests share one connection-pooled session, created for the call unless
+          'session' is given.
+        - At most 'max_workers' keys are consumed ahead of the results, so 'keys' can be a
+          generator of any size.
+    """
+    if limiter is None:
+        limiter = RateLimiter(rate)
+    own_session = session is None
+    if own_session:
+        session = make_session(max_workers)
+    keys = iter(keys)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            if ordered:
+                window = deque()
+                for key in keys:
+                    window.append(executor.submit(fetch_book, session, key, limiter, base_url,
+                                                  retries, cache=cache, works=works))
+                    if len(window) >= max_workers:
+                        book = window.popleft().result()
+                        if book is not None:
+                            yield book
+                while window:
+                    book = window.popleft().result()
+                    if book is not None:
+                        yield book
+                return
+            pending = set()
+            for key in keys:
+                pending.add(executor.submit(fetch_book, session, key, limiter, base_url, retries,
+                                            cache=cache, works=works))
+                if len(pending) < max_workers:
+                    continue
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.result() is not None:
+                        yield future.result()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.result() is not None:
+                        yield future.result()
+    finally:
+        if own_session:
+            session.close()
+
+
+def books_request_by_key(keys: list, max_workers: int = 8, rate: float = 3.0,
+                         cache: WorkCache = None, works: WorksDump = None) -> list:
     """
         Retrieves book details from Open Library API based on provided keys.
 
@@ -10,6 +209,11 @@ def books_request_by_key(keys: list) -> list:
 
         Args:
         - keys (list): A list of book keys in the format 'https://openlibrary.org/works/{book_key}'.
+        - max_workers (int): The maximum number of concurrent requests.
+        - rate (float): The maximum number of requests per second.
+        - cache (WorkCache): A persistent cache consulted before the API (optional).
+        - works (WorksDump): The local works dump. Works found in it are read from disk
+          instead of being requested (optional).
 
         Returns:
         list: A list containing book details fetched from the Open Library API for the provided keys.
@@ -17,19 +221,13 @@ def books_request_by_key(keys: list) -> list:
         Note:
         - The function extracts the book key from the URL provided in the 'keys' list.
         - It constructs the API endpoint for each book using the extracted book key.
-        - Retrieves book details for each book key using the Open Library API.
-        - Returns a list containing book details in JSON format for the provided keys.
+        - Retrieves book details concurrently with 'iter_books_by_key', over a shared
+          connection-pooled session, with rate limiting and retries on 429/5xx responses.
+        - Returns a list containing book details in JSON format for the provided keys, in
+          the order in which they were received.
 
         Example:
         books_request_by_key(['https://openlibrary.org/works/OL1W', 'https://openlibrary.org/works/OL2W'])
         # This will fetch book details for books with keys OL1W and OL2W from Open Library API.
         """
-    result = []
-    for key in keys:
-        book_key = key.split('/')[-1]
-        url = f"https://openlibrary.org/works/{book_key}.json"
-        response = requests.get(url)
-        if response.status_code == 200:
-            book_details = response.json()
-            result.append(book_details)
-    return result
+    return list(iter_books_by_key(keys, max_workers, rate, cache=cache, works=works))
@@ -1,55 +1,506 @@
 import json
-import pandas as pd
+import os
+import shutil
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from src import profiling
 
+DF_COLUMNS = ['key', 'title', 'subject_ids', 'revision', 'last_modified']
 
-def ol_read_manipulate_files():
+# Subject dictionary of the processed files: line N holds the subject with id N
+SUBJECTS_FILE = 'subjects.txt'
+
+SCHEMA = pa.schema([
+    ('key', pa.string()),
+    ('title', pa.string()),
+    ('subject_ids', pa.list_(pa.int32())),
+    ('revision', pa.int32()),
+    ('last_modified', pa.string()),
+])
+
+# Number of books of each Parquet row group
+ROW_GROUP_SIZE = 2 ** 14
+
+
+def parse_dump_lines(lines):
     """
-        Reads, processes, and manipulates data from a file in chunks and saves it to CSV files.
+        Parses lines of an OpenLibrary dump and yields the relevant fields of each book.
 
-        The function reads data from the file located at '../data/ol_dump_editions.txt'. It reads
-        the data in chunks using Pandas, selects specific columns, processes JSON data within the
-        'json' column, and creates a new DataFrame with columns 'key', 'title', and 'subjects'.
-        The 'subjects' column is generated by joining subjects from the JSON data.
+        Each line of the dump is a tab separated record with the columns 'type', 'key',
+        'revision', 'last_modified' and 'json'. Only the 'json' column is decoded, and only
+        'key', 'title' and 'subjects' are kept from it. 'revision' and 'last_modified' are
+        kept from the dump columns, for incremental database updates.
 
-        The function iterates through the chunks, processes JSON data from the 'json' column, extracts
-        relevant information such as 'key', 'title', and 'subjects' if available, and appends this
-        information to the 'data' DataFrame.
+        Args:
+        - lines (iterable): An iterable of dump lines (str), for example an open file.
 
-        Upon processing each chunk, the function saves the current 'data' DataFrame into a separate
-        CSV file located at '../data/processed/booksX.csv', where X represents the file number.
+        Yields:
+        tuple: A tuple (key, title, subjects, revision, last_modified) where 'subjects' is the
+        list of subjects of the book, empty if the book has no subjects.
+
+        Note:
+        - Records without 'key' or 'title' are skipped.
+        - Blank lines are ignored.
+    """
+    loads = json.loads
+    for line in lines:
+        fields = line.rstrip('\n').split('\t', 4)
+        if len(fields) < 5:
+            continue
+        book = loads(fields[4])
+        if ('key' not in book) or ('title' not in book):
+            continue
+        title = book['title']
+        yield (book['key'], title if isinstance(title, str) else str(title),
+               book.get('subjects') or [], int(fields[2]) if fields[2].isdigit() else 0, fields[3])
+
+
+def normalize_subjects(subjects) -> list:
+    """
+        Converts the subjects of a book into a list of normalized subjects.
+
+        Args:
+        - subjects (list or str): The list of subjects of a book, or a comma-joined string of
+          them. Other values (such as None or the NaN read by Pandas for empty cells) are
+          treated as no subjects.
+
+        Returns:
+        list: The distinct subjects, lower-cased and with their whitespace collapsed, in
+        their original order.
+    """
+    if isinstance(subjects, str):
+        subjects = subjects.split(',')
+    elif not isinstance(subjects, list):
+        return []
+    normalized = (' '.join(s.split()).lower() for s in subjects if isinstance(s, str))
+    return list(dict.fromkeys(s for s in normalized if s))
+
+
+def intern_subjects(records, dictionary: dict):
+    """
+        Replaces the subjects of parsed records by the ids of their normalized forms.
+
+        The same few hundred thousand subjects are repeated across millions of editions. Each
+        distinct normalized subject is stored once in 'dictionary', and the books only keep
+        arrays of small integer ids.
+
+        Args:
+        - records (iterable): Tuples (key, title, subjects, revision, last_modified) as
+          produced by 'parse_dump_lines'.
+        - dictionary (dict): The subject -> id dictionary. New subjects are added to it with
+          the next free id, so ids follow the order of first appearance.
+
+        Yields:
+        tuple: A tuple (key, title, subject_ids, revision, last_modified).
+    """
+    for key, title, subjects, revision, last_modified in records:
+        subject_ids = []
+        for subject in normalize_subjects(subjects):
+            subject_id = dictionary.get(subject)
+            if subject_id is None:
+                subject_id = dictionary[subject] = len(dictionary)
+            subject_ids.append(subject_id)
+        yield key, title, subject_ids, revision, last_modified
+
+
+def write_subject_dictionary(subjects, output_folder: str):
+    """
+        Writes the subject dictionary of the processed files, one subject per line in id order.
+
+        Args:
+        - subjects (iterable): The subjects in id order, for example the keys of the
+          dictionary filled by 'intern_subjects'.
+        - output_folder (str): The folder of the processed files.
+    """
+    with open(os.path.join(output_folder, SUBJECTS_FILE), 'w', encoding='utf-8') as subjects_file:
+        for subject in subjects:
+            subjects_file.write(subject + '\n')
+
+
+def read_subject_dictionary(folder_path: str = "../data/processed") -> list:
+    """
+        Returns the subjects of the processed files, the subject with id N at position N.
+    """
+    path = os.path.join(folder_path, SUBJECTS_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as subjects_file:
+        return subjects_file.read().splitlines()
+
+
+def columnar_batches(records, batch_size: int):
+    """
+        Groups parsed records into columnar batches.
+
+        Args:
+        - records (iterable): An iterable of tuples with the values of DF_COLUMNS.
+        - batch_size (int): The maximum number of records in each batch.
+
+        Yields:
+        dict: A dictionary mapping each column of DF_COLUMNS to the list of its values in
+        the batch. Only one batch is held in memory at a time.
+    """
+    batch = {column: [] for column in DF_COLUMNS}
+    appends = [batch[column].append for column in DF_COLUMNS]
+    size = 0
+    for record in records:
+        for append, value in zip(appends, record):
+            append(value)
+        size += 1
+        if size == batch_size:
+            yield batch
+            batch = {column: [] for column in DF_COLUMNS}
+            appends = [batch[column].append for column in DF_COLUMNS]
+            size = 0
+    if size:
+        yield batch
+
+
+def batch_table(batch: dict) -> pa.Table:
+    """
+        Converts a columnar batch as produced by 'columnar_batches' into an Arrow table.
+    """
+    return pa.Table.from_pydict(batch, schema=SCHEMA)
+
+
+def parquet_writer(output_file: str) -> pq.ParquetWriter:
+    """
+        Opens a zstd compressed Parquet writer of processed books.
+
+        Every table written to it becomes a row group, with min/max statistics for each
+        column so readers can skip row groups.
+    """
+    return pq.ParquetWriter(output_file, SCHEMA, compression='zstd', write_statistics=True)
+
+
+def write_parquet_batch(batch: dict, output_file: str):
+    """
+        Writes a columnar batch to a Parquet file, in row groups of ROW_GROUP_SIZE books.
+
+        Args:
+        - batch (dict): A columnar batch as produced by 'columnar_batches'.
+        - output_file (str): The path of the Parquet file to write.
+    """
+    with parquet_writer(output_file) as writer:
+        writer.write_table(batch_table(batch), row_group_size=ROW_GROUP_SIZE)
+
+
+@contextmanager
+def processed_output(output_folder: str):
+    """
+        Yields an empty staging folder where a processing run writes its files, and moves
+        them into 'output_folder' once the run succeeds.
+
+        The 'booksX.parquet' files and 'subjects.txt' of an earlier run are deleted at that
+        point. Otherwise, a run writing fewer files would leave older ones behind, whose
+        subject ids refer to the overwritten dictionary. A run that fails leaves the
+        previous files untouched.
+
+        Example:
+        with processed_output('../data/processed') as staging:
+            ...write the files in 'staging'...
+    """
+    staging = output_folder.rstrip('/\\') + '.staging'
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    try:
+        yield staging
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    os.makedirs(output_folder, exist_ok=True)
+    for file_name in os.listdir(output_folder):
+        if (file_name.startswith('books') and '.parquet' in file_name) or file_name == SUBJECTS_FILE:
+            os.remove(os.path.join(output_folder, file_name))
+    for file_name in os.listdir(staging):
+        os.replace(os.path.join(staging, file_name), os.path.join(output_folder, file_name))
+    os.rmdir(staging)
+
+
+def shard_offsets(input_file: str, shards: int) -> list:
+    """
+        Splits a file into byte ranges aligned on line boundaries.
+
+        Args:
+        - input_file (str): The path of the file to split.
+        - shards (int): The desired number of ranges.
+
+        Returns:
+        list: A list of (start, end) byte offsets. Every range starts at the beginning of a
+        line and ends right after a newline (or at the end of the file), so each line belongs
+        to exactly one range. Fewer ranges than requested are returned for small files.
+    """
+    size = os.path.getsize(input_file)
+    boundaries = [0]
+    with open(input_file, 'rb') as dump_file:
+        for i in range(1, shards):
+            dump_file.seek(max(size * i // shards - 1, boundaries[-1]))
+            dump_file.readline()
+            position = min(dump_file.tell(), size)
+            if position > boundaries[-1]:
+                boundaries.append(position)
+    if boundaries[-1] < size:
+        boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def iter_shard_lines(input_file: str, start: int, end: int):
+    """
+        Yields the decoded lines of 'input_file' between the byte offsets 'start' and 'end'.
+    """
+    with open(input_file, 'rb') as dump_file:
+        dump_file.seek(start)
+        position = start
+        while position < end:
+            line = dump_file.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line.decode('utf-8')
+
+
+def process_shard(input_file: str, start: int, end: int, output_file: str) -> tuple:
+    """
+        Parses one byte range of the dump and writes its books to 'output_file'.
+
+        Rows are written to the Parquet file one row group at a time, so a worker uses
+        constant memory regardless of the size of its shard. Subjects are interned in a
+        dictionary local to the shard.
+
+        Returns:
+        tuple: The number of books written and the subjects of the local dictionary, in
+        local id order.
+    """
+    total = 0
+    dictionary = {}
+    with parquet_writer(output_file) as writer:
+        records = intern_subjects(parse_dump_lines(iter_shard_lines(input_file, start, end)), dictionary)
+        for batch in columnar_batches(records, ROW_GROUP_SIZE):
+            writer.write_table(batch_table(batch))
+            total += len(batch['key'])
+    return total, list(dictionary)
+
+
+def remap_shard(output_file: str, remap: list):
+    """
+        Rewrites the 'subject_ids' of a shard file, replacing each local id N by remap[N].
+    """
+    temporary_file = output_file + '.tmp'
+    remap = pa.array(remap, pa.int32())
+    with pq.ParquetFile(output_file) as source, parquet_writer(temporary_file) as writer:
+        for i in range(source.num_row_groups):
+            table = source.read_row_group(i)
+            subject_ids = table.column('subject_ids').combine_chunks()
+            offsets = pc.subtract(subject_ids.offsets, subject_ids.offsets[0])
+            remapped = pa.ListArray.from_arrays(offsets, pc.take(remap, subject_ids.flatten()))
+            writer.write_table(table.set_column(2, SCHEMA.field('subject_ids'), remapped))
+    os.replace(temporary_file, output_file)
+
+
+def ol_read_manipulate_files_parallel(input_file: str, output_folder: str, workers: int,
+                                      shard_size: int = 64 * 2 ** 20) -> int:
+    """
+        Processes the dump in a pool of processes, one byte-range shard per task.
+
+        The file is split into newline aligned shards of about 'shard_size' bytes (and at
+        least one per worker). Shard X is parsed by a worker process that writes its own
+        '../data/processed/booksX.parquet' file. Reading the files in the order of X yields
+        exactly the same rows, in the same order, as the single-process run.
+
+        Each worker interns subjects in its own dictionary. The local dictionaries are merged
+        in shard order, which gives the same ids as the single-process run, and the shards
+        whose local ids differ from the global ones are rewritten in a second parallel pass.
+
+        Args:
+        - input_file (str): The path of the uncompressed editions dump.
+        - output_folder (str): The folder where the Parquet files are written.
+        - workers (int): The number of worker processes.
+        - shard_size (int): The approximate size in bytes of each shard.
+
+        Returns:
+        int: The number of books written.
+    """
+    size = os.path.getsize(input_file)
+    shards = shard_offsets(input_file, max(workers, -(-size // shard_size)))
+    with processed_output(output_folder) as staging:
+        total = _process_shards(input_file, staging, workers, shards, size)
+    return total
+
+
+def _process_shards(input_file: str, output_folder: str, workers: int, shards: list, size: int) -> int:
+    output_files = [os.path.join(output_folder, 'books' + str(file_number) + '.parquet')
+                    for file_number in range(len(shards))]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        with profiling.stage('process_shards'):
+            results = list(executor.map(process_shard,
+                                        [input_file] * len(shards),
+                                        [start for start, _ in shards],
+                                        [end for _, end in shards],
+                                        output_files))
+        total = sum(count for count, _ in results)
+        profiling.add('process_shards', total, size)
+
+        with profiling.stage('remap_shards'):
+            dictionary = {}
+            remaps = {}
+            for output_file, (_, subjects) in zip(output_files, results):
+                remap = [dictionary.setdefault(subject, len(dictionary)) for subject in subjects]
+                if remap != list(range(len(remap))):
+                    remaps[output_file] = remap
+            list(executor.map(remap_shard, list(remaps), list(remaps.values())))
+
+    write_subject_dictionary(dictionary, output_folder)
+    return total
+
+
+def ol_process_dump_lines(lines, output_folder: str = "../data/processed",
+                          chunksize: int = 10 ** 5) -> int:
+    """
+        Parses dump lines and saves the books to Parquet files of 'chunksize' rows, and the
+        subject dictionary to '../data/processed/subjects.txt'.
+
+        Args:
+        - lines (iterable): The lines of an editions dump, for example an open file or the
+          lines streamed by 'src.download_data.stream_dump_lines'.
+        - output_folder (str): The folder where the Parquet files are written.
+        - chunksize (int): The number of books written to each Parquet file.
+
+        Returns:
+        int: The number of books written.
+    """
+    total = 0
+    dictionary = {}
+    records = profiling.timed_iter('parse', parse_dump_lines(lines), hot=True)
+    records = profiling.timed_iter('intern_subjects', intern_subjects(records, dictionary))
+    with processed_output(output_folder) as staging:
+        for file_number, batch in enumerate(columnar_batches(records, chunksize)):
+            # write the batch to a file
+            output_file = os.path.join(staging, 'books' + str(file_number) + '.parquet')
+            with profiling.stage('write_parquet'):
+                write_parquet_batch(batch, output_file)
+            profiling.add('write_parquet', len(batch['key']), os.path.getsize(output_file))
+            total += len(batch['key'])
+        write_subject_dictionary(dictionary, staging)
+    return total
+
+
+def ol_read_manipulate_files(input_file: str = "../data/ol_dump_editions.txt",
+                             output_folder: str = "../data/processed",
+                             chunksize: int = 10 ** 5,
+                             workers: int = 1) -> int:
+    """
+        Reads, processes, and manipulates data from a dump file and saves it to Parquet files.
+
+        The function streams the file located at '../data/ol_dump_editions.txt' line by line,
+        decodes the 'json' column of every record and keeps 'key', 'title' and 'subjects'.
+        The 'revision' and 'last_modified' columns of the dump are kept alongside them.
+
+        Subjects are normalized and interned: each distinct subject is written once to
+        '../data/processed/subjects.txt', and the 'subject_ids' column of every book holds
+        the ids (line numbers in that file) of its subjects.
+
+        Parsed records are grouped into columnar batches of 'chunksize' books. Each batch is
+        saved into a separate Parquet file located at '../data/processed/booksX.parquet', where X
+        represents the file number. Only one batch is held in memory at a time, so memory
+        usage is constant regardless of the size of the dump.
+
+        Args:
+        - input_file (str): The path of the uncompressed editions dump.
+        - output_folder (str): The folder where the Parquet files are written.
+        - chunksize (int): The number of books written to each Parquet file.
+        - workers (int): The number of processes. With more than one worker, the dump is
+          split into byte-range shards that are parsed in parallel by
+          'ol_read_manipulate_files_parallel', and 'chunksize' is not used.
+
+        Returns:
+        int: The number of books written.
 
         Note:
         - The input file '../data/ol_dump_editions.txt' is assumed to exist.
         - JSON data within the file is processed to extract 'key', 'title', and 'subjects'.
-        - The function saves the processed data into separate CSV files.
-    """
-    input_file = "../data/ol_dump_editions.txt"
-
-    columns = ['type', 'key', 'revision', 'last_modified', 'json']
-
-    chunksize = 10 ** 5
-    iterator = pd.read_csv(input_file, sep='\t', iterator=True, chunksize=chunksize, names=columns)
-
-    df_columns = ['key', 'title', 'subjects']
-    data = pd.DataFrame(columns=df_columns)
-
-    file_number = 0
-
-    for iter in iterator:
-        for row in iter['json']:
-            book = json.loads(row)
-            if ('key' not in book) or ('title' not in book):
-                continue
-            else:
-                key = book['key']
-                title = book['title']
-            if 'subjects' in book:
-                subjects = ','.join(book['subjects'])
-            else:
-                subjects = ''
-            data = data.append({'key': key, 'title': title, 'subjects': subjects}, ignore_index=True)
-        # write the dataframe to a file
-        output_file = '../data/processed/books' + str(file_number) + '.csv'
-        data.to_csv(output_file, index=False)
-        file_number += 1
-        data = pd.DataFrame(columns=df_columns)
+        - The function saves the processed data into separate Parquet files.
+        - The files of an earlier run are replaced once the run succeeds, see
+          'processed_output'.
+    """
+    if workers > 1:
+        return ol_read_manipulate_files_parallel(input_file, output_folder, workers)
+
+    with open(input_file, 'r', encoding='utf-8') as dump_file:
+        return ol_process_dump_lines(dump_file, output_folder, chunksize)
+
+
+def processed_files(folder_path: str = "../data/processed") -> list:
+    """
+        Returns the paths of the 'booksX.parquet' files of a folder, ordered by X.
+    """
+    numbers = []
+    for file_name in os.listdir(folder_path):
+        if file_name.startswith('books') and file_name.endswith('.parquet'):
+            number = file_name[len('books'):-len('.parquet')]
+            if number.isdigit():
+                numbers.append(int(number))
+    return [os.path.join(folder_path, 'books' + str(number) + '.parquet') for number in sorted(numbers)]
+
+
+def iter_processed_batches(folder_path: str = "../data/processed", columns: list = None,
+                           batch_size: int = ROW_GROUP_SIZE):
+    """
+        Streams the processed books as Arrow record batches.
+
+        Only the requested columns are read and decompressed, and the batches are views over
+        the decoded Parquet pages, without converting the values to Python objects.
+
+        Args:
+        - folder_path (str): The folder holding the 'booksX.parquet' files.
+        - columns (list): The columns to read, all of DF_COLUMNS by default.
+        - batch_size (int): The maximum number of books of each batch.
+
+        Yields:
+        pyarrow.RecordBatch: The batches of every file, in dump order.
+    """
+    for path in processed_files(folder_path):
+        with pq.ParquetFile(path) as parquet_file:
+            yield from parquet_file.iter_batches(batch_size=batch_size, columns=columns)
+
+
+def read_processed_file(path: str, subjects: list = None, batch_size: int = ROW_GROUP_SIZE):
+    """
+        Streams the books of one processed 'booksX.parquet' file.
+
+        Args:
+        - path (str): The path of the file.
+        - subjects (list): The subject dictionary of 'read_subject_dictionary', used to
+          resolve the subject ids (optional).
+        - batch_size (int): The number of books decoded at a time.
+
+        Yields:
+        dict: One dictionary per book with the keys of DF_COLUMNS. With 'subjects', the
+        'subjects' key holds the list of normalized subjects.
+    """
+    with pq.ParquetFile(path) as parquet_file:
+        for batch in parquet_file.iter_batches(batch_size=batch_size):
+            for record in batch.to_pylist():
+                if subjects is not None:
+                    record['subjects'] = [subjects[i] for i in record['subject_ids']]
+                yield record
+
+
+def iter_processed_records(folder_path: str = "../data/processed", resolve_subjects: bool = True):
+    """
+        Streams the books saved by 'ol_read_manipulate_files'.
+
+        Args:
+        - folder_path (str): The folder holding the 'booksX.parquet' files.
+        - resolve_subjects (bool): Also resolve the subject ids to their normalized strings.
+
+        Yields:
+        dict: One dictionary per book, see 'read_processed_file', in the order in which the
+        books appear in the dump.
+    """
+    subjects = read_subject_dictionary(folder_path) if resolve_subjects else None
+    for path in processed_files(folder_path):
+        yield from read_processed_file(path, subjects)
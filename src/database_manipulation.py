@@ -1,192 +1,647 @@
+import json
 import os
-import pandas as pd
-from pymongo import MongoClient
+import re
+import shutil
+import sqlite3
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pymongo import MongoClient, ReplaceOne, DeleteMany, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
 from pymongo.server_api import ServerApi
 from urllib.parse import quote_plus
-from difflib import SequenceMatcher
-from statistics import median, mean
+from src.fuzzy_match import MATCHER_PATH, SubjectMatcher
+from src.fuzzy_match import getWords, string_matching  # noqa: F401 (kept importable from here)
+from src import profiling
+from src.ranking import specificity, top_matches
+from src.result_cache import bump_data_version
 
+SYNC_STATE_PATH = '../data/sync_state.sqlite'
 
-def write_to_mongodb():
-    """
-        Writes data from CSV files to a MongoDB collection.
+# Error code of a duplicate key, returned when a retried document was already inserted
+DUPLICATE_KEY = 11000
 
-        The function reads CSV files from a specified folder path ('../data/processed'),
-        filters for files with a '.csv' extension, and establishes a connection with a
-        MongoDB database hosted on MongoDB Atlas.
+# The shortest word suffix stored in the 'suffixes' of the 'ol_subjects' collection
+MIN_SUFFIX = 3
 
-        It's important to note that the function uses visible credentials for accessing the
-        MongoDB database. The 'ol_user' used in the connection URI was created with limited
-        time-based access and will be removed from MongoDB after one week for security purposes.
 
-        The function utilizes the 'pymongo' library to establish a connection, create a client,
-        access the specified database ('ol_database'), and a collection ('ol_collection').
-        It then drops the existing collection and proceeds to read each CSV file from the
-        folder, converting its contents into Pandas DataFrames. These DataFrames are then
-        converted into dictionaries and inserted into the MongoDB collection using the
-        'insert_many' method.
+def mongo_client() -> MongoClient:
+    """
+        Creates a client connected to the MongoDB Atlas cluster that holds the books.
 
-        Note:
-        - The MongoDB connection string is created using credentials and the database URI.
-        - The function assumes the existence of CSV files in the specified folder path.
-        - The MongoDB collection ('ol_collection') is cleared ('drop') before inserting
-          new data.
+        The 'ol_user' used in the connection URI was created with limited time-based access.
 
         Returns:
-        None. The function writes data from CSV files to the specified MongoDB collection.
-
-        Raises:
-        Any exceptions raised during the process (such as connection errors, file reading errors,
-        or insertion errors) are caught and printed. The function tries to proceed with the
-        remaining files even if one fails, and eventually closes the MongoDB client connection.
+        MongoClient: A new client. The caller is responsible for closing it.
     """
-    # Path of the folder where the CSV files are located
-    folder_path = '../data/processed'
-
-    # Get all files in the folder
-    archivos_en_carpeta = os.listdir(folder_path)
-
-    # Filtering .csv files
-    archivos_csv = [archivo for archivo in archivos_en_carpeta if archivo.endswith('.csv')]
-
-    # Establish connection with MongoDB
     username = quote_plus('ol_user')
     password = quote_plus('12345678ol_user')
     uri = 'mongodb+srv://' + username + ':' + password + '@oldb.kcwnra7.mongodb.net/?retryWrites=true&w=majority'
 
     # Create a new client and connect to the server
-    client = MongoClient(uri, server_api=ServerApi('1'))
+    return MongoClient(uri, server_api=ServerApi('1'))
 
-    try:
 
-        db = client['ol_database']
-        collection = db['ol_collection']
+def to_document(record: dict) -> dict:
+    """
+        Builds the MongoDB document of a processed book.
 
-        collection.drop()
+        The subject ids of the processed files are local to one processing run, so the
+        document stores the resolved, normalized 'subjects' array instead.
+    """
+    document = {name: value for name, value in record.items() if name != 'subject_ids'}
+    document['subjects'] = record.get('subjects') or []
+    return document
+
+
+def ensure_indexes(db):
+    """
+        Creates the indexes used by the topic searches if they do not exist yet.
+
+        - 'ol_collection.key': unique index used by the upserts and deletions.
+        - 'ol_collection.subjects': multikey index over the normalized subjects array.
+        - 'ol_subjects.suffixes': multikey index over the word suffixes of every subject,
+          see 'subject_suffixes'.
+    """
+    db['ol_collection'].create_index('key', unique=True)
+    db['ol_collection'].create_index('subjects')
+    db['ol_subjects'].create_index('suffixes')
+
+
+def subject_suffixes(subject: str) -> list:
+    """
+        Returns the distinct suffixes of at least 'MIN_SUFFIX' characters of the words of a
+        subject, stored in its 'ol_subjects' document.
+
+        A topic contained in a subject has each of its words inside a word of the subject, so
+        every subject containing the topic has a suffix starting with its longest word. The
+        topics are matched with an anchored prefix search on these suffixes, which uses their
+        index, instead of scanning every subject.
+
+        Example:
+        subject_suffixes('world history') == ['world', 'orld', 'rld', 'history', 'istory',
+                                              'story', 'tory', 'ory']
+    """
+    return list(dict.fromkeys(word[start:] for word in subject.split()
+                              for start in range(len(word) - MIN_SUFFIX + 1)))
+
+
+def matching_subjects(db, topics, fields: dict = None) -> list:
+    """
+        Returns the documents of the 'ol_subjects' collection whose subject contains one of
+        the topics, ignoring case.
+
+        For every topic, the candidates are the subjects having a suffix that starts with the
+        longest word of the topic, found through the index on 'suffixes'. The topic is then
+        looked up in each candidate. A topic without a word of 'MIN_SUFFIX' characters is
+        matched by scanning the subjects.
+
+        Args:
+        - db: The MongoDB database.
+        - topics (list): A list of topics.
+        - fields (dict): The projection of the returned documents, the '_id' only by default.
+    """
+    projection = dict(fields or {}, _id=1)
+    documents = {}
+    for topic in dict.fromkeys(t.lower() for t in topics):
+        word = max(topic.split(), key=len, default='')
+        if len(word) >= MIN_SUFFIX:
+            query = {'suffixes': {'$regex': '^' + re.escape(word)}}
+        else:
+            query = {'_id': {'$regex': re.escape(topic)}}
+        for document in db['ol_subjects'].find(query, projection):
+            if topic in document['_id']:
+                documents[document['_id']] = document
+    return list(documents.values())
+
+
+def rebuild_subject_index(db, batch_size: int = 1000):
+    """
+        Rebuilds the 'ol_subjects' collection from 'ol_collection'.
+
+        'ol_subjects' holds one document per distinct normalized subject, with the subject as
+        '_id', the number of books having it as 'count' and its word suffixes as
+        'suffixes'. It is a few orders of magnitude
+        smaller than the books collection, so substring matches of topics can be resolved on
+        it before querying the multikey 'subjects' index. The aggregation replaces the
+        collection atomically through '$out', then the word suffixes of 'subject_suffixes'
+        are added to every subject, in bulk writes of 'batch_size' subjects.
+    """
+    db['ol_collection'].aggregate([
+        {'$unwind': '$subjects'},
+        {'$group': {'_id': '$subjects', 'count': {'$sum': 1}}},
+        {'$out': 'ol_subjects'},
+    ])
+    subjects = db['ol_subjects']
+    operations = []
+    for document in subjects.find({}, {'_id': 1}):
+        operations.append(UpdateOne({'_id': document['_id']},
+                                    {'$set': {'suffixes': subject_suffixes(document['_id'])}}))
+        if len(operations) == batch_size:
+            subjects.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        subjects.bulk_write(operations, ordered=False)
+    subjects.create_index('suffixes')
+
+
+def update_subject_index(db, added: Counter, removed: Counter, batch_size: int = 1000,
+                         batch_id: str = None):
+    """
+        Applies the subject counts of added and removed books to the 'ol_subjects' collection.
 
-        # Read each CSV file and load the data into DataFrames
-        for archivo_csv in archivos_csv:
-            complete_path = os.path.join(folder_path, archivo_csv)
-            df = pd.read_csv(complete_path)
-            records = df.to_dict(orient='records')
-            collection.insert_many(records)
+        Args:
+        - db: The MongoDB database.
+        - added (Counter): The number of added books for each normalized subject.
+        - removed (Counter): The number of removed books for each normalized subject.
+        - batch_size (int): The number of operations sent in each bulk write.
+        - batch_id (str): An id of the change (optional). Each subject updated for it keeps
+          it in its 'batch' field and is skipped if the same change is applied again, so a
+          change interrupted halfway can be applied again without counting it twice.
+    """
+    delta = Counter(added)
+    delta.subtract(removed)
+    match = {} if batch_id is None else {'batch': {'$ne': batch_id}}
+    update = {} if batch_id is None else {'$set': {'batch': batch_id}}
+    operations = [UpdateOne(dict(match, _id=subject),
+                            dict(update, **{'$inc': {'count': count},
+                                            '$setOnInsert': {'suffixes': subject_suffixes(subject)}}),
+                            upsert=True)
+                  for subject, count in delta.items() if count]
+    for start in range(0, len(operations), batch_size):
+        try:
+            db['ol_subjects'].bulk_write(operations[start:start + batch_size], ordered=False)
+        except BulkWriteError as e:
+            # With 'batch_id', the upsert of a subject already updated for it fails with a
+            # duplicate key, as its '_id' does not match the filter
+            if batch_id is None or any(error['code'] != DUPLICATE_KEY
+                                       for error in e.details.get('writeErrors', [])):
+                raise
+    if operations:
+        db['ol_subjects'].delete_many({'count': {'$lte': 0}})
+
+
+def write_subject_matcher(db, matcher_path: str = None):
+    """
+        Builds the fuzzy matcher of the subjects of the 'ol_subjects' collection and saves it,
+        so fuzzy searches open it instead of reading the whole vocabulary, see
+        'src.fuzzy_match.SubjectMatcher.save'.
+
+        Args:
+        - db: The MongoDB database.
+        - matcher_path (str): The folder of the matcher. Defaults to '../data/subject_matcher'.
+
+        Raises:
+        Any exceptions raised while reading the subjects or writing the matcher are caught and
+        printed, and the previous matcher is removed, so fuzzy searches build it from the
+        collection instead of using stale subjects.
+    """
+    matcher_path = matcher_path or MATCHER_PATH
+    try:
+        vocabulary = [doc['_id'] for doc in db['ol_subjects'].find({}, {'_id': 1})]
+        with profiling.stage('fuzzy_index'):
+            SubjectMatcher(vocabulary).save(matcher_path)
     except Exception as e:
         print(e)
-    finally:
-        client.close()
+        shutil.rmtree(matcher_path, ignore_errors=True)
 
 
-def getWords(input: str) -> list:
+def insert_batch(collection, documents: list, retries: int = 3, backoff: float = 0.5) -> tuple:
     """
-        Extracts words from an input string based on specified criteria.
+        Inserts one batch of documents with an unordered 'insert_many', retrying failures.
 
-        This function splits the input string into words and filters the words based
-        on certain criteria. It calculates the minimum word length depending on the
-        word count and the median length of words to exclude presumed fillers or short
-        words that may not be relevant.
+        With 'ordered=False' the server keeps inserting the rest of the batch after a failed
+        document, so a retry only resends the documents that failed. After a connection
+        error the whole batch is resent: 'insert_many' assigns the '_id' of the documents
+        before sending them, so the ones already written are reported as duplicate keys and
+        counted as inserted instead of being written twice.
 
         Args:
-        - input (str): The input string to extract words from.
+        - collection: The MongoDB collection.
+        - documents (list): The documents to insert.
+        - retries (int): The number of retries of the failed documents.
+        - backoff (float): The first retry delay in seconds, doubled after every retry.
 
         Returns:
-        list: A list containing words from the input string that meet the minimum length
-        criteria calculated based on the word count and median length of words.
+        tuple: The number of inserted documents, the number of documents that still failed
+        after the last retry, and the number of retries.
+    """
+    inserted = 0
+    for attempt in range(retries + 1):
+        try:
+            result = collection.insert_many(documents, ordered=False)
+            return inserted + len(result.inserted_ids), 0, attempt
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            failed = {error['index'] for error in errors if error['code'] != DUPLICATE_KEY}
+            inserted += len(documents) - len(failed)
+            documents = [documents[index] for index in sorted(failed)]
+            if not documents:
+                return inserted, 0, attempt
+        except PyMongoError:
+            pass
+        if attempt < retries:
+            time.sleep(backoff * 2 ** attempt)
+    return inserted, len(documents), retries
+
+
+def bulk_insert(collection, documents, workers: int = 4, batch_size: int = 1000,
+                retries: int = 3) -> dict:
+    """
+        Inserts documents in parallel, unordered batches.
 
-        Note:
-        - The function determines the minimum word length dynamically based on word count
-          and the median length of words in the input string.
-        - It filters out words shorter than the calculated minimum length.
+        The documents are grouped in batches of 'batch_size' and inserted by 'workers'
+        threads with 'insert_batch'. The threads share the connection pool of the client of
+        'collection', and at most two batches per thread are held in memory, so 'documents'
+        can be a generator of any size.
 
-        Example:
-        getWords("This is a test sentence with some words")
-        # This will extract words longer than the dynamically determined minimum length
-        # based on the word count and median length of words in the input string.
+        Args:
+        - collection: The MongoDB collection, of a real or a mock ('mongomock') client.
+        - documents (iterable): The documents to insert.
+        - workers (int): The number of writer threads.
+        - batch_size (int): The number of documents of each 'insert_many'.
+        - retries (int): The number of retries of each batch, see 'insert_batch'.
+
+        Returns:
+        dict: The number of 'inserted' and 'failed' documents, the number of batch
+        'retries', the elapsed 'seconds' and the throughput in 'docs_per_sec'.
     """
-    words = input.split()
-    lengths = [len(x) for x in words if len(x) > 1]
+    stats = {'inserted': 0, 'failed': 0, 'retries': 0}
+    start = time.monotonic()
+
+    def collect(futures):
+        for future in futures:
+            inserted, failed, retried = future.result()
+            stats['inserted'] += inserted
+            stats['failed'] += failed
+            stats['retries'] += retried
+
+    documents = iter(documents)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        while True:
+            batch = [document for _, document in zip(range(batch_size), documents)]
+            if not batch:
+                break
+            pending.add(executor.submit(insert_batch, collection, batch, retries))
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(wait(pending).done)
+    stats['seconds'] = time.monotonic() - start
+    stats['docs_per_sec'] = stats['inserted'] / stats['seconds'] if stats['seconds'] else 0.0
+    return stats
+
+
+def open_sync_state(state_path: str = SYNC_STATE_PATH) -> sqlite3.Connection:
+    """
+        Opens the SQLite sync state of 'sync_to_mongodb', creating its tables if needed.
+
+        - 'editions': the 'key', 'revision' and 'last_modified' of every edition written.
+        - 'meta': the 'last_modified' watermark of the last load or sync, as 'watermark', and
+          the id of the batch being written, as 'batch'.
+        - 'pending': the 'key' of every book of the batch being written, with its 'subjects'
+          before the batch (JSON), see 'write_sync_batch'.
+    """
+    state = sqlite3.connect(state_path)
+    state.execute('CREATE TABLE IF NOT EXISTS editions '
+                  '(key TEXT PRIMARY KEY, revision INTEGER, last_modified TEXT) WITHOUT ROWID')
+    state.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+    state.execute('CREATE TABLE IF NOT EXISTS pending (key TEXT PRIMARY KEY, subjects TEXT) WITHOUT ROWID')
+    return state
+
+
+def write_sync_batch(db, state: sqlite3.Connection, keys: list, write, batch_size: int = 1000):
+    """
+        Writes one batch of an incremental sync and applies its subject counts, so that an
+        interruption at any point can be recovered by 'finish_sync_batch'.
+
+        The subjects of the books of the batch before it are journaled in the 'pending' table
+        of the sync state, with a new batch id, before anything is written. 'write' then
+        writes the books to 'ol_collection', and the difference between their new subjects
+        and the journaled ones is applied to 'ol_subjects' with the batch id. The journal is
+        cleared, but not committed: the caller records the batch in the sync state in the
+        same transaction.
+
+        Args:
+        - db: The MongoDB database.
+        - state (sqlite3.Connection): The sync state, see 'open_sync_state'.
+        - keys (list): The keys of the books written, upserted or deleted.
+        - write (callable): Writes the batch to 'ol_collection'.
+        - batch_size (int): The number of operations sent in each bulk write.
+    """
+    previous = {key: [] for key in keys}
+    for doc in db['ol_collection'].find({'key': {'$in': keys}}, {'key': 1, 'subjects': 1, '_id': 0}):
+        previous[doc['key']] = doc.get('subjects') or []
+    state.executemany('INSERT OR REPLACE INTO pending VALUES (?, ?)',
+                      [(key, json.dumps(subjects)) for key, subjects in previous.items()])
+    state.execute("INSERT OR REPLACE INTO meta VALUES ('batch', ?)", (uuid.uuid4().hex,))
+    state.commit()
+    write()
+    finish_sync_batch(db, state, batch_size)
+
+
+def finish_sync_batch(db, state: sqlite3.Connection, batch_size: int = 1000) -> int:
+    """
+        Applies the subject counts of the batch journaled by 'write_sync_batch' and clears
+        the journal, without committing it.
+
+        The counts are the difference between the subjects the books have now in
+        'ol_collection' and the journaled ones, applied with the batch id by
+        'update_subject_index'. Called again after an interruption, before or after the
+        books were written, it applies each subject change exactly once.
+
+        Returns:
+        int: The number of books of the journaled batch, 0 if there was none.
+    """
+    row = state.execute("SELECT value FROM meta WHERE name = 'batch'").fetchone()
+    if row is None:
+        return 0
+    added = Counter()
+    removed = Counter()
+    keys = []
+    for key, subjects in state.execute('SELECT key, subjects FROM pending'):
+        keys.append(key)
+        removed.update(json.loads(subjects))
+    for start in range(0, len(keys), batch_size):
+        for doc in db['ol_collection'].find({'key': {'$in': keys[start:start + batch_size]}},
+                                            {'subjects': 1, '_id': 0}):
+            added.update(doc.get('subjects') or [])
+    update_subject_index(db, added, removed, batch_size, row[0])
+    state.execute('DELETE FROM pending')
+    state.execute("DELETE FROM meta WHERE name = 'batch'")
+    return len(keys)
+
+
+def record_sync_state(documents, state_path: str = SYNC_STATE_PATH, batch_size: int = 10 ** 4):
+    """
+        Yields the documents of a full load while recording them as the sync state, so the
+        next 'sync_to_mongodb' only writes the books changed since this load.
 
-    # set the minimum word length based on word count
-    # and median of word length to remove presumed fillers
-    minLength = 2
-    if len(words) >= 3 and median(lengths) > 4:
-        minLength = 5
-    elif len(words) >= 2 and median(lengths) > 3:
-        minLength = 4
+        The 'key', 'revision' and 'last_modified' of every document and the 'last_modified'
+        watermark are written to a new state, '<state_path>.loading', which
+        'finish_sync_state' installs once the load is over.
 
-    # keep words of minimum length
-    answer = list()
-    for item in words:
-        if len(item) >= minLength:
-            answer.append(item)
+        Args:
+        - documents (iterable): The documents of the books, see 'to_document'.
+        - state_path (str): The path of the SQLite sync state.
+        - batch_size (int): The number of rows inserted in each transaction.
+    """
+    loading_path = state_path + '.loading'
+    if os.path.exists(loading_path):
+        os.remove(loading_path)
+    # The state is opened by the thread consuming the documents, the only one using it
+    state = open_sync_state(loading_path)
+    watermark = ''
+    rows = []
+    try:
+        for document in documents:
+            rows.append((document['key'], document['revision'], document['last_modified']))
+            watermark = max(watermark, document['last_modified'])
+            if len(rows) == batch_size:
+                state.executemany('INSERT OR REPLACE INTO editions VALUES (?, ?, ?)', rows)
+                state.commit()
+                rows = []
+            yield document
+        state.executemany('INSERT OR REPLACE INTO editions VALUES (?, ?, ?)', rows)
+        state.execute("INSERT OR REPLACE INTO meta VALUES ('watermark', ?)", (watermark,))
+        state.commit()
+    finally:
+        state.close()
 
-    return answer
 
+def finish_sync_state(complete: bool, state_path: str = SYNC_STATE_PATH):
+    """
+        Replaces the sync state with the one recorded by 'record_sync_state' when the load
+        inserted every document.
 
-def string_matching(match_list: list, user_input: str) -> tuple:
+        Otherwise, the collection may miss some of the recorded books, so both states are
+        deleted and the next 'sync_to_mongodb' upserts every book.
+    """
+    loading_path = state_path + '.loading'
+    if complete and os.path.exists(loading_path):
+        os.replace(loading_path, state_path)
+        return
+    for path in (loading_path, state_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def write_to_mongodb(folder_path: str = '../data/processed', workers: int = 4,
+                     batch_size: int = 1000, client: MongoClient = None,
+                     state_path: str = None) -> dict:
     """
-        Finds the best match between user input and a list of strings.
+        Writes data from Parquet files to a MongoDB collection.
+
+        The function reads the 'booksX.parquet' files and the subject dictionary from a specified
+        folder path ('../data/processed'), and establishes a connection with a MongoDB
+        database hosted on MongoDB Atlas.
 
-        This function compares the user input string with a list of strings (matchList)
-        to find the best match based on similarity scores. It calculates the similarity
-        scores using the SequenceMatcher from difflib library.
+        It's important to note that the function uses visible credentials for accessing the
+        MongoDB database. The 'ol_user' used in the connection URI was created with limited
+        time-based access and will be removed from MongoDB after one week for security purposes.
+
+        The function utilizes the 'pymongo' library to establish a connection, create a client,
+        access the specified database ('ol_database'), and a collection ('ol_collection').
+        It then drops the existing collection and streams the books of the Parquet files,
+        converting them into dictionaries that are inserted into the MongoDB collection by
+        'bulk_insert', in unordered batches sent by several writer threads. The subject ids of
+        each book are resolved through the subject dictionary and stored as a normalized
+        'subjects' array, and the indexes and the 'ol_subjects' collection used by
+        'read_from_mongodb' are rebuilt once all the books are loaded.
 
         Args:
-        - match_list (list): A list of strings to be compared with the user input.
-        - user_input (str): The input string provided by the user for comparison.
+        - folder_path (str): The folder holding the processed 'booksX.parquet' files.
+        - workers (int): The number of writer threads.
+        - batch_size (int): The number of books of each 'insert_many'.
+        - client (MongoClient): An existing client, for example connected to a local mongod,
+          used instead of the Atlas cluster (optional). It is not closed.
+        - state_path (str): The path of the SQLite sync state of 'sync_to_mongodb'. Defaults
+          to '../data/sync_state.sqlite'.
 
         Returns:
-        tuple: A tuple containing the maximum similarity score and the string from
-        matchList that has the best match with the user input.
+        dict: The loading statistics of 'bulk_insert', empty if the load failed.
 
         Note:
-        - The function uses difflib's SequenceMatcher to calculate similarity scores
-          between strings.
-        - It compares the user input string with each string in matchList and calculates
-          a score based on full string comparison and word-level comparisons.
-        - The string with the highest score is considered the best match and returned
-          along with its score.
+        - The MongoDB connection string is created using credentials and the database URI.
+        - The function assumes the existence of Parquet files in the specified folder path.
+        - The MongoDB collection ('ol_collection') is cleared ('drop') before inserting
+          new data.
+        - The key, revision and last_modified of every loaded book are recorded as the state
+          of 'sync_to_mongodb', with their latest 'last_modified' as its watermark, so the
+          next incremental sync only writes the changes since this load. If the load fails or
+          some books could not be inserted, the state is deleted instead, and the next sync
+          upserts every book.
+        - Failed batches are retried on their own, without reloading the other books.
+        - The data version is bumped, which invalidates the cached search results.
 
-        Example:
-        string_matching(['apple', 'orange', 'banana'], 'apples')
-        # This will compare 'apples' with 'apple', 'orange', and 'banana' and return
-        # the maximum similarity score and the best-matching string from the list.
+        Raises:
+        Any exceptions raised during the process (such as connection errors or file reading
+        errors) are caught and printed, and eventually the MongoDB client connection is closed.
     """
+    stats = {}
+    state_path = state_path or SYNC_STATE_PATH
+    complete = False
+    own_client = client is None
+    # Establish connection with MongoDB
+    if own_client:
+        client = mongo_client()
 
-    # find the best match between the user input and the link list
-    maxi = 0
-    result = ''
-    for matchItem in match_list:
+    try:
 
-        # ratio of the original item comparison
-        fullRatio = SequenceMatcher(None, user_input, matchItem).ratio()
+        db = client['ol_database']
+        collection = db['ol_collection']
 
-        # every word of the user input will be compared
-        # to each word of the list item, the maximum score
-        # for each user word will be kept
-        wordResults = list()
-        for userWord in getWords(user_input):
-            maxWordRatio = 0
-            for matchWord in getWords(matchItem):
-                wordRatio = SequenceMatcher(None, userWord, matchWord).ratio()
-                if wordRatio > maxWordRatio:
-                    maxWordRatio = wordRatio
-            wordResults.append(maxWordRatio)
+        collection.drop()
 
-        # the total score for each list item is the full ratio
-        # multiplied by the mean of all single word scores
-        itemScore = fullRatio * mean(wordResults)
+        # Stream the books of every Parquet file to the writer threads. pyarrow is imported
+        # here, so searches do not pay for it
+        from src.data_processing import iter_processed_records
+        records = profiling.timed_iter('read_parquet', iter_processed_records(folder_path))
+        documents = record_sync_state((to_document(record) for record in records), state_path)
+        with profiling.stage('mongo_insert', hot=True):
+            stats = bulk_insert(collection, documents, workers, batch_size)
+        profiling.add('mongo_insert', stats['inserted'])
+        complete = not stats['failed']
+
+        with profiling.stage('mongo_indexes'):
+            ensure_indexes(db)
+            rebuild_subject_index(db)
+        write_subject_matcher(db)
+        bump_data_version()
+    except Exception as e:
+        print(e)
+    finally:
+        finish_sync_state(complete, state_path)
+        if own_client:
+            client.close()
+
+    return stats
+
+
+def sync_to_mongodb(folder_path: str = '../data/processed', state_path: str = None,
+                    batch_size: int = 1000, client: MongoClient = None) -> dict:
+    """
+        Applies only the changes between the processed dump and the MongoDB collection.
+
+        Instead of dropping and reloading the collection, the function compares every book of
+        the processed dump with a local sync state, a SQLite file holding the 'key' and
+        'revision' of every edition already written and the 'last_modified' watermark of the
+        last sync. Editions that are new, or that were modified after the watermark with a
+        different revision, are upserted. Editions of the state that are no longer in the
+        dump are deleted. All writes are sent as unordered bulk writes of 'batch_size'
+        operations, and the collection stays queryable during the whole sync.
+
+        Args:
+        - folder_path (str): The folder holding the processed 'booksX.parquet' files.
+        - state_path (str): The path of the SQLite sync state. Defaults to
+          '../data/sync_state.sqlite'.
+        - batch_size (int): The number of operations sent in each bulk write.
+        - client (MongoClient): An existing client, for example connected to a local mongod,
+          used instead of the Atlas cluster (optional). It is not closed.
+
+        Returns:
+        dict: The number of 'upserted', 'deleted' and 'unchanged' editions.
 
-        # print item result
-        print('%.5f' % itemScore, matchItem)
+        Note:
+        - Every batch is written to the collection, then its subject counts are applied to
+          the 'ol_subjects' collection, and only then is it recorded in the sync state, see
+          'write_sync_batch'. An interrupted sync can simply be run again: it first finishes
+          the subject counts of the interrupted batch, and writes again the books that were
+          not recorded.
+        - The indexes of 'ensure_indexes' are created if needed, and the subject counts of
+          the 'ol_subjects' collection are updated from the changed books only.
+        - When books were upserted or deleted, the fuzzy matcher of the subjects is saved
+          again, see 'write_subject_matcher', and the data version is bumped, which
+          invalidates the cached search results.
 
-        # keep track of maximum score
-        if itemScore > maxi:
-            maxi = itemScore
-            result = matchItem
+        Raises:
+        Any exceptions raised during the process (such as connection errors or bulk write
+        errors) are caught and printed, and the MongoDB client connection it created is
+        closed.
+    """
+    state = open_sync_state(state_path or SYNC_STATE_PATH)
+    state.execute('CREATE TEMP TABLE seen (key TEXT PRIMARY KEY) WITHOUT ROWID')
+    row = state.execute("SELECT value FROM meta WHERE name = 'watermark'").fetchone()
+    watermark = row[0] if row else ''
+    new_watermark = watermark
+    stats = {'upserted': 0, 'deleted': 0, 'unchanged': 0}
+
+    own_client = client is None
+    if own_client:
+        client = mongo_client()
+    try:
+        db = client['ol_database']
+        collection = db['ol_collection']
+        ensure_indexes(db)
+        # The subject counts of a batch of an interrupted sync. Its books are not recorded
+        # in the state, so they are written again below
+        if finish_sync_batch(db, state, batch_size):
+            state.commit()
+
+        def flush(changed):
+            documents = [to_document(r) for r in changed]
+            write_sync_batch(db, state, [d['key'] for d in documents], lambda: collection.bulk_write(
+                [ReplaceOne({'key': d['key']}, d, upsert=True) for d in documents], ordered=False),
+                batch_size)
+            state.executemany('INSERT OR REPLACE INTO editions VALUES (?, ?, ?)',
+                              [(r['key'], r['revision'], r['last_modified']) for r in changed])
+            state.commit()
+            stats['upserted'] += len(changed)
+
+        from src.data_processing import iter_processed_records
+        changed = []
+        records = profiling.timed_iter('read_parquet', iter_processed_records(folder_path))
+        while True:
+            batch = [record for _, record in zip(range(batch_size), records)]
+            if not batch:
+                break
+            keys = [record['key'] for record in batch]
+            state.executemany('INSERT OR IGNORE INTO seen VALUES (?)', [(key,) for key in keys])
+            known = dict(state.execute(
+                'SELECT key, revision FROM editions WHERE key IN (%s)' % ','.join('?' * len(keys)),
+                keys))
+            for record in batch:
+                new_watermark = max(new_watermark, record['last_modified'])
+                if record['key'] not in known or (record['last_modified'] > watermark
+                                                  and record['revision'] != known[record['key']]):
+                    changed.append(record)
+                else:
+                    stats['unchanged'] += 1
+            if len(changed) >= batch_size:
+                with profiling.stage('mongo_upsert'):
+                    flush(changed)
+                changed = []
+        if changed:
+            with profiling.stage('mongo_upsert'):
+                flush(changed)
+        profiling.add('mongo_upsert', stats['upserted'])
+
+        # Editions of the previous sync that are not in the dump anymore
+        removed = [key for key, in state.execute(
+            'SELECT key FROM editions WHERE key NOT IN (SELECT key FROM seen)')]
+        for start in range(0, len(removed), batch_size):
+            keys = removed[start:start + batch_size]
+            write_sync_batch(db, state, keys, lambda: collection.bulk_write(
+                [DeleteMany({'key': {'$in': keys}})], ordered=False), batch_size)
+            state.executemany('DELETE FROM editions WHERE key = ?', [(key,) for key in keys])
+            state.commit()
+            stats['deleted'] += len(keys)
+        state.execute("INSERT OR REPLACE INTO meta VALUES ('watermark', ?)", (new_watermark,))
+        state.commit()
+    except Exception as e:
+        print(e)
+    finally:
+        # Books written before an error change the results too
+        if stats['upserted'] or stats['deleted']:
+            write_subject_matcher(client['ol_database'])
+            bump_data_version()
+        if own_client:
+            client.close()
+        state.close()
 
-    # award ceremony
-    print('result:', result, maxi)
-    return maxi, result
+    return stats
 
 
 def match_topic(subjects: str, topics: list) -> bool:
@@ -229,18 +684,23 @@ def match_topic(subjects: str, topics: list) -> bool:
     return False
 
 
-def read_from_mongodb(topics) -> list:
+def read_from_mongodb(topics, client: MongoClient = None) -> list:
     """
         Retrieves data from a MongoDB collection based on specified topics.
 
         The function establishes a connection with a MongoDB database hosted on MongoDB Atlas
         using credentials visible within the function ('ol_user' and its password). It creates
         a client, accesses the specified database ('ol_database'), and a collection
-        ('ol_collection'). Then, it retrieves all documents from the collection and filters
-        the data based on specified 'topics'.
+        ('ol_collection'). The topics are first matched as lower-cased substrings against
+        the distinct subjects of the 'ol_subjects' collection, through the index on their word
+        suffixes (see 'matching_subjects'). The books having any of the
+        matched subjects are then looked up through the multikey index on 'subjects', and
+        only their 'key' is transferred.
 
         Args:
         - topics (list): A list of topics to filter the MongoDB documents.
+        - client (MongoClient): An already connected client, for example the one kept open by
+          the query service, to skip the connection handshake (optional). It is not closed.
 
         Returns:
         list: A list containing keys from documents in the MongoDB collection that match the
@@ -250,38 +710,147 @@ def read_from_mongodb(topics) -> list:
         - The MongoDB connection string is created using visible credentials and the database URI.
         - The function uses 'topics' to filter documents based on 'subjects' in the collection.
         - If 'topics' match any 'subjects' in the documents, the 'key' of those documents is
-          appended to the result list.
+          appended to the result list. Each key appears once.
+        - As in 'match_topic', a topic matches a subject when it is contained in it, ignoring
+          case. A topic is matched against each subject separately, not against the
+          comma-joined string.
 
         Raises:
         Any exceptions raised during the retrieval process (such as connection errors or
         querying errors) are caught and printed. The function eventually closes the MongoDB
-        client connection.
+        client connection it created.
     """
 
     if not bool(len(topics)):
         return []
+    own_client = client is None
     # Establish connection with MongoDB
-    username = quote_plus('ol_user')
-    password = quote_plus('12345678ol_user')
-    uri = 'mongodb+srv://' + username + ':' + password + '@oldb.kcwnra7.mongodb.net/?retryWrites=true&w=majority'
-
-    # Create a new client and connect to the server
-    client = MongoClient(uri, server_api=ServerApi('1'))
+    if own_client:
+        client = mongo_client()
     result = []
 
     try:
         db = client['ol_database']
         my_collection = db['ol_collection']
 
-        all_data = my_collection.find()
-
-        if all_data:
-            for doc in all_data:
-                if match_topic(doc['subjects'], topics):
-                    result.append(doc['key'])
+        # Resolve the topics to the distinct subjects that contain them
+        with profiling.stage('mongo_subject_match'):
+            subjects = [doc['_id'] for doc in matching_subjects(db, topics)]
+        profiling.add('mongo_subject_match', len(subjects))
+
+        # Indexed lookup of the books having any of those subjects
+        seen = set()
+        with profiling.stage('mongo_key_lookup'):
+            for start in range(0, len(subjects), 1000):
+                cursor = my_collection.find({'subjects': {'$in': subjects[start:start + 1000]}},
+                                            {'key': 1, '_id': 0})
+                for doc in cursor:
+                    if doc['key'] not in seen:
+                        seen.add(doc['key'])
+                        result.append(doc['key'])
+        profiling.add('mongo_key_lookup', len(result))
     except Exception as e:
         print(e)
     finally:
-        client.close()
+        if own_client:
+            client.close()
 
     return result
+
+
+def read_ranked_from_mongodb(topics, limit: int = 20, offset: int = 0, client: MongoClient = None) -> list:
+    """
+        Retrieves a page of the keys of the books matching the topics, the best matches first.
+
+        The matching rules are those of 'read_from_mongodb'. Each matching book is scored by
+        the number of topics it matches, then by how specific its matching subjects are: for
+        every matched topic, the specificity of the rarest of its subjects containing the
+        topic is added, computed from the book counts of the 'ol_subjects' collection (see
+        'src.ranking.specificity'). Ties are ordered by key, as in
+        'src.inverted_index.InvertedIndex.rank_ids', so both backends return the same pages.
+
+        The subjects of every matching book are transferred and scored here, so the memory
+        used grows with the number of matching books: their keys and scores are all kept
+        until the page is selected with a bounded heap. Only the keys of the page are
+        returned, so only they need their details fetched.
+
+        Args:
+        - topics (list): A list of topics to filter the MongoDB documents.
+        - limit (int): The maximum number of keys returned, None for all of them.
+        - offset (int): The number of best matches skipped, to read the following pages.
+        - client (MongoClient): An already connected client (optional). It is not closed.
+
+        Returns:
+        list: The keys of the page, best first.
+
+        Raises:
+        Any exceptions raised during the retrieval are caught and printed, and an empty list
+        is returned. The MongoDB client connection it created is closed.
+    """
+    if not bool(len(topics)):
+        return []
+    own_client = client is None
+    if own_client:
+        client = mongo_client()
+    topics = list(dict.fromkeys(t.lower() for t in topics))
+
+    try:
+        db = client['ol_database']
+        my_collection = db['ol_collection']
+        total = my_collection.estimated_document_count()
+
+        with profiling.stage('mongo_subject_match'):
+            weights = {doc['_id']: specificity(doc.get('count', 0), total) for doc in
+                       matching_subjects(db, topics, {'count': 1})}
+        profiling.add('mongo_subject_match', len(weights))
+
+        # The subjects of the books are transferred to score them against each topic
+        subjects = list(weights)
+        scores = {}
+        with profiling.stage('mongo_key_lookup'):
+            for start in range(0, len(subjects), 1000):
+                cursor = my_collection.find({'subjects': {'$in': subjects[start:start + 1000]}},
+                                            {'key': 1, 'subjects': 1, '_id': 0})
+                for doc in cursor:
+                    if doc['key'] in scores:
+                        continue
+                    matched, score = 0, 0.0
+                    for topic in topics:
+                        best = max((weights[s] for s in doc['subjects'] if s in weights and topic in s),
+                                   default=None)
+                        if best is not None:
+                            matched += 1
+                            score += best
+                    scores[doc['key']] = (matched, score)
+        profiling.add('mongo_key_lookup', len(scores))
+        return [key for key, _ in top_matches(scores, limit, offset)]
+    except Exception as e:
+        print(e)
+        return []
+    finally:
+        if own_client:
+            client.close()
+
+
+def read_subject_vocabulary(client: MongoClient = None) -> list:
+    """
+        Returns the distinct normalized subjects of the 'ol_subjects' collection.
+
+        Args:
+        - client (MongoClient): An already connected client (optional). It is not closed.
+
+        Raises:
+        Any exceptions raised during the retrieval are caught and printed, and an empty list
+        is returned. The MongoDB client connection it created is closed.
+    """
+    own_client = client is None
+    if own_client:
+        client = mongo_client()
+    try:
+        return [doc['_id'] for doc in client['ol_database']['ol_subjects'].find({}, {'_id': 1})]
+    except Exception as e:
+        print(e)
+        return []
+    finally:
+        if own_client:
+            client.close()
@@ -1,42 +1,202 @@
+import glob
+import hashlib
+import json
 import os
+import shutil
 import subprocess
+import time
+import zlib
 import requests
 from concurrent.futures import ThreadPoolExecutor
+from src import profiling
 
 
-def ol_download_dumb_files(url: str, unprocessed_path: str):
+def download_range(url: str, part_path: str, start: int = 0, end: int = None,
+                   chunk_size: int = 2 ** 20, retries: int = 5, validator: str = None):
+    """
+        Streams the bytes 'start'..'end' of a URL to 'part_path', resuming where it left off.
+
+        If 'part_path' already holds some bytes, only the remaining ones are requested with an
+        HTTP Range header and appended to the file. Dropped connections and timeouts are
+        retried with exponential backoff, each retry resuming from the bytes already on disk.
+        With 'validator', the resumed requests carry an If-Range header, so a server whose
+        file changed sends the whole new file instead of appending its bytes to the old ones.
+
+        Args:
+        - url (str): The URL of the file.
+        - part_path (str): The file where the bytes are written.
+        - start (int): The first byte to download.
+        - end (int): The last byte to download (inclusive), or None to download until the end.
+        - chunk_size (int): The size in bytes of the chunks written to disk.
+        - retries (int): The number of times a failed connection is retried.
+        - validator (str): The ETag or Last-Modified date of the file the bytes on disk come
+          from (optional).
+
+        Raises:
+        - requests.RequestException: If the server answers with an error status code, if the
+          file changed while downloading a segment, or if the connection still fails after
+          'retries' attempts.
+    """
+    for attempt in range(retries + 1):
+        done = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if end is not None and start + done > end:
+            return
+        headers = {}
+        if start + done > 0 or end is not None:
+            headers['Range'] = f"bytes={start + done}-{'' if end is None else end}"
+            if done and validator:
+                headers['If-Range'] = validator
+        try:
+            with requests.get(url, headers=headers, stream=True, timeout=60) as response:
+                if response.status_code == 416 and end is None:
+                    # Nothing left to download
+                    return
+                response.raise_for_status()
+                if response.status_code == 206:
+                    mode = 'ab'
+                elif start == 0 and end is None:
+                    # The server ignored the Range header, or the file changed since the
+                    # bytes on disk were written, and sent the whole file
+                    mode = 'wb'
+                else:
+                    raise requests.RequestException(f"{url} changed or does not support range requests")
+                with open(part_path, mode) as part_file:
+                    for chunk in response.iter_content(chunk_size):
+                        part_file.write(chunk)
+            if end is None or os.path.getsize(part_path) == end - start + 1:
+                return
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError):
+            if attempt == retries:
+                raise
+        time.sleep(min(2 ** attempt, 30))
+    raise requests.RequestException(f"Incomplete download from {url}")
+
+
+def file_md5(path: str, chunk_size: int = 2 ** 20) -> str:
+    """
+        Returns the hexadecimal MD5 checksum of a file, reading it in chunks.
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def reuse_parts(part_path: str, identity: dict) -> bool:
+    """
+        Keeps the partial files of an earlier download only if they come from the same file.
+
+        'identity' describes the download (URL, size, ETag, Last-Modified and number of
+        segments) and is stored in '<part_path>.json' next to the parts. When the stored one
+        differs, or is missing, the parts ('<part_path>' and '<part_path>N') are deleted:
+        resuming them would splice bytes of another file, or of other segment bounds, into
+        the download.
+
+        Returns:
+        bool: True if the existing parts are kept.
+    """
+    identity_path = part_path + '.json'
+    try:
+        with open(identity_path, 'r', encoding='utf-8') as identity_file:
+            kept = json.load(identity_file) == identity
+    except (FileNotFoundError, ValueError):
+        kept = False
+    if not kept:
+        for path in [part_path] + glob.glob(glob.escape(part_path) + '[0-9]*'):
+            if os.path.exists(path):
+                os.remove(path)
+        with open(identity_path, 'w', encoding='utf-8') as identity_file:
+            json.dump(identity, identity_file)
+    return kept
+
+
+def ol_download_dumb_files(url: str, unprocessed_path: str, segments: int = 1,
+                           expected_size: int = None, expected_md5: str = None,
+                           chunk_size: int = 2 ** 20, retries: int = 5) -> bool:
     """
         Downloads a file from a given URL and saves it to the specified destination path.
 
         Args:
         - url (str): The URL from which to download the file.
         - unprocessed_path (str): The path where the downloaded file will be saved.
+        - segments (int): The number of byte ranges of the file fetched in parallel. Only
+          used when the server reports the file size and accepts range requests.
+        - expected_size (int): The expected size in bytes. Defaults to the Content-Length
+          reported by the server.
+        - expected_md5 (str): The expected hexadecimal MD5 checksum (optional).
+        - chunk_size (int): The size in bytes of the chunks written to disk.
+        - retries (int): The number of times a dropped connection is resumed.
 
         Returns:
-        None. The function saves the downloaded file to the specified path.
-
-        Raises:
-        - requests.RequestException: If there is an issue during the GET request.
+        bool: True if the file was downloaded and verified, False otherwise.
 
-        The function performs a GET request to download a file from the specified URL.
-        If the download is successful (status code 200), it saves the file to the specified path.
-        If there is an error during the download, it prints an error message along with the
-        status code (if available) or the encountered exception.
+        The response is streamed to '<unprocessed_path>.part' in chunks, so the file is never
+        held in memory. If a previous run was interrupted, the download resumes from the bytes
+        already on disk using HTTP Range requests. With several segments, each one is streamed
+        to its own '.partN' file by a thread, and the parts are joined once all of them are
+        complete. Parts left by a download of another file or with another number of
+        segments are discarded first, see 'reuse_parts', and resumed requests are sent with
+        If-Range. The size and checksum are verified before the file is moved to
+        'unprocessed_path'. If there is an error during the download or the verification, it
+        prints an error message and the partial data is kept (or removed if corrupted).
     """
+    part_path = unprocessed_path + '.part'
     try:
-        # Perform GET request to download the file
-        response = requests.get(url)
-        if response.status_code == 200:
-            with open(unprocessed_path, 'wb') as archivo_destino:
-                archivo_destino.write(response.content)
-                print(f"File downloaded: {unprocessed_path}")
+        head = requests.head(url, allow_redirects=True, timeout=60)
+        head.raise_for_status()
+        url = head.url
+        if expected_size is None and 'Content-Length' in head.headers:
+            expected_size = int(head.headers['Content-Length'])
+        accepts_ranges = head.headers.get('Accept-Ranges') == 'bytes'
+        segmented = segments > 1 and expected_size and accepts_ranges
+        etag = head.headers.get('ETag')
+        last_modified = head.headers.get('Last-Modified')
+        reuse_parts(part_path, {'url': url, 'size': expected_size, 'etag': etag,
+                                'last_modified': last_modified, 'segments': segments if segmented else 1})
+        # weak ETags cannot be used in If-Range
+        validator = etag if etag and not etag.startswith('W/') else last_modified
+
+        if segmented:
+            bounds = [expected_size * i // segments for i in range(segments + 1)]
+            segment_paths = [f"{part_path}{i}" for i in range(segments)]
+            with ThreadPoolExecutor(max_workers=segments) as executor:
+                # list() re-raises the first error of any segment
+                list(executor.map(download_range, [url] * segments, segment_paths,
+                                  bounds[:-1], [b - 1 for b in bounds[1:]],
+                                  [chunk_size] * segments, [retries] * segments,
+                                  [validator] * segments))
+            with open(part_path, 'wb') as part_file:
+                for segment_path in segment_paths:
+                    with open(segment_path, 'rb') as segment_file:
+                        shutil.copyfileobj(segment_file, part_file, chunk_size)
+                    os.remove(segment_path)
         else:
-            print(f"Error downloading from {url}. Error code: {response.status_code}")
+            download_range(url, part_path, chunk_size=chunk_size, retries=retries, validator=validator)
     except requests.RequestException as e:
         print(f"Error downloading from {url}: {e}")
+        return False
 
+    size = os.path.getsize(part_path)
+    if expected_size is not None and size != expected_size:
+        print(f"Error downloading from {url}: expected {expected_size} bytes, got {size}")
+        if size > expected_size:
+            os.remove(part_path)
+        return False
+    if expected_md5 is not None and file_md5(part_path, chunk_size) != expected_md5.lower():
+        print(f"Error downloading from {url}: checksum mismatch")
+        os.remove(part_path)
+        return False
 
-def thread_download():
+    os.replace(part_path, unprocessed_path)
+    os.remove(part_path + '.json')
+    profiling.add('download', 1, size)
+    print(f"File downloaded: {unprocessed_path}")
+    return True
+
+
+def thread_download(segments: int = 1, include_works: bool = False):
     """
         Downloads files from specified URLs concurrently using ThreadPoolExecutor.
 
@@ -51,13 +211,22 @@ def thread_download():
         downloaded gzip file in 'unprocessed_paths' using the 'gzip' command-line utility.
         It subsequently removes the original compressed files after successful decompression.
 
+        Args:
+        - segments (int): The number of byte ranges of each file fetched in parallel.
+        - include_works (bool): Also download the works dump, used to resolve book details
+          locally (see 'src.works_dump').
+
         Note:
         - The 'urls' list contains the URLs of the files to be downloaded.
         - The 'unprocessed_paths' list contains the destination paths where downloaded
           files will be saved.
+        - Files that could not be downloaded or verified are not decompressed. Running the
+          function again resumes their download.
+        - Each file is decompressed to a '.tmp' file renamed once gzip succeeds. If gzip
+          fails, the archive is kept and the previous uncompressed dump is left unchanged.
 
         Returns:
-        None. The function performs downloads and decompression in place.
+        bool: True if every file was downloaded and decompressed.
     """
     urls = [
         'https://openlibrary.org/data/ol_dump_editions_latest.txt.gz'
@@ -65,15 +234,141 @@ def thread_download():
     unprocessed_paths = [
         '../data/unprocessed/ol_dump_editions.txt.gz'
     ]
+    if include_works:
+        urls.append('https://openlibrary.org/data/ol_dump_works_latest.txt.gz')
+        unprocessed_paths.append('../data/unprocessed/ol_dump_works.txt.gz')
 
-    with ThreadPoolExecutor(max_workers=5) as executor:
+    with profiling.stage('download'), ThreadPoolExecutor(max_workers=5) as executor:
         # Use executor.map to execute downloads in parallel
-        executor.map(ol_download_dumb_files, urls, unprocessed_paths)
+        downloaded = list(executor.map(ol_download_dumb_files, urls, unprocessed_paths,
+                                       [segments] * len(urls)))
 
     # Run the gzip command to decompress the files
-    for f_path in unprocessed_paths:
-        decompression_command = f"gzip -d -c  {f_path} > {f_path.replace('.gz', '', 1)}"
-        subprocess.run(decompression_command, shell=True)
+    complete = all(downloaded)
+    for f_path, ok in zip(unprocessed_paths, downloaded):
+        if not ok:
+            continue
+        txt_path = f_path.replace('.gz', '', 1)
+        decompression_command = f"gzip -d -c  {f_path} > {txt_path}.tmp"
+        with profiling.stage('gunzip'):
+            result = subprocess.run(decompression_command, shell=True)
+        if result.returncode != 0:
+            # Keep the archive, so it can be checked or downloaded again
+            print(f"Error decompressing {f_path}: gzip exited with status {result.returncode}")
+            os.remove(txt_path + '.tmp')
+            complete = False
+            continue
+        os.replace(txt_path + '.tmp', txt_path)
+        profiling.add('gunzip', 1, os.path.getsize(txt_path))
 
         # Delete the archive after unzipping
         os.remove(f_path)
+    return complete
+
+
+def gunzip_chunks(chunks):
+    """
+        Decompresses an iterable of gzip compressed byte chunks incrementally.
+
+        Args:
+        - chunks (iterable): An iterable of bytes objects holding a gzip stream.
+
+        Yields:
+        bytes: Decompressed data, as soon as it is available. Only one compressed chunk is
+        held in memory at a time. Concatenated gzip members are supported.
+
+        Raises:
+        - EOFError: If the stream ends before the end of its last gzip member, for example
+          a download cut short, so a truncated dump is never taken for a complete one.
+        - zlib.error: If the stream is not valid gzip data.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    # whether the current member received any input, an empty stream being valid
+    started = False
+    for chunk in chunks:
+        while chunk:
+            started = True
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            if not decompressor.eof:
+                break
+            # a new gzip member starts after the end of the current one
+            chunk = decompressor.unused_data
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            started = False
+    data = decompressor.flush()
+    if data:
+        yield data
+    if started and not decompressor.eof:
+        raise EOFError('Compressed dump ended before the end-of-stream marker was reached')
+
+
+def split_lines(chunks):
+    """
+        Splits an iterable of byte chunks into decoded text lines.
+
+        Args:
+        - chunks (iterable): An iterable of bytes objects.
+
+        Yields:
+        str: Each line decoded as UTF-8, including its trailing newline.
+    """
+    pending = b''
+    for chunk in chunks:
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8') + '\n'
+    if pending:
+        yield pending.decode('utf-8')
+
+
+def stream_dump_lines(url: str = 'https://openlibrary.org/data/ol_dump_editions_latest.txt.gz',
+                      chunk_size: int = 2 ** 20):
+    """
+        Streams a gzip compressed dump from a URL and yields its uncompressed lines.
+
+        The HTTP body is read in chunks of 'chunk_size' bytes and decompressed on the fly,
+        so neither the compressed download nor the uncompressed dump is stored on disk or
+        held in memory.
+
+        Args:
+        - url (str): The URL of the '.txt.gz' dump.
+        - chunk_size (int): The size in bytes of the chunks read from the response.
+
+        Yields:
+        str: The lines of the uncompressed dump.
+
+        Raises:
+        - requests.RequestException: If the request fails or returns an error status code.
+        - EOFError: If the dump ends before the end of its gzip stream, see 'gunzip_chunks'.
+    """
+    with requests.get(url, stream=True) as response:
+        response.raise_for_status()
+        chunks = profiling.timed_iter('download', response.iter_content(chunk_size), size=len)
+        chunks = profiling.timed_iter('gunzip', gunzip_chunks(chunks), size=len)
+        yield from split_lines(chunks)
+
+
+def read_dump_lines(gz_path: str, chunk_size: int = 2 ** 20):
+    """
+        Yields the uncompressed lines of an already downloaded '.txt.gz' dump.
+
+        This is the offline counterpart of 'stream_dump_lines': the file is read in chunks
+        and decompressed with the same incremental decoder.
+
+        Args:
+        - gz_path (str): The path of the gzip compressed dump.
+        - chunk_size (int): The size in bytes of the chunks read from the file.
+
+        Yields:
+        str: The lines of the uncompressed dump.
+
+        Raises:
+        - EOFError: If the file is truncated, see 'gunzip_chunks'.
+    """
+    with open(gz_path, 'rb') as gz_file:
+        chunks = profiling.timed_iter('read', iter(lambda: gz_file.read(chunk_size), b''), size=len)
+        chunks = profiling.timed_iter('gunzip', gunzip_chunks(chunks), size=len)
+        yield from split_lines(chunks)
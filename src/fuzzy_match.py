@@ -0,0 +1,566 @@
+import heapq
+import mmap
+import os
+import shutil
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from difflib import SequenceMatcher
+from statistics import median, mean
+
+
+def getWords(input: str) -> list:
+    """
+        Extracts words from an input string based on specified criteria.
+
+        This function splits the input string into words and filters the words based
+        on certain criteria. It calculates the minimum word length depending on the
+        word count and the median length of words to exclude presumed fillers or short
+        words that may not be relevant.
+
+        Args:
+        - input (str): The input string to extract words from.
+
+        Returns:
+        list: A list containing words from the input string that meet the minimum length
+        criteria calculated based on the word count and median length of words.
+
+        Note:
+        - The function determines the minimum word length dynamically based on word count
+          and the median length of words in the input string.
+        - It filters out words shorter than the calculated minimum length.
+
+        Example:
+        getWords("This is a test sentence with some words")
+        # This will extract words longer than the dynamically determined minimum length
+        # based on the word count and median length of words in the input string.
+    """
+    words = input.split()
+    lengths = [len(x) for x in words if len(x) > 1]
+
+    # set the minimum word length based on word count
+    # and median of word length to remove presumed fillers
+    minLength = 2
+    if len(words) >= 3 and median(lengths) > 4:
+        minLength = 5
+    elif len(words) >= 2 and median(lengths) > 3:
+        minLength = 4
+
+    # keep words of minimum length
+    answer = list()
+    for item in words:
+        if len(item) >= minLength:
+            answer.append(item)
+
+    return answer
+
+
+def string_score(user_input: str, match_item: str) -> float:
+    """
+        Scores the similarity between the user input and one string, from 0 to 1.
+
+        The score is the SequenceMatcher ratio of the full strings multiplied by the mean,
+        over the words of the user input, of the best ratio with a word of 'match_item'.
+    """
+    # ratio of the original item comparison
+    fullRatio = SequenceMatcher(None, user_input, match_item).ratio()
+    return fullRatio * word_score(user_input, match_item)
+
+
+def word_score(user_input: str, match_item: str) -> float:
+    """
+        Returns the mean, over the words of the user input, of the best SequenceMatcher ratio
+        with a word of 'match_item', the second factor of 'string_score'.
+    """
+    # every word of the user input will be compared
+    # to each word of the list item, the maximum score
+    # for each user word will be kept
+    wordResults = list()
+    matchWords = getWords(match_item)
+    for userWord in getWords(user_input):
+        maxWordRatio = 0
+        for matchWord in matchWords:
+            wordRatio = SequenceMatcher(None, userWord, matchWord).ratio()
+            if wordRatio > maxWordRatio:
+                maxWordRatio = wordRatio
+        wordResults.append(maxWordRatio)
+
+    # the total score for each list item is the full ratio
+    # multiplied by the mean of all single word scores
+    return mean(wordResults) if wordResults else 0.0
+
+
+def string_matching(match_list: list, user_input: str) -> tuple:
+    """
+        Finds the best match between user input and a list of strings.
+
+        This function compares the user input string with a list of strings (matchList)
+        to find the best match based on similarity scores. It calculates the similarity
+        scores using the SequenceMatcher from difflib library.
+
+        Args:
+        - match_list (list): A list of strings to be compared with the user input.
+        - user_input (str): The input string provided by the user for comparison.
+
+        Returns:
+        tuple: A tuple containing the maximum similarity score and the string from
+        matchList that has the best match with the user input.
+
+        Note:
+        - The function uses difflib's SequenceMatcher to calculate similarity scores
+          between strings.
+        - It compares the user input string with each string in matchList and calculates
+          a score based on full string comparison and word-level comparisons.
+        - The string with the highest score is considered the best match and returned
+          along with its score.
+
+        Example:
+        string_matching(['apple', 'orange', 'banana'], 'apples')
+        # This will compare 'apples' with 'apple', 'orange', and 'banana' and return
+        # the maximum similarity score and the best-matching string from the list.
+    """
+
+    # find the best match between the user input and the link list
+    maxi = 0
+    result = ''
+    for matchItem in match_list:
+
+        itemScore = string_score(user_input, matchItem)
+
+        # print item result
+        print('%.5f' % itemScore, matchItem)
+
+        # keep track of maximum score
+        if itemScore > maxi:
+            maxi = itemScore
+            result = matchItem
+
+    # award ceremony
+    print('result:', result, maxi)
+    return maxi, result
+
+
+# The matcher of the 'ol_subjects' collection, see 'SubjectMatcher.save'. The matcher of the
+# local inverted index is saved in its 'matcher' folder
+MATCHER_PATH = '../data/subject_matcher'
+
+
+def trigrams(text: str) -> set:
+    """
+        Returns the character trigrams of a string, padded with spaces so that the first and
+        last letters of each word are part of their own trigrams.
+    """
+    padded = ' ' + ' '.join(text.split()) + ' '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def bounded_edit_distance(a: str, b: str, limit: int) -> int:
+    """
+        Returns the Levenshtein distance between 'a' and 'b', or 'limit' + 1 as soon as it is
+        known to be larger than 'limit'. Only a band of width 2 * 'limit' + 1 around the
+        diagonal of the distance matrix is computed.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    if len(a) > len(b):
+        a, b = b, a
+    out = limit + 1
+    previous = [j if j <= limit else out for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        current = [out] * (len(b) + 1)
+        if i <= limit:
+            current[0] = i
+        low, high = max(1, i - limit), min(len(b), i + limit)
+        char = a[i - 1]
+        for j in range(low, high + 1):
+            cost = previous[j - 1] + (char != b[j - 1])
+            if previous[j] + 1 < cost:
+                cost = previous[j] + 1
+            if current[j - 1] + 1 < cost:
+                cost = current[j - 1] + 1
+            current[j] = cost if cost <= limit else out
+        if min(current[low - 1:high + 1]) > limit:
+            return out
+        previous = current
+    return previous[len(b)]
+
+
+class SubjectMatcher:
+    """
+        Approximate matching of topics against a vocabulary of distinct subjects.
+
+        Comparing a topic with every subject through 'string_matching' is far too slow for a
+        large vocabulary, and so is a trigram index of whole subjects: subjects share common
+        words such as 'history', so every query would count millions of postings. This
+        matcher indexes the distinct words of the vocabulary instead (trigram -> word ids,
+        and word -> ids of the subjects having it) and answers a query in four steps:
+        - Words: for every word of the topic, the words of the vocabulary sharing at least
+          'min_overlap' of its trigrams and within a third of its length in edits.
+        - Candidates: the subjects having a close word for every word of the topic,
+          intersected starting from the most selective word. A subject much longer or
+          shorter than the topic cannot score above 'min_score', since the score is at most
+          2 * min(len(topic), len(subject)) / (len(topic) + len(subject)). The subjects are
+          numbered by length, so the lengths allowed by that bound are a range of ids, cut
+          out of the posting lists by bisection. The candidates are ordered by the bound,
+          and only the first 'max_candidates' are kept.
+        - Filter: the candidates having a run of words within 'max_distance' edits of the
+          topic (bounded Levenshtein distance), so misspelled topics still match.
+        - Ranking: the remaining candidates are scored with 'string_score', the scoring of
+          'string_matching', and those above 'min_score' are returned best first. The full
+          ratio of the score is computed first, after its cheaper 'quick_ratio' bound, and
+          the words are only compared when it can still beat the matches found. The scan
+          stops once no remaining candidate can.
+
+        Args:
+        - vocabulary (iterable): The distinct normalized subjects.
+        - min_overlap (float): The minimum share of the trigrams of a topic word a close word
+          must have.
+        - max_distance (int): The maximum number of edits, by default a third of the topic
+          length.
+        - min_score (float): The minimum 'string_score' of a match.
+        - max_candidates (int): The maximum number of subjects compared with each topic.
+
+        Building the indexes of a large vocabulary takes about a second, so they are saved
+        with 'save' when the data is updated, and opened with 'load', which memory-maps them.
+
+        Example:
+        matcher = SubjectMatcher(['science fiction', 'history', 'fiction in english'])
+        matcher.match('sciense fiction')
+        # [('science fiction', 0.87...)]
+    """
+
+    def __init__(self, vocabulary, min_overlap: float = 0.4, max_distance: int = None,
+                 min_score: float = 0.5, max_candidates: int = 2000):
+        self._files = []
+        self._maps = []
+        self._views = []
+        self.vocabulary = sorted(vocabulary, key=len)
+        # The id of the first subject of every length
+        self.length_starts = array('Q')
+        for subject_id, subject in enumerate(self.vocabulary):
+            while len(self.length_starts) <= len(subject):
+                self.length_starts.append(subject_id)
+        self.length_starts.append(len(self.vocabulary))
+        self.min_overlap = min_overlap
+        self.max_distance = max_distance
+        self.min_score = min_score
+        self.max_candidates = max_candidates
+        self.words = []
+        word_ids = {}
+        # The words of every subject, flattened, and the subjects of every word
+        self.subject_words = array('I')
+        self.subject_offsets = array('Q', [0])
+        self.postings = []
+        for subject_id, subject in enumerate(self.vocabulary):
+            for word in dict.fromkeys(subject.split()):
+                word_id = word_ids.get(word)
+                if word_id is None:
+                    word_id = word_ids[word] = len(self.words)
+                    self.words.append(word)
+                    self.postings.append(array('I'))
+                self.postings[word_id].append(subject_id)
+                self.subject_words.append(word_id)
+            self.subject_offsets.append(len(self.subject_words))
+        self.index = {}
+        for word_id, word in enumerate(self.words):
+            for trigram in trigrams(word):
+                ids = self.index.get(trigram)
+                if ids is None:
+                    self.index[trigram] = ids = array('I')
+                ids.append(word_id)
+
+    def save(self, path: str):
+        """
+            Writes the vocabulary and the indexes of the matcher to the folder 'path', to be
+            opened by 'load'. The folder holds the following files:
+            - 'subjects.txt' / 'subjects.idx': the subjects ordered by length, one per line,
+              and the byte offset of every line (uint64) plus the size of the file.
+            - 'words.txt' / 'words.idx': the distinct words of the subjects, the same way.
+            - 'lengths.idx': the id of the first subject of every length (uint64).
+            - 'subject_words.bin' / 'subject_words.idx': the word ids of every subject (uint32)
+              and the position of the words of every subject (uint64), plus their number.
+            - 'word_subjects.bin' / 'word_subjects.idx': the sorted subject ids of every word,
+              the same way.
+            - 'trigrams.txt' / 'trigrams.idx': the sorted trigrams of the words, as the
+              subjects.
+            - 'trigram_words.bin' / 'trigram_words.idx': the word ids of every trigram.
+
+            Note:
+            - The files are written to a '.building' folder, which then replaces 'path' with a
+              rename, as in 'src.inverted_index.build_inverted_index'. A matcher opened before
+              keeps reading the previous files through its memory maps.
+        """
+        building = path.rstrip('/\\') + '.building'
+        previous = path.rstrip('/\\') + '.previous'
+        shutil.rmtree(building, ignore_errors=True)
+        os.makedirs(building)
+        try:
+            _write_lines(os.path.join(building, 'subjects'), self.vocabulary)
+            _write_lines(os.path.join(building, 'words'), self.words)
+            with open(os.path.join(building, 'lengths.idx'), 'wb') as lengths_file:
+                array('Q', self.length_starts).tofile(lengths_file)
+            with open(os.path.join(building, 'subject_words.bin'), 'wb') as words_file:
+                array('I', self.subject_words).tofile(words_file)
+            with open(os.path.join(building, 'subject_words.idx'), 'wb') as offsets_file:
+                array('Q', self.subject_offsets).tofile(offsets_file)
+            _write_lists(os.path.join(building, 'word_subjects'), self.postings)
+            grams = sorted(self.index)
+            _write_lines(os.path.join(building, 'trigrams'), grams)
+            _write_lists(os.path.join(building, 'trigram_words'), (self.index[gram] for gram in grams))
+        except BaseException:
+            shutil.rmtree(building, ignore_errors=True)
+            raise
+        shutil.rmtree(previous, ignore_errors=True)
+        if os.path.exists(path):
+            os.rename(path, previous)
+        os.rename(building, path)
+        shutil.rmtree(previous, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path: str, min_overlap: float = 0.4, max_distance: int = None,
+             min_score: float = 0.5, max_candidates: int = 2000) -> 'SubjectMatcher':
+        """
+            Opens a matcher written by 'save'. Its files are memory-mapped, so opening it
+            costs the same whatever the size of the vocabulary, and a query only reads the
+            pages of the trigrams, words and subjects it touches. The other arguments are those
+            of the constructor.
+
+            Raises:
+            FileNotFoundError: If the folder does not hold a saved matcher.
+        """
+        matcher = cls.__new__(cls)
+        matcher._files = []
+        matcher._maps = []
+        matcher._views = []
+        matcher.min_overlap = min_overlap
+        matcher.max_distance = max_distance
+        matcher.min_score = min_score
+        matcher.max_candidates = max_candidates
+        try:
+            matcher.vocabulary = matcher._lines(os.path.join(path, 'subjects'))
+            matcher.words = matcher._lines(os.path.join(path, 'words'))
+            matcher.length_starts = matcher._view(os.path.join(path, 'lengths.idx'), 'Q')
+            matcher.subject_words = matcher._view(os.path.join(path, 'subject_words.bin'), 'I')
+            matcher.subject_offsets = matcher._view(os.path.join(path, 'subject_words.idx'), 'Q')
+            matcher.postings = matcher._lists(os.path.join(path, 'word_subjects'))
+            matcher.index = _SortedLookup(matcher._lines(os.path.join(path, 'trigrams')),
+                                          matcher._lists(os.path.join(path, 'trigram_words')))
+        except BaseException:
+            matcher.close()
+            raise
+        return matcher
+
+    def _view(self, path: str, typecode: str) -> memoryview:
+        f = open(path, 'rb')
+        self._files.append(f)
+        if os.fstat(f.fileno()).st_size == 0:
+            view = memoryview(array(typecode))
+        else:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps.append(mapped)
+            view = memoryview(mapped).cast(typecode)
+        self._views.append(view)
+        return view
+
+    def _lines(self, path: str):
+        return _Lines(self._view(path + '.txt', 'B'), self._view(path + '.idx', 'Q'))
+
+    def _lists(self, path: str):
+        return _Lists(self._view(path + '.bin', 'I'), self._view(path + '.idx', 'Q'))
+
+    def close(self):
+        """
+            Releases the files of a matcher opened by 'load'. Nothing to do for a built one.
+        """
+        for view in self._views:
+            view.release()
+        for mapped in self._maps:
+            mapped.close()
+        for f in self._files:
+            f.close()
+
+    def close_words(self, word: str) -> set:
+        """
+            Returns the ids of the words of the vocabulary close to 'word'.
+        """
+        limit = max(1, (len(word) + 1) // 3)
+        word_trigrams = trigrams(word)
+        needed = max(1, int(len(word_trigrams) * self.min_overlap))
+        counts = Counter()
+        for trigram in word_trigrams:
+            counts.update(self.index.get(trigram, ()))
+        return {word_id for word_id, count in counts.items()
+                if count >= needed and bounded_edit_distance(word, self.words[word_id], limit) <= limit}
+
+    def score_bound(self, topic: str, subject_id: int) -> float:
+        """
+            Returns the highest 'string_score' the subject can have for the topic, from the
+            lengths of both.
+        """
+        # The subjects are numbered by length, so its length is found without reading it
+        a, b = len(topic), bisect_right(self.length_starts, subject_id) - 1
+        return 2 * min(a, b) / (a + b)
+
+    def id_range(self, topic: str) -> tuple:
+        """
+            Returns the range of the ids of the subjects whose length allows a score above
+            'min_score'.
+        """
+        a = len(topic)
+        lengths = [b for b in range(len(self.length_starts) - 1) if 2 * min(a, b) / (a + b) > self.min_score]
+        if not lengths:
+            return 0, 0
+        return self.length_starts[lengths[0]], self.length_starts[lengths[-1] + 1]
+
+    def candidates(self, topic: str) -> list:
+        """
+            Returns the ids of the subjects having a word close to every word of the topic,
+            the most promising first.
+        """
+        close = [self.close_words(word) for word in topic.split()]
+        if not close or not all(close):
+            return []
+        low, high = self.id_range(topic)
+
+        def window(word_id):
+            postings = self.postings[word_id]
+            return postings[bisect_left(postings, low):bisect_left(postings, high)]
+
+        close.sort(key=lambda word_ids: sum(len(self.postings[word_id]) for word_id in word_ids))
+        subject_ids = set()
+        for word_id in close[0]:
+            subject_ids.update(window(word_id))
+        words, offsets = self.subject_words, self.subject_offsets
+        for word_ids in close[1:]:
+            subject_ids = {subject_id for subject_id in subject_ids
+                           if not word_ids.isdisjoint(words[offsets[subject_id]:offsets[subject_id + 1]])}
+        return sorted(subject_ids, key=lambda subject_id: (-self.score_bound(topic, subject_id),
+                                                           subject_id))[:self.max_candidates]
+
+    def close_enough(self, topic: str, subject: str, limit: int) -> bool:
+        """
+            Tells whether a run of words of the subject, with as many words as the topic, is
+            within 'limit' edits of the topic.
+        """
+        words = subject.split()
+        size = len(topic.split())
+        for start in range(max(1, len(words) - size + 1)):
+            if bounded_edit_distance(topic, ' '.join(words[start:start + size]), limit) <= limit:
+                return True
+        return False
+
+    def match(self, topic: str, limit: int = 10) -> list:
+        """
+            Returns up to 'limit' (subject, score) pairs close to the topic, best first.
+        """
+        topic = ' '.join(topic.lower().split())
+        if not topic:
+            return []
+        distance = self.max_distance if self.max_distance is not None else max(1, len(topic) // 3)
+        matches = []
+        for subject_id in self.candidates(topic):
+            # The score is at most its full ratio, itself at most its quick ratio and the
+            # length bound, so a candidate is skipped as soon as it cannot enter the
+            # 'limit' best matches. The candidates come by decreasing length bound, so none
+            # of the next ones can either.
+            needed = matches[0][0] if len(matches) >= limit else self.min_score
+            if self.score_bound(topic, subject_id) <= needed:
+                break
+            subject = self.vocabulary[subject_id]
+            sequence = SequenceMatcher(None, topic, subject)
+            if sequence.quick_ratio() <= needed or not self.close_enough(topic, subject, distance):
+                continue
+            full_ratio = sequence.ratio()
+            if full_ratio > needed:
+                score = full_ratio * word_score(topic, subject)
+                if score > needed:
+                    heapq.heappush(matches, (score, -subject_id, subject))
+                    if len(matches) > limit:
+                        heapq.heappop(matches)
+        return [(subject, score) for score, _, subject in sorted(matches, reverse=True)]
+
+    def expand(self, topics: list, limit: int = 10) -> list:
+        """
+            Returns the topics followed by the subjects that approximately match them, without
+            duplicates. The result can be searched like the original topics.
+        """
+        expanded = dict.fromkeys(t.lower() for t in topics)
+        for t in topics:
+            expanded.update(dict.fromkeys(subject for subject, _ in self.match(t, limit)))
+        return list(expanded)
+
+
+def open_subject_matcher(path: str, read_vocabulary) -> SubjectMatcher:
+    """
+        Opens the matcher saved in 'path' by 'SubjectMatcher.save', or builds it from the
+        subjects returned by 'read_vocabulary' when the data was updated before matchers were
+        saved.
+    """
+    if os.path.exists(os.path.join(path, 'subjects.idx')):
+        return SubjectMatcher.load(path)
+    return SubjectMatcher(read_vocabulary())
+
+
+def _write_lines(path: str, lines):
+    # 'path'.txt holds the lines, 'path'.idx the byte offset of each of them and the file size
+    offsets = array('Q', [0])
+    with open(path + '.txt', 'wb') as lines_file:
+        for line in lines:
+            data = line.encode('utf-8') + b'\n'
+            lines_file.write(data)
+            offsets.append(offsets[-1] + len(data))
+    with open(path + '.idx', 'wb') as offsets_file:
+        offsets.tofile(offsets_file)
+
+
+def _write_lists(path: str, lists):
+    # 'path'.bin holds the integers of every list, 'path'.idx the position of each list in it
+    offsets = array('Q', [0])
+    with open(path + '.bin', 'wb') as values_file:
+        for values in lists:
+            array('I', values).tofile(values_file)
+            offsets.append(offsets[-1] + len(values))
+    with open(path + '.idx', 'wb') as offsets_file:
+        offsets.tofile(offsets_file)
+
+
+class _Lines:
+    # The lines of a file written by '_write_lines', read without loading the others
+
+    def __init__(self, data: memoryview, offsets: memoryview):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return str(self.data[self.offsets[i]:self.offsets[i + 1] - 1], 'utf-8')
+
+
+class _Lists:
+    # The lists of a file written by '_write_lists', each one a slice of the mapped integers
+
+    def __init__(self, values: memoryview, offsets: memoryview):
+        self.values = values
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> memoryview:
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+
+class _SortedLookup:
+    # A read-only mapping of sorted '_Lines' keys to '_Lists' values, found by bisection
+
+    def __init__(self, keys: _Lines, values: _Lists):
+        self.keys = keys
+        self.values = values
+
+    def get(self, key: str, default=None):
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.values[i]
+        return default
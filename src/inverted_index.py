@@ -0,0 +1,329 @@
+import heapq
+import mmap
+import os
+import shutil
+from array import array
+from itertools import accumulate
+from src import profiling
+from src.ranking import specificity, top_matches
+from src.result_cache import bump_data_version
+
+INDEX_PATH = '../data/index'
+
+
+def _int32_view(values) -> memoryview:
+    # zero-copy view of a pyarrow int32 array without nulls
+    return memoryview(values.buffers()[1]).cast('i')[values.offset:values.offset + len(values)]
+
+
+def build_inverted_index(folder_path: str = '../data/processed', index_path: str = INDEX_PATH) -> int:
+    """
+        Builds an on-disk inverted index (subject -> books) from the processed dump.
+
+        Every book of the processed files gets a document id, its position in the dump. The
+        index is made of the following files in 'index_path':
+        - 'keys.txt': the key of every book, one per line, in document id order.
+        - 'keys.idx': the byte offset of every line of 'keys.txt' (uint64), plus the size of
+          the file, so a key is read without loading the others.
+        - 'subjects.txt': the distinct normalized subjects, one per line. The line number of
+          a subject is its term id, the same as its id in the processed files.
+        - 'postings.idx': the position of the posting list of every term in
+          'postings.bin' (uint64, counted in integers), plus the total number of integers.
+        - 'postings.bin': the document ids of every term (uint32), sorted and delta encoded.
+        - 'matcher': the fuzzy matcher of the subjects, see 'src.fuzzy_match.SubjectMatcher.save',
+          so fuzzy searches open it instead of building it.
+
+        Args:
+        - folder_path (str): The folder holding the processed 'booksX' files.
+        - index_path (str): The folder where the index is written.
+
+        Returns:
+        int: The number of indexed books.
+
+        Note:
+        - The index is written to a '.building' folder next to 'index_path', which then
+          replaces 'index_path' with a rename. The files of the previous index are never
+          rewritten, so an index opened before the build keeps reading them safely through its
+          memory maps.
+        - The data version is bumped, which invalidates the cached search results and makes
+          the query service reopen the index.
+    """
+    building = index_path.rstrip('/\\') + '.building'
+    previous = index_path.rstrip('/\\') + '.previous'
+    shutil.rmtree(building, ignore_errors=True)
+    os.makedirs(building)
+    try:
+        books = _write_index(folder_path, building)
+    except BaseException:
+        shutil.rmtree(building, ignore_errors=True)
+        raise
+    shutil.rmtree(previous, ignore_errors=True)
+    if os.path.exists(index_path):
+        os.rename(index_path, previous)
+    os.rename(building, index_path)
+    # the files stay readable by the indexes that mapped them until they are closed
+    shutil.rmtree(previous, ignore_errors=True)
+    bump_data_version()
+    return books
+
+
+def _write_index(folder_path: str, index_path: str) -> int:
+    # pyarrow is only needed to build the index, not to search it
+    from src.data_processing import iter_processed_batches, read_subject_dictionary
+    subjects = read_subject_dictionary(folder_path)
+    postings = [None] * len(subjects)
+    doc_id = 0
+    offsets = array('Q')
+    with open(os.path.join(index_path, 'keys.txt'), 'wb') as keys_file, \
+            open(os.path.join(index_path, 'keys.idx'), 'wb') as keys_idx:
+        position = 0
+        # only the key and subject_ids columns are read from the processed files
+        batches = iter_processed_batches(folder_path, columns=['key', 'subject_ids'])
+        for batch in profiling.timed_iter('read_parquet', batches):
+            column = batch.column(1)
+            # read the int32 list offsets and subject ids straight from the Arrow buffers
+            bounds = _int32_view(column.offsets)
+            subject_ids = _int32_view(column.values)
+            for i, key in enumerate(batch.column(0).to_pylist()):
+                line = key.encode('utf-8') + b'\n'
+                keys_file.write(line)
+                offsets.append(position)
+                position += len(line)
+                for subject_id in subject_ids[bounds[i]:bounds[i + 1]]:
+                    ids = postings[subject_id]
+                    if ids is None:
+                        postings[subject_id] = ids = array('I')
+                    ids.append(doc_id)
+                doc_id += 1
+            offsets.tofile(keys_idx)
+            del offsets[:]
+        offsets.append(position)
+        offsets.tofile(keys_idx)
+
+    with open(os.path.join(index_path, 'subjects.txt'), 'w', encoding='utf-8') as subjects_file, \
+            open(os.path.join(index_path, 'postings.bin'), 'wb') as postings_file:
+        term_offsets = array('Q', [0])
+        for term_id, subject in enumerate(subjects):
+            ids = postings[term_id] or array('I')
+            postings[term_id] = None
+            # ids are appended in increasing order, store the gaps between them
+            deltas = array('I', ids[:1])
+            deltas.extend(b - a for a, b in zip(ids, ids[1:]))
+            deltas.tofile(postings_file)
+            term_offsets.append(term_offsets[-1] + len(deltas))
+            subjects_file.write(subject + '\n')
+    with open(os.path.join(index_path, 'postings.idx'), 'wb') as postings_idx:
+        term_offsets.tofile(postings_idx)
+    from src.fuzzy_match import SubjectMatcher
+    with profiling.stage('fuzzy_index'):
+        SubjectMatcher(subjects).save(os.path.join(index_path, 'matcher'))
+    return doc_id
+
+
+class InvertedIndex:
+    """
+        Read-only access to an index written by 'build_inverted_index'.
+
+        Only the subject vocabulary is loaded in memory. The keys and the posting lists are
+        memory-mapped, so opening the index costs the same whatever the number of books, and
+        a query only touches the pages of the posting lists it reads.
+
+        Example:
+        with InvertedIndex('../data/index') as index:
+            keys = index.search(['science', 'fantasy'])
+    """
+
+    def __init__(self, index_path: str = INDEX_PATH):
+        with open(os.path.join(index_path, 'subjects.txt'), 'r', encoding='utf-8') as subjects_file:
+            self.subjects = subjects_file.read().splitlines()
+        self._files = []
+        self._maps = []
+        self._views = []
+        self._keys = self._map(os.path.join(index_path, 'keys.txt'))
+        self._key_offsets = self._view(os.path.join(index_path, 'keys.idx'), 'Q')
+        self._term_offsets = self._view(os.path.join(index_path, 'postings.idx'), 'Q')
+        self._postings = self._view(os.path.join(index_path, 'postings.bin'), 'I')
+
+    def _map(self, path: str):
+        f = open(path, 'rb')
+        self._files.append(f)
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        return mapped
+
+    def _view(self, path: str, typecode: str) -> memoryview:
+        view = memoryview(self._map(path)).cast(typecode)
+        self._views.append(view)
+        return view
+
+    def __len__(self) -> int:
+        return len(self._key_offsets) - 1
+
+    def close(self):
+        for view in self._views:
+            view.release()
+        for mapped in self._maps:
+            mapped.close()
+        for f in self._files:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def key(self, doc_id: int) -> str:
+        """
+            Returns the book key of a document id.
+        """
+        return self._keys[self._key_offsets[doc_id]:self._key_offsets[doc_id + 1] - 1].decode('utf-8')
+
+    def matching_terms(self, topic: str) -> list:
+        """
+            Returns the term ids of the subjects that contain 'topic', ignoring case.
+        """
+        topic = topic.lower()
+        return [term_id for term_id, subject in enumerate(self.subjects) if topic in subject]
+
+    def postings(self, term_id: int):
+        """
+            Returns the sorted document ids of a term, decoding its delta encoded posting list.
+        """
+        start, end = self._term_offsets[term_id], self._term_offsets[term_id + 1]
+        return accumulate(self._postings[start:end])
+
+    def search_ids(self, topics: list):
+        """
+            Yields, in increasing order and without duplicates, the document ids of the books
+            having a subject that contains any of the topics.
+
+            The posting lists of all the matching subjects are merged as a union of sorted
+            lists.
+        """
+        term_ids = sorted({term_id for t in topics for term_id in self.matching_terms(t)})
+        last = -1
+        for doc_id in heapq.merge(*(self.postings(term_id) for term_id in term_ids)):
+            if doc_id != last:
+                last = doc_id
+                yield doc_id
+
+    def search(self, topics: list) -> list:
+        """
+            Returns the keys of the books having a subject that contains any of the topics.
+        """
+        return [self.key(doc_id) for doc_id in self.search_ids(topics)]
+
+    def document_frequency(self, term_id: int) -> int:
+        """
+            Returns the number of books having a subject, the length of its posting list.
+        """
+        return self._term_offsets[term_id + 1] - self._term_offsets[term_id]
+
+    def rank_ids(self, topics: list, limit: int = None, offset: int = 0) -> list:
+        """
+            Returns a page of the document ids matching the topics, best scored first.
+
+            A book scores (number of matched topics, specificity): for every topic it
+            matches, the specificity of the rarest of its subjects containing the topic is
+            added, see 'src.ranking.specificity'. Ties are ordered by book key, as in
+            'src.database_manipulation.read_ranked_from_mongodb', so both backends return
+            the same pages. The key of a match is only read when it ties with another one.
+
+            Returns:
+            list: (doc_id, score) tuples, see 'src.ranking.top_matches'.
+        """
+        total = len(self)
+        scores = {}
+        for topic in dict.fromkeys(t.lower() for t in topics):
+            best = {}
+            for term_id in self.matching_terms(topic):
+                weight = specificity(self.document_frequency(term_id), total)
+                for doc_id in self.postings(term_id):
+                    if best.get(doc_id, -1.0) < weight:
+                        best[doc_id] = weight
+            for doc_id, weight in best.items():
+                matched, score = scores.get(doc_id, (0, 0.0))
+                scores[doc_id] = (matched + 1, score + weight)
+        return top_matches(scores, limit, offset, tie_key=self.key)
+
+    def search_ranked(self, topics: list, limit: int = None, offset: int = 0) -> list:
+        """
+            Returns a page of the keys of the books matching the topics, best scored first,
+            see 'rank_ids'. Only the keys of the page are read.
+        """
+        return [self.key(doc_id) for doc_id, _ in self.rank_ids(topics, limit, offset)]
+
+
+def read_from_index(topics, index_path: str = INDEX_PATH) -> list:
+    """
+        Retrieves the keys of the books matching the topics from the local inverted index.
+
+        This is the local counterpart of 'src.database_manipulation.read_from_mongodb', with the
+        same matching rules: a book matches when one of its subjects contains one of the
+        topics, ignoring case. No database or network access is needed.
+
+        Args:
+        - topics (list): A list of topics.
+        - index_path (str): The folder of the index written by 'build_inverted_index'.
+
+        Returns:
+        list: The keys of the matching books, in dump order.
+    """
+    return list(iter_from_index(topics, index_path))
+
+
+def iter_from_index(topics, index_path: str = INDEX_PATH):
+    """
+        Yields the keys of the books matching the topics one by one, see 'read_from_index'.
+
+        The index stays open until the generator is exhausted or closed, and no list of keys
+        is built, so memory usage does not depend on the number of matching books.
+    """
+    if not bool(len(topics)):
+        return
+    with InvertedIndex(index_path) as index:
+        doc_ids = profiling.timed_iter('index_search', index.search_ids(topics))
+        try:
+            for doc_id in doc_ids:
+                yield index.key(doc_id)
+        finally:
+            # release the posting list views before the index unmaps its files
+            doc_ids.close()
+
+
+def read_ranked_from_index(topics, limit: int = 20, offset: int = 0, index_path: str = INDEX_PATH) -> list:
+    """
+        Retrieves a page of the keys of the books matching the topics from the local inverted
+        index, the best matches first.
+
+        The matching rules are those of 'read_from_index'. Books matching more topics come
+        first, then books whose matching subjects are more specific, see
+        'InvertedIndex.rank_ids'.
+
+        Args:
+        - topics (list): A list of topics.
+        - limit (int): The maximum number of keys returned, None for all of them.
+        - offset (int): The number of best matches skipped, to read the following pages.
+        - index_path (str): The folder of the index written by 'build_inverted_index'.
+
+        Returns:
+        list: The keys of the page, best first.
+    """
+    if not bool(len(topics)):
+        return []
+    with InvertedIndex(index_path) as index:
+        with profiling.stage('index_rank'):
+            keys = index.search_ranked(topics, limit, offset)
+    profiling.add('index_rank', len(keys))
+    return keys
+
+
+def read_vocabulary(index_path: str = INDEX_PATH) -> list:
+    """
+        Returns the distinct normalized subjects of the local inverted index.
+    """
+    with open(os.path.join(index_path, 'subjects.txt'), 'r', encoding='utf-8') as subjects_file:
+        return subjects_file.read().splitlines()
@@ -0,0 +1,44 @@
+import gzip
+import json
+import sys
+
+
+def write_jsonl(records, path: str = 'output/output.json', flush_every: int = 100) -> int:
+    """
+        Writes records as JSON lines while they are produced.
+
+        Each record is serialized and written as soon as it is received, so memory usage does
+        not depend on the number of records and the first results are available before the
+        last ones are fetched.
+
+        Args:
+        - records (iterable): The records to write, for example the generator returned by
+          'src.books_retieve.iter_books_by_key'.
+        - path (str): The output file. '-' writes to the standard output, and a path ending
+          with '.gz' writes gzip-compressed JSON lines.
+        - flush_every (int): The number of records after which the output is flushed, so
+          they can be read while the writing goes on.
+
+        Returns:
+        int: The number of records written.
+    """
+    if path == '-':
+        output = sys.stdout
+    elif path.endswith('.gz'):
+        output = gzip.open(path, 'wt', encoding='utf-8')
+    else:
+        output = open(path, 'w', encoding='utf-8')
+
+    count = 0
+    try:
+        for record in records:
+            output.write(json.dumps(record))
+            output.write('\n')
+            count += 1
+            if count % flush_every == 0:
+                output.flush()
+        output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    return count
@@ -0,0 +1,327 @@
+import os
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from src.data_processing import (DF_COLUMNS, intern_subjects, parse_dump_lines, processed_output,
+                                 write_parquet_batch, write_subject_dictionary)
+from src.result_cache import bump_data_version
+
+# Marks the end of the items of a queue
+_DONE = object()
+
+
+class _Stopped(Exception):
+    pass
+
+
+class Pipeline:
+    """
+        Bookkeeping of the stages and bounded queues of 'ingest_dump'.
+
+        Each stage records the time it spent waiting for its input ('wait_in'), waiting for
+        room in its output queue ('wait_out') and working ('busy'). A monitor thread samples
+        the depth of every queue. A stage whose input queue stays full and whose output queue
+        stays empty is the bottleneck of the pipeline.
+    """
+
+    def __init__(self, queue_size: int):
+        self.queues = {name: queue.Queue(queue_size) for name in ('lines', 'records')}
+        self.stages = {name: {'items': 0, 'busy': 0.0, 'wait_in': 0.0, 'wait_out': 0.0}
+                       for name in ('download', 'parse', 'load')}
+        self.depths = {name: {'max': 0, 'total': 0, 'samples': 0} for name in self.queues}
+        self.stop = threading.Event()
+        self.errors = []
+
+    def put(self, stage: str, name: str, item):
+        # Blocks while the queue is full, which slows the producer down to its consumer
+        start = time.perf_counter()
+        while True:
+            try:
+                self.queues[name].put(item, timeout=0.1)
+                break
+            except queue.Full:
+                if self.stop.is_set():
+                    raise _Stopped()
+        self.stages[stage]['wait_out'] += time.perf_counter() - start
+
+    def drain(self, stage: str, name: str):
+        """
+            Yields the items of a queue until its producer is done.
+        """
+        while True:
+            start = time.perf_counter()
+            while True:
+                try:
+                    item = self.queues[name].get(timeout=0.1)
+                    break
+                except queue.Empty:
+                    if self.stop.is_set():
+                        raise _Stopped()
+            self.stages[stage]['wait_in'] += time.perf_counter() - start
+            if item is _DONE:
+                return
+            yield item
+
+    def run(self, stage: str, target, *args):
+        """
+            Starts 'target' in a thread as the stage 'stage'. An error stops every stage.
+        """
+        def work():
+            start = time.perf_counter()
+            try:
+                target(*args)
+            except _Stopped:
+                pass
+            except BaseException as e:
+                self.errors.append(e)
+                self.stop.set()
+            stats = self.stages[stage]
+            stats['busy'] = time.perf_counter() - start - stats['wait_in'] - stats['wait_out']
+
+        thread = threading.Thread(target=work, name=f'pipeline-{stage}', daemon=True)
+        thread.start()
+        return thread
+
+    def monitor(self, interval: float, report_every: float):
+        """
+            Samples the queue depths every 'interval' seconds until the pipeline stops, and
+            prints them every 'report_every' seconds (0 to never print).
+        """
+        last_report = time.monotonic()
+        while not self.stop.wait(interval):
+            for name, depths in self.depths.items():
+                depth = self.queues[name].qsize()
+                depths['max'] = max(depths['max'], depth)
+                depths['total'] += depth
+                depths['samples'] += 1
+            if report_every and time.monotonic() - last_report >= report_every:
+                last_report = time.monotonic()
+                print('queues: ' + ', '.join(f'{name} {q.qsize()}/{q.maxsize}'
+                                             for name, q in self.queues.items()), file=sys.stderr)
+
+    def stats(self) -> dict:
+        queues = {}
+        for name, depths in self.depths.items():
+            queues[name] = {'capacity': self.queues[name].maxsize, 'max_depth': depths['max'],
+                            'mean_depth': depths['total'] / depths['samples'] if depths['samples'] else 0.0}
+        return {'stages': self.stages, 'queues': queues}
+
+
+def parse_line_batch(lines: list) -> list:
+    """
+        Parses a batch of dump lines, see 'src.data_processing.parse_dump_lines'.
+    """
+    return list(parse_dump_lines(lines))
+
+
+def ingest_dump(lines, output_folder: str = '../data/processed', collection=None,
+                chunksize: int = 10 ** 5, parse_workers: int = 1, writers: int = 4,
+                batch_size: int = 1000, lines_per_batch: int = 10 ** 4, queue_size: int = 8,
+                report_every: float = 0, state_path: str = None) -> dict:
+    """
+        Downloads, parses and loads a dump with the three stages running at the same time.
+
+        The stages are connected by bounded queues of batches. When a queue is full its
+        producer waits, so a fast stage never runs ahead of a slow one by more than
+        'queue_size' batches, memory stays bounded, and the wall-clock time is close to the
+        time of the slowest stage instead of the sum of the three:
+        - download: reads 'lines', for example 'src.download_data.stream_dump_lines', and
+          queues them in batches of 'lines_per_batch' lines.
+        - parse: decodes the batches with 'parse_dump_lines', in 'parse_workers' processes
+          when more than one, keeping the order of the dump.
+        - load: interns the subjects and writes the 'booksX.parquet' files of 'chunksize'
+          books and 'subjects.txt', exactly as 'ol_process_dump_lines', replacing the files of
+          an earlier run once all the stages succeed. With 'collection', the books are also
+          inserted into MongoDB while they arrive, by 'bulk_insert', and with 'state_path'
+          they are recorded as the sync state, see 'record_sync_state'.
+
+        Args:
+        - lines (iterable): The lines of an editions dump.
+        - output_folder (str): The folder where the Parquet files are written.
+        - collection: The MongoDB collection to load, or None to only write the files.
+        - chunksize (int): The number of books of each Parquet file.
+        - parse_workers (int): The number of parser processes.
+        - writers (int): The number of MongoDB writer threads.
+        - batch_size (int): The number of books of each 'insert_many'.
+        - lines_per_batch (int): The number of lines of each queued batch.
+        - queue_size (int): The maximum number of batches waiting in each queue.
+        - report_every (float): Print the queue depths every 'report_every' seconds on the
+          standard error, 0 to disable.
+        - state_path (str): The sync state recorded while loading 'collection' (optional). It
+          still has to be installed with 'finish_sync_state'.
+
+        Returns:
+        dict: The number of 'books', the elapsed 'seconds', the 'items', 'busy', 'wait_in' and
+        'wait_out' seconds of every stage in 'stages', the 'capacity', 'max_depth' and
+        'mean_depth' of every queue in 'queues', and the statistics of 'bulk_insert' in
+        'load' when a collection is loaded.
+
+        Raises:
+        The first error raised by a stage, once all the stages are stopped.
+    """
+    if collection is not None:
+        # pymongo is only needed to load MongoDB, not to write the processed files
+        from src.database_manipulation import bulk_insert, record_sync_state, to_document
+    pipeline = Pipeline(queue_size)
+    start = time.perf_counter()
+    result = {}
+
+    def download():
+        batch = []
+        for line in lines:
+            batch.append(line)
+            if len(batch) == lines_per_batch:
+                pipeline.stages['download']['items'] += 1
+                pipeline.put('download', 'lines', batch)
+                batch = []
+        if batch:
+            pipeline.stages['download']['items'] += 1
+            pipeline.put('download', 'lines', batch)
+        pipeline.put('download', 'lines', _DONE)
+
+    def parse():
+        if parse_workers > 1:
+            # spawn, as forking a process that runs threads is unsafe
+            with ProcessPoolExecutor(max_workers=parse_workers, mp_context=get_context('spawn')) as executor:
+                # A window of futures keeps the workers busy and the batches in dump order
+                pending = deque()
+                for batch in pipeline.drain('parse', 'lines'):
+                    pending.append(executor.submit(parse_line_batch, batch))
+                    if len(pending) >= 2 * parse_workers:
+                        publish(pending.popleft().result())
+                while pending:
+                    publish(pending.popleft().result())
+        else:
+            for batch in pipeline.drain('parse', 'lines'):
+                publish(parse_line_batch(batch))
+        pipeline.put('parse', 'records', _DONE)
+
+    def publish(records):
+        pipeline.stages['parse']['items'] += 1
+        pipeline.put('parse', 'records', records)
+
+    def load():
+        dictionary = {}
+        # The subject of every id, so the documents store the same normalized subjects as
+        # the Parquet files
+        names = []
+        books = []
+        file_number = 0
+        for records in pipeline.drain('load', 'records'):
+            pipeline.stages['load']['items'] += 1
+            interned = list(intern_subjects(records, dictionary))
+            if collection is not None:
+                names.extend(islice(dictionary, len(names), None))
+                for key, title, subject_ids, revision, last_modified in interned:
+                    yield to_document({'key': key, 'title': title, 'revision': revision,
+                                       'last_modified': last_modified,
+                                       'subjects': [names[i] for i in subject_ids]})
+            books.extend(interned)
+            while len(books) >= chunksize:
+                write_books(books[:chunksize], file_number)
+                del books[:chunksize]
+                file_number += 1
+        if books:
+            write_books(books, file_number)
+        write_subject_dictionary(dictionary, staging)
+
+    def write_books(books, file_number):
+        batch = dict(zip(DF_COLUMNS, map(list, zip(*books))))
+        write_parquet_batch(batch, os.path.join(staging, 'books' + str(file_number) + '.parquet'))
+        result['books'] = result.get('books', 0) + len(books)
+
+    def load_stage():
+        if collection is None:
+            for _ in load():
+                pass
+        else:
+            documents = load() if state_path is None else record_sync_state(load(), state_path)
+            result['load'] = bulk_insert(collection, documents, writers, batch_size)
+
+    with processed_output(output_folder) as staging:
+        threads = [pipeline.run('download', download), pipeline.run('parse', parse),
+                   pipeline.run('load', load_stage)]
+        monitor = threading.Thread(target=pipeline.monitor, args=(0.1, report_every), daemon=True)
+        monitor.start()
+        for thread in threads:
+            thread.join()
+        pipeline.stop.set()
+        monitor.join()
+        if pipeline.errors:
+            raise pipeline.errors[0]
+
+    result.setdefault('books', 0)
+    result['seconds'] = time.perf_counter() - start
+    result.update(pipeline.stats())
+    return result
+
+
+def format_pipeline_stats(stats: dict) -> str:
+    """
+        Formats the statistics of 'ingest_dump' as a human readable summary.
+    """
+    lines = [f"{stats['books']} books in {stats['seconds']:.1f}s"]
+    for name, stage in stats['stages'].items():
+        lines.append(f"  {name:<9} {stage['items']:>7} batches, busy {stage['busy']:.1f}s, "
+                     f"waiting for input {stage['wait_in']:.1f}s, for output {stage['wait_out']:.1f}s")
+    for name, depths in stats['queues'].items():
+        lines.append(f"  queue {name:<9} max {depths['max_depth']}/{depths['capacity']}, "
+                     f"mean {depths['mean_depth']:.1f}")
+    if 'load' in stats:
+        lines.append('  loaded {inserted} books ({docs_per_sec:.0f} docs/sec), {failed} failed'
+                     .format(**stats['load']))
+    return '\n'.join(lines)
+
+
+def pipelined_update(lines, output_folder: str = '../data/processed', load_mongodb: bool = True,
+                     client=None, state_path: str = None, **options) -> dict:
+    """
+        Rebuilds the processed files, and the MongoDB collection with 'load_mongodb', from dump
+        lines in one pipelined pass, see 'ingest_dump'.
+
+        As in 'write_to_mongodb', the collection is dropped first, the loaded books are
+        recorded as the sync state of 'sync_to_mongodb', and the indexes, the 'ol_subjects'
+        collection and the data version are updated once all the books are loaded.
+
+        Args:
+        - lines (iterable): The lines of an editions dump.
+        - output_folder (str): The folder where the Parquet files are written.
+        - load_mongodb (bool): Also load the books into MongoDB.
+        - client (MongoClient): An existing client, used instead of the Atlas cluster
+          (optional). It is not closed.
+        - state_path (str): The path of the SQLite sync state. Defaults to
+          '../data/sync_state.sqlite'.
+        - options: The other arguments of 'ingest_dump'.
+
+        Returns:
+        dict: The statistics of 'ingest_dump'.
+    """
+    if not load_mongodb:
+        return ingest_dump(lines, output_folder, **options)
+
+    from src.database_manipulation import (SYNC_STATE_PATH, ensure_indexes, finish_sync_state,
+                                           mongo_client, rebuild_subject_index)
+    state_path = state_path or SYNC_STATE_PATH
+    complete = False
+    own_client = client is None
+    if own_client:
+        client = mongo_client()
+    try:
+        db = client['ol_database']
+        collection = db['ol_collection']
+        collection.drop()
+        stats = ingest_dump(lines, output_folder, collection, state_path=state_path, **options)
+        complete = not stats['load']['failed']
+        ensure_indexes(db)
+        rebuild_subject_index(db)
+        bump_data_version()
+        return stats
+    finally:
+        finish_sync_state(complete, state_path)
+        if own_client:
+            client.close()
@@ -0,0 +1,248 @@
+import cProfile
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import nullcontext
+
+# Profiling is off until 'enable' is called, and every helper is then a no-op
+_enabled = False
+_trace_memory = False
+_cprofile_dir = None
+_cprofile_active = False
+_started = 0.0
+_stages = {}
+_peaks = []
+_lock = threading.Lock()
+_local = threading.local()
+_NULL = nullcontext()
+
+
+def enable(trace_memory: bool = True, cprofile_dir: str = None):
+    """
+        Starts collecting the stage timers and counters of the whole process.
+
+        Args:
+        - trace_memory (bool): Also track the peak Python memory of each stage with
+          'tracemalloc'. It slows down allocations, so the timings are less accurate.
+        - cprofile_dir (str): A folder where the hot stages dump their 'cProfile' statistics,
+          one '<stage>.prof' file per stage, readable with 'pstats' or snakeviz (optional).
+    """
+    global _enabled, _trace_memory, _cprofile_dir, _started
+    _enabled = True
+    _trace_memory = trace_memory
+    _cprofile_dir = cprofile_dir
+    _started = time.perf_counter()
+    _stages.clear()
+    if cprofile_dir:
+        os.makedirs(cprofile_dir, exist_ok=True)
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def _stats(name: str) -> dict:
+    stats = _stages.get(name)
+    if stats is None:
+        stats = _stages[name] = {'calls': 0, 'seconds': 0.0, 'rows': 0, 'bytes': 0}
+    return stats
+
+
+def add(name: str, rows: int = 0, nbytes: int = 0):
+    """
+        Adds rows and bytes to the counters of a stage.
+    """
+    if not _enabled:
+        return
+    with _lock:
+        stats = _stats(name)
+        stats['rows'] += rows
+        stats['bytes'] += nbytes
+
+
+class _Stage:
+    def __init__(self, name: str, hot: bool):
+        self.name = name
+        self.hot = hot
+        self.profiler = None
+        self.traced = False
+
+    def __enter__(self):
+        global _cprofile_active
+        # Memory peaks are only tracked for stages of the main thread, which are nested
+        self.traced = _trace_memory and threading.current_thread() is threading.main_thread()
+        if self.traced:
+            if _peaks:
+                _peaks[-1] = max(_peaks[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            _peaks.append(0)
+        if self.hot and _cprofile_dir and not _cprofile_active:
+            _cprofile_active = True
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        global _cprofile_active
+        elapsed = time.perf_counter() - self.start
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(os.path.join(_cprofile_dir, self.name + '.prof'))
+            _cprofile_active = False
+        with _lock:
+            stats = _stats(self.name)
+            stats['calls'] += 1
+            stats['seconds'] += elapsed
+            if self.traced:
+                peak = max(_peaks.pop(), tracemalloc.get_traced_memory()[1])
+                stats['peak_bytes'] = max(stats.get('peak_bytes', 0), peak)
+                if _peaks:
+                    _peaks[-1] = max(_peaks[-1], peak)
+
+
+def stage(name: str, hot: bool = False):
+    """
+        Times a block of code as one call of the stage 'name'.
+
+        Times are wall-clock and include the nested stages, and the stages of several threads
+        add up. With 'hot', the block is also profiled with 'cProfile' when enabled, unless
+        another stage is already being profiled.
+
+        Example:
+        with profiling.stage('parse'):
+            ...
+    """
+    if not _enabled:
+        return _NULL
+    return _Stage(name, hot)
+
+
+def timed_iter(name: str, iterable, hot: bool = False, size=None):
+    """
+        Wraps an iterable, timing the production of its items as the stage 'name'.
+
+        Only the time spent waiting for the items is counted, not the time the consumer
+        spends on them, and every item counts as one row. The time spent in other wrapped
+        iterables it pulls from is excluded, so a lazy pipeline such as download -> gunzip
+        -> parse is split into the cost of each step.
+
+        Args:
+        - name (str): The stage name.
+        - iterable (iterable): The iterable to time.
+        - hot (bool): Profile the production of the items with 'cProfile', see 'stage'.
+        - size (callable): Returns the number of bytes of an item, added to the 'bytes'
+          counter of the stage, such as 'len' for chunks (optional).
+    """
+    if not _enabled:
+        return iterable
+    return _timed_iter(name, iterable, hot, size)
+
+
+def _timed_iter(name, iterable, hot, size):
+    global _cprofile_active
+    iterator = iter(iterable)
+    nested = _local.__dict__.setdefault('nested', [])
+    rows = 0
+    nbytes = 0
+    own = 0.0
+    profiler = None
+    if hot and _cprofile_dir and not _cprofile_active:
+        _cprofile_active = True
+        profiler = cProfile.Profile()
+    try:
+        while True:
+            nested.append(0.0)
+            if profiler is not None:
+                profiler.enable()
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                elapsed = time.perf_counter() - start
+                if profiler is not None:
+                    profiler.disable()
+                own += elapsed - nested.pop()
+                if nested:
+                    nested[-1] += elapsed
+            rows += 1
+            if size is not None:
+                nbytes += size(item)
+            yield item
+    finally:
+        if profiler is not None:
+            profiler.dump_stats(os.path.join(_cprofile_dir, name + '.prof'))
+            _cprofile_active = False
+        with _lock:
+            stats = _stats(name)
+            stats['calls'] += 1
+            stats['seconds'] += own
+            stats['rows'] += rows
+            stats['bytes'] += nbytes
+
+
+def report() -> dict:
+    """
+        Returns the collected statistics.
+
+        Returns:
+        dict: 'wall_seconds' since 'enable', 'stages' with the 'calls', 'seconds', 'rows',
+        'bytes', throughput ('rows_per_sec', 'mib_per_sec') and, with memory tracing,
+        'peak_bytes' of every stage, and the peak resident memory of the process
+        ('max_rss_bytes') and of its finished child processes ('children_max_rss_bytes').
+    """
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    with _lock:
+        stages = {}
+        for name, stats in _stages.items():
+            stats = dict(stats)
+            seconds = stats['seconds']
+            stats['rows_per_sec'] = stats['rows'] / seconds if seconds else 0.0
+            stats['mib_per_sec'] = stats['bytes'] / 2 ** 20 / seconds if seconds else 0.0
+            stages[name] = stats
+    result = {
+        'wall_seconds': time.perf_counter() - _started,
+        'stages': stages,
+        'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+        'children_max_rss_bytes': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit,
+    }
+    if tracemalloc.is_tracing():
+        result['traced_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+    return result
+
+
+def format_report(result: dict) -> str:
+    """
+        Formats a report of 'report' as a human readable table.
+    """
+    lines = [f"{'stage':<24}{'calls':>8}{'seconds':>10}{'rows':>12}{'rows/s':>12}"
+             f"{'MiB':>10}{'MiB/s':>9}{'peak MiB':>10}"]
+    for name, stats in sorted(result['stages'].items(), key=lambda item: -item[1]['seconds']):
+        peak = f"{stats['peak_bytes'] / 2 ** 20:.1f}" if 'peak_bytes' in stats else '-'
+        lines.append(f"{name:<24}{stats['calls']:>8}{stats['seconds']:>10.2f}{stats['rows']:>12}"
+                     f"{stats['rows_per_sec']:>12.0f}{stats['bytes'] / 2 ** 20:>10.1f}"
+                     f"{stats['mib_per_sec']:>9.1f}{peak:>10}")
+    lines.append(f"wall {result['wall_seconds']:.2f}s, max RSS {result['max_rss_bytes'] / 2 ** 20:.1f} MiB, "
+                 f"children max RSS {result['children_max_rss_bytes'] / 2 ** 20:.1f} MiB")
+    return '\n'.join(lines)
+
+
+def write_report(path: str):
+    """
+        Writes the report of 'report' as JSON. '-' writes to the standard error.
+    """
+    result = report()
+    if path == '-':
+        print(json.dumps(result, indent=2), file=sys.stderr)
+        return
+    with open(path, 'w', encoding='utf-8') as report_file:
+        json.dump(result, report_file, indent=2)
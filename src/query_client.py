@@ -0,0 +1,40 @@
+import json
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+# Client side of 'src.query_service', kept apart so that the thin client only imports the
+# standard library
+SERVICE_URL = 'http://127.0.0.1:8080'
+
+
+def remote_url(server_url: str, path: str, topics: list, fuzzy: bool, limit: int = None,
+               offset: int = 0) -> str:
+    query = [('topic', topic) for topic in topics]
+    if fuzzy:
+        query.append(('fuzzy', '1'))
+    if limit is not None:
+        query.append(('limit', str(limit)))
+    if offset:
+        query.append(('offset', str(offset)))
+    return server_url.rstrip('/') + path + '?' + urlencode(query)
+
+
+def remote_keys(topics: list, fuzzy: bool = False, server_url: str = SERVICE_URL, limit: int = None,
+                offset: int = 0) -> list:
+    """
+        Retrieves the keys of the books matching the topics from a running query service,
+        only a page of the best matches with 'limit' or 'offset'.
+    """
+    with urlopen(remote_url(server_url, '/keys', topics, fuzzy, limit, offset)) as response:
+        return json.load(response)['keys']
+
+
+def iter_remote_books(topics: list, fuzzy: bool = False, server_url: str = SERVICE_URL,
+                      limit: int = None, offset: int = 0):
+    """
+        Yields the books matching the topics from a running query service, while the service
+        fetches them. With 'limit' or 'offset', only a page of the best matches.
+    """
+    with urlopen(remote_url(server_url, '/books', topics, fuzzy, limit, offset)) as response:
+        for line in response:
+            yield json.loads(line)
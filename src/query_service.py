@@ -0,0 +1,237 @@
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from src.books_retieve import OPENLIBRARY_URL, RateLimiter, iter_books_by_key, make_session
+from src.database_manipulation import (mongo_client, read_from_mongodb, read_ranked_from_mongodb,
+                                       read_subject_vocabulary)
+from src.fuzzy_match import MATCHER_PATH, SubjectMatcher, open_subject_matcher
+from src.inverted_index import INDEX_PATH, InvertedIndex
+from src.query_client import SERVICE_URL, iter_remote_books, remote_keys  # noqa: F401 (kept importable from here)
+from src.result_cache import DATA_VERSION_PATH, ResultCache, read_data_version, result_key
+from src.work_cache import WorkCache
+from src.works_dump import WorksDump
+
+
+class QueryService:
+    """
+        Topic searches that keep their connections and indexes open between queries.
+
+        With the 'mongodb' backend, one MongoClient is created at startup and its connection
+        pool is shared by all the queries, so they skip the SRV lookup and the TLS handshake.
+        With the 'local' backend, the inverted index stays memory-mapped. Book details are
+        fetched over one pooled HTTP session, with one rate limit for all the clients.
+
+        When the data version of 'src.result_cache.bump_data_version' changes, the next query
+        reopens the local index, and the next fuzzy query reopens the fuzzy matcher. Queries
+        already running finish on the previous index, which is released with them.
+
+        All the methods can be called from several threads at the same time.
+
+        Args:
+        - backend (str): 'mongodb' or 'local', as the '--backend' option of the script.
+        - index_path (str): The folder of the local inverted index.
+        - max_workers (int): The maximum number of book details requested at the same time
+          by each query.
+        - rate (float): The maximum number of book details requested per second, for all
+          the queries together.
+        - cache (WorkCache): The cache of book details (optional).
+        - works (WorksDump): The local works dump (optional).
+        - base_url (str): The URL of the Open Library API.
+        - results (ResultCache): The cache of the matched keys, so repeated searches do not
+          touch the database or the index (optional).
+        - version_path (str): The data version file.
+    """
+
+    def __init__(self, backend: str = 'mongodb', index_path: str = INDEX_PATH, max_workers: int = 8,
+                 rate: float = 3.0, cache: WorkCache = None, works: WorksDump = None,
+                 base_url: str = OPENLIBRARY_URL, results: ResultCache = None,
+                 version_path: str = DATA_VERSION_PATH):
+        self.backend = backend
+        self.max_workers = max_workers
+        self.base_url = base_url
+        self.cache = cache
+        self.works = works
+        self.results = results
+        self.client = None
+        self.index = None
+        self.index_path = index_path
+        self.version_path = version_path
+        self.version = read_data_version(version_path)
+        if backend == 'local':
+            self.index = InvertedIndex(index_path)
+        else:
+            self.client = mongo_client()
+        self.session = make_session(max_workers)
+        self.limiter = RateLimiter(rate)
+        self.matcher = None
+        self.lock = threading.Lock()
+
+    def subject_matcher(self) -> SubjectMatcher:
+        """
+            Returns the fuzzy matcher of the subjects, opened on the first fuzzy query, see
+            'src.fuzzy_match.open_subject_matcher'.
+        """
+        with self.lock:
+            if self.matcher is None:
+                if self.index is not None:
+                    index = self.index
+                    self.matcher = open_subject_matcher(os.path.join(self.index_path, 'matcher'),
+                                                        lambda: index.subjects)
+                else:
+                    self.matcher = open_subject_matcher(MATCHER_PATH,
+                                                        lambda: read_subject_vocabulary(self.client))
+            return self.matcher
+
+    def current_index(self):
+        """
+            Returns the local index to query, reopened if the data version changed since it
+            was opened, or None with the 'mongodb' backend. The fuzzy matcher is dropped on a
+            new version, so it is opened again with the new subjects. Like the index, it is not
+            closed, since running queries may still read it.
+        """
+        with self.lock:
+            version = read_data_version(self.version_path)
+            if version != self.version:
+                if self.index is not None:
+                    # The previous index is not closed: running queries may still read it, and
+                    # its files are unmapped once the last of them drops it
+                    self.index = InvertedIndex(self.index_path)
+                self.matcher = None
+                self.version = version
+            return self.index
+
+    def keys(self, topics: list, fuzzy: bool = False, limit: int = None, offset: int = 0) -> list:
+        """
+            Returns the keys of the books matching the topics, see 'read_from_mongodb' and
+            'src.inverted_index.read_from_index'. With 'limit' or 'offset', only that page of
+            the best matches is returned, see 'read_ranked_from_mongodb'. Results are served
+            from the result cache while the data version does not change.
+        """
+        ranked = limit is not None or offset > 0
+        version = None
+        if self.results is not None:
+            key = result_key(topics, fuzzy, limit, offset)
+            keys, version = self.results.lookup(key)
+            if keys is not None:
+                return keys
+        index = self.current_index()
+        if fuzzy:
+            topics = self.subject_matcher().expand(topics)
+        if not topics:
+            keys = []
+        elif index is not None:
+            keys = index.search_ranked(topics, limit, offset) if ranked else index.search(topics)
+        elif ranked:
+            keys = read_ranked_from_mongodb(topics, limit, offset, self.client)
+        else:
+            keys = read_from_mongodb(topics, self.client)
+        # read_from_mongodb also returns an empty list on connection errors, so empty
+        # results are not cached
+        if self.results is not None and keys:
+            self.results.store(key, keys, version)
+        return keys
+
+    def books(self, topics: list, fuzzy: bool = False, limit: int = None, offset: int = 0):
+        """
+            Yields the details of the books matching the topics as soon as they are fetched,
+            only those of the requested page with 'limit' or 'offset', see 'keys'. The books of
+            a page are yielded best match first.
+        """
+        ranked = limit is not None or offset > 0
+        return iter_books_by_key(self.keys(topics, fuzzy, limit, offset), self.max_workers,
+                                 base_url=self.base_url, cache=self.cache, works=self.works,
+                                 session=self.session, limiter=self.limiter, ordered=ranked)
+
+    def close(self):
+        self.session.close()
+        if self.index is not None:
+            self.index.close()
+        if self.client is not None:
+            self.client.close()
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """
+        HTTP interface of a QueryService.
+
+        - 'GET /keys?topic=A&topic=B[&fuzzy=1][&limit=N][&offset=N]': the matching keys, as a
+          JSON object {"keys": [...]}. With 'limit' or 'offset', only that page of the best
+          matches.
+        - 'GET /books?topic=A&topic=B[&fuzzy=1][&limit=N][&offset=N]': the matching books, as
+          JSON lines written while they are fetched.
+        - 'GET /health': {"status": "ok"} once the service is ready, with the counters of the
+          result cache under "results" when it is enabled.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    service = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        topics = query.get('topic', [])
+        fuzzy = query.get('fuzzy', ['0'])[0] not in ('', '0', 'false')
+        try:
+            limit = int(query['limit'][0]) if 'limit' in query else None
+            offset = int(query.get('offset', ['0'])[0])
+        except ValueError:
+            self.send_json({'error': 'limit and offset must be integers'}, 400)
+            return
+        if url.path == '/health':
+            health = {'status': 'ok'}
+            if self.service.results is not None:
+                health['results'] = self.service.results.stats()
+            self.send_json(health)
+        elif url.path == '/keys':
+            self.send_json({'keys': self.service.keys(topics, fuzzy, limit, offset)})
+        elif url.path == '/books':
+            self.send_lines(self.service.books(topics, fuzzy, limit, offset))
+        else:
+            self.send_json({'error': 'not found'}, 404)
+
+    def send_json(self, document: dict, status: int = 200):
+        body = json.dumps(document).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_lines(self, records):
+        # The number of books is unknown until they are all fetched, so the response is
+        # delimited by closing the connection
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        for record in records:
+            self.wfile.write(json.dumps(record).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(service: QueryService, host: str = '127.0.0.1', port: int = 8080):
+    """
+        Serves the queries of 'service' over HTTP until interrupted, one thread per request.
+
+        Args:
+        - service (QueryService): The service answering the queries. It is closed when the
+          server stops.
+        - host (str): The address to listen on.
+        - port (int): The port to listen on.
+    """
+    handler = type('BoundQueryHandler', (QueryHandler,), {'service': service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
@@ -0,0 +1,71 @@
+import heapq
+import math
+
+
+def specificity(count: int, total: int) -> float:
+    """
+        Returns the inverse document frequency of a subject: log(total / count).
+
+        A subject shared by few books, such as 'quantum chromodynamics', is more specific and
+        weighs more than one shared by a large part of the books, such as 'fiction'.
+
+        Args:
+        - count (int): The number of books having the subject.
+        - total (int): The number of books.
+    """
+    if count <= 0 or total <= 0:
+        return 0.0
+    return math.log(max(total, count) / count)
+
+
+def top_matches(scores: dict, limit: int = None, offset: int = 0, tie_key=None) -> list:
+    """
+        Selects a page of the best scored matches.
+
+        Matches are ordered by decreasing score, then by increasing id, or increasing
+        'tie_key(id)' when given. Only 'offset + limit'
+        matches are kept by a bounded heap, so selecting a page costs O(n log(offset + limit))
+        instead of sorting all the matches.
+
+        Args:
+        - scores (dict): The score of every match, by id. A score is a tuple, compared
+          element by element, such as (number of matched topics, specificity).
+        - limit (int): The maximum number of matches returned, None for all of them.
+        - offset (int): The number of best matches skipped.
+        - tie_key (callable): The value tied matches are ordered by, from their id, for
+          example the book key of a document id (optional). It is only called for matches
+          compared with another one of the same score.
+
+        Returns:
+        list: (id, score) tuples of the page, best first.
+    """
+    def order(item):
+        return item[1], _Reversed(item[0], tie_key)
+
+    if limit is None:
+        ranked = sorted(scores.items(), key=order, reverse=True)
+    else:
+        ranked = heapq.nlargest(offset + limit, scores.items(), key=order)
+    return ranked[offset:]
+
+
+class _Reversed:
+    # Inverts the comparison of ids, so ties are broken by increasing id in a descending sort.
+    # With 'tie_key', ids are compared by tie_key(id), computed on their first tie
+    __slots__ = ('id', 'tie_key')
+
+    def __init__(self, id, tie_key=None):
+        self.id = id
+        self.tie_key = tie_key
+
+    def value(self):
+        if self.tie_key is not None:
+            self.id = self.tie_key(self.id)
+            self.tie_key = None
+        return self.id
+
+    def __lt__(self, other):
+        return other.value() < self.value()
+
+    def __eq__(self, other):
+        return self.value() == other.value()
@@ -0,0 +1,142 @@
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+# Rewritten every time the searchable data changes, see 'bump_data_version'
+DATA_VERSION_PATH = '../data/data_version'
+
+
+def bump_data_version(path: str = DATA_VERSION_PATH) -> str:
+    """
+        Marks the searchable data as changed, invalidating the cached search results.
+
+        Called after 'write_to_mongodb', an incremental sync that changed books, and
+        'build_inverted_index'. The file is replaced atomically, so a reader never sees a
+        partial version.
+
+        Returns:
+        str: The new version.
+    """
+    version = str(time.time_ns())
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temporary_file = path + '.tmp'
+    with open(temporary_file, 'w', encoding='utf-8') as version_file:
+        version_file.write(version)
+    os.replace(temporary_file, path)
+    return version
+
+
+def read_data_version(path: str = DATA_VERSION_PATH) -> str:
+    """
+        Returns the current data version, or an empty string if the data was never versioned.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as version_file:
+            return version_file.read()
+    except FileNotFoundError:
+        return ''
+
+
+def result_key(topics, *options) -> tuple:
+    """
+        Returns the cache key of a search.
+
+        A book matches when one of its subjects contains one of the topics, ignoring case, so
+        the order, case and repetitions of the topics do not change the result. They are
+        lower-cased, deduplicated and sorted. Spaces are kept, since 'art ' and 'art' match
+        different subjects. 'options' holds whatever else changes the result, such as the
+        fuzzy flag.
+    """
+    return (tuple(sorted({topic.lower() for topic in topics})),) + options
+
+
+class ResultCache:
+    """
+        In-memory LRU cache of the book keys matched by topic searches.
+
+        The cached results are dropped as soon as the data version of 'bump_data_version'
+        changes, so a search never returns keys of an older load or sync. When the cached
+        key lists exceed 'max_bytes', the least recently used ones are evicted.
+
+        The cache can be shared by several threads.
+
+        Args:
+        - max_bytes (int): The memory budget of the cached key lists, in bytes.
+        - version_path (str): The data version file.
+
+        Example:
+        keys, version = results.lookup(key)
+        if keys is None:
+            keys = read_from_mongodb(topics)
+            results.store(key, keys, version)
+    """
+
+    def __init__(self, max_bytes: int = 64 * 2 ** 20, version_path: str = DATA_VERSION_PATH):
+        self.max_bytes = max_bytes
+        self.version_path = version_path
+        self.version = read_data_version(version_path)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def _check_version(self):
+        version = read_data_version(self.version_path)
+        if version != self.version:
+            self.version = version
+            self.entries.clear()
+            self.size = 0
+            self.invalidations += 1
+
+    def lookup(self, key: tuple):
+        """
+            Looks up the result of a search.
+
+            Returns:
+            tuple: (keys, version) where 'keys' is the cached list of book keys or None, and
+            'version' is the data version to pass to 'store' with a freshly computed result.
+        """
+        with self.lock:
+            self._check_version()
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, self.version
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], self.version
+
+    def store(self, key: tuple, keys: list, version: str):
+        """
+            Stores the result of a search computed on the data of 'version'.
+
+            The result is discarded if the data changed since 'version', or if it does not fit
+            in the budget on its own.
+        """
+        size = sys.getsizeof(keys) + sum(sys.getsizeof(book_key) for book_key in keys)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self._check_version()
+            if version != self.version:
+                return
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self.entries[key] = (keys, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def stats(self) -> dict:
+        """
+            Returns the counters of the cache, its number of entries and their size in bytes.
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations,
+                    'entries': len(self.entries), 'bytes': self.size}
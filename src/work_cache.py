@@ -0,0 +1,149 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_PATH = '../data/works_cache.sqlite'
+
+
+class WorkCache:
+    """
+        Persistent on-disk cache of the work JSON fetched from the Open Library API.
+
+        Entries are stored in a SQLite file, keyed by work key (for example 'OL1W'), with the
+        'ETag' and 'Last-Modified' headers of the response. An entry younger than 'ttl'
+        seconds is served without any request. An older entry is revalidated with a
+        conditional request, and served again if the server answers '304 Not Modified'.
+        When the cached bodies exceed 'max_bytes', the least recently used entries are
+        evicted. The access times of the hits are kept in memory and written in batches of
+        'access_batch', before any eviction and when the cache is closed, so a hit does not
+        cost a write.
+
+        The 'hits' counter tells how many lookups were answered without any request, and
+        'misses' how many needed one. 'revalidated' counts the misses answered by a
+        conditional request with '304 Not Modified', which transfer no body.
+
+        The cache can be shared by several threads.
+
+        Args:
+        - path (str): The path of the SQLite file, whose folder is created if needed.
+        - ttl (float): The number of seconds an entry is served without revalidation.
+        - max_bytes (int): The disk budget of the cached bodies, in bytes.
+        - access_batch (int): The number of access times buffered before they are written.
+
+        Raises:
+        sqlite3.Error: If the SQLite file cannot be opened.
+    """
+
+    def __init__(self, path: str = CACHE_PATH, ttl: float = 7 * 24 * 3600,
+                 max_bytes: int = 512 * 2 ** 20, access_batch: int = 256):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.access_batch = access_batch
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.lock = threading.Lock()
+        # Access times of the hits not written yet, by key
+        self.accessed = {}
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        try:
+            self.db.execute('CREATE TABLE IF NOT EXISTS works (key TEXT PRIMARY KEY, body TEXT, '
+                            'etag TEXT, last_modified TEXT, fetched_at REAL, accessed_at REAL, '
+                            'size INTEGER) WITHOUT ROWID')
+            self.db.execute('CREATE INDEX IF NOT EXISTS works_accessed_at ON works (accessed_at)')
+            self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM works').fetchone()[0]
+        except sqlite3.Error:
+            self.db.close()
+            raise
+
+    def lookup(self, key: str):
+        """
+            Looks up a work.
+
+            Returns:
+            tuple: (book, fresh, headers) where 'book' is the cached dict or None, 'fresh'
+            tells whether it can be used without a request, and 'headers' holds the
+            conditional request headers to revalidate a stale entry.
+        """
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT body, etag, last_modified, fetched_at FROM works '
+                                  'WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None, False, {}
+            body, etag, last_modified, fetched_at = row
+            self.accessed[key] = now
+            if len(self.accessed) >= self.access_batch:
+                self._write_accesses()
+                self.db.commit()
+            if now - fetched_at < self.ttl:
+                self.hits += 1
+                return json.loads(body), True, {}
+            self.misses += 1
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return json.loads(body), False, headers
+
+    def refresh(self, key: str):
+        """
+            Marks a stale entry as fresh again after a '304 Not Modified' answer.
+        """
+        with self.lock:
+            self.revalidated += 1
+            self.db.execute('UPDATE works SET fetched_at = ? WHERE key = ?', (time.time(), key))
+            self.db.commit()
+
+    def store(self, key: str, book: dict, etag: str = None, last_modified: str = None):
+        """
+            Stores the body and validators of a fetched work, evicting old entries if needed.
+        """
+        body = json.dumps(book)
+        size = len(body)
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT size FROM works WHERE key = ?', (key,)).fetchone()
+            self.size += size - (row[0] if row else 0)
+            self.db.execute('INSERT OR REPLACE INTO works VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (key, body, etag, last_modified, now, now, size))
+            self.accessed.pop(key, None)
+            if self.size > self.max_bytes:
+                self._evict()
+            self.db.commit()
+
+    def _write_accesses(self):
+        self.db.executemany('UPDATE works SET accessed_at = ? WHERE key = ?',
+                            [(accessed_at, key) for key, accessed_at in self.accessed.items()])
+        self.accessed.clear()
+
+    def _evict(self):
+        # Drop the least recently used entries until the cache is back under 90% of its budget
+        self._write_accesses()
+        target = self.max_bytes * 0.9
+        rows = self.db.execute('SELECT key, size FROM works ORDER BY accessed_at')
+        evicted = []
+        for key, size in rows:
+            if self.size <= target:
+                break
+            evicted.append((key,))
+            self.size -= size
+        self.db.executemany('DELETE FROM works WHERE key = ?', evicted)
+
+    def stats(self) -> dict:
+        """
+            Returns the counters of the cache and its current size in bytes.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'revalidated': self.revalidated,
+                'bytes': self.size}
+
+    def close(self):
+        with self.lock:
+            self._write_accesses()
+            self.db.commit()
+        self.db.close()
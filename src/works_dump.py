@@ -0,0 +1,161 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+
+WORKS_DUMP_PATH = '../data/unprocessed/ol_dump_works.txt'
+EDITIONS_DUMP_PATH = '../data/unprocessed/ol_dump_editions.txt'
+WORKS_INDEX_PATH = '../data/works_index.sqlite'
+
+# The key of the first work of an edition, read without decoding the whole JSON column
+_FIRST_WORK = re.compile(rb'"works":\s*\[\s*\{\s*"key":\s*"([^"]+)"')
+
+
+def build_works_index(dump_path: str = WORKS_DUMP_PATH, index_path: str = WORKS_INDEX_PATH,
+                      batch_size: int = 10 ** 5, editions_path: str = EDITIONS_DUMP_PATH) -> int:
+    """
+        Builds a key -> byte offset index of an uncompressed works dump.
+
+        The dump is scanned once in binary mode. For every line, the 'key' column (for example
+        '/works/OL1W') is stored in a SQLite table with the offset and length of the line, so
+        the JSON of a work can later be read with a single seek, without scanning the dump.
+
+        The searches return edition keys ('/books/OL1M'), so the editions dump is scanned as
+        well, and the key of the first work of every edition ('works[0].key') is stored in a
+        second table.
+
+        Args:
+        - dump_path (str): The path of the uncompressed 'ol_dump_works' file.
+        - index_path (str): The path of the SQLite index. It is rebuilt from scratch.
+        - batch_size (int): The number of rows inserted in each transaction.
+        - editions_path (str): The path of the uncompressed 'ol_dump_editions' file. Editions
+          are not linked to their works if it does not exist.
+
+        Returns:
+        int: The number of indexed works.
+    """
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    index = sqlite3.connect(index_path)
+    index.execute('CREATE TABLE works (key TEXT PRIMARY KEY, offset INTEGER, length INTEGER) '
+                  'WITHOUT ROWID')
+    index.execute('CREATE TABLE editions (key TEXT PRIMARY KEY, work TEXT) WITHOUT ROWID')
+    if os.path.exists(editions_path):
+        link_editions(index, editions_path, batch_size)
+    total = 0
+    rows = []
+    with open(dump_path, 'rb') as dump_file:
+        offset = 0
+        for line in dump_file:
+            fields = line.split(b'\t', 2)
+            if len(fields) == 3:
+                rows.append((fields[1].decode('utf-8'), offset, len(line)))
+            offset += len(line)
+            if len(rows) == batch_size:
+                index.executemany('INSERT OR REPLACE INTO works VALUES (?, ?, ?)', rows)
+                index.commit()
+                total += len(rows)
+                rows = []
+    index.executemany('INSERT OR REPLACE INTO works VALUES (?, ?, ?)', rows)
+    index.commit()
+    index.close()
+    return total + len(rows)
+
+
+def link_editions(index: sqlite3.Connection, editions_path: str, batch_size: int = 10 ** 5) -> int:
+    """
+        Stores the key of the first work of every edition of an editions dump in the
+        'editions' table of a works index.
+
+        Returns:
+        int: The number of editions linked to a work.
+    """
+    total = 0
+    rows = []
+    with open(editions_path, 'rb') as dump_file:
+        for line in dump_file:
+            fields = line.split(b'\t', 4)
+            if len(fields) < 5:
+                continue
+            match = _FIRST_WORK.search(fields[4])
+            if match is not None:
+                rows.append((fields[1].decode('utf-8'), match.group(1).decode('utf-8')))
+            if len(rows) == batch_size:
+                index.executemany('INSERT OR REPLACE INTO editions VALUES (?, ?)', rows)
+                index.commit()
+                total += len(rows)
+                rows = []
+    index.executemany('INSERT OR REPLACE INTO editions VALUES (?, ?)', rows)
+    index.commit()
+    return total + len(rows)
+
+
+class WorksDump:
+    """
+        Resolves work details from the local works dump through the index of
+        'build_works_index'.
+
+        Lines are read with positional reads ('os.pread'), so one instance can be shared by
+        several threads.
+
+        Raises:
+        FileNotFoundError: If the dump or its index does not exist.
+        sqlite3.Error: If the index cannot be read.
+
+        Example:
+        with WorksDump() as works:
+            book = works.get(works.work_id('OL1M') or 'OL1M')
+    """
+
+    def __init__(self, dump_path: str = WORKS_DUMP_PATH, index_path: str = WORKS_INDEX_PATH):
+        # sqlite3 reports a missing file as 'unable to open database file'
+        for path in (dump_path, index_path):
+            if not os.path.exists(path):
+                raise FileNotFoundError(f'{path} does not exist')
+        self.fd = os.open(dump_path, os.O_RDONLY)
+        try:
+            self.index = sqlite3.connect(f'file:{index_path}?mode=ro', uri=True,
+                                         check_same_thread=False)
+            try:
+                self.index.execute('SELECT 1 FROM works LIMIT 1').fetchall()
+            except sqlite3.Error:
+                self.index.close()
+                raise
+        except BaseException:
+            os.close(self.fd)
+            raise
+        self.lock = threading.Lock()
+
+    def work_id(self, book_key: str):
+        """
+            Returns the id of the work of the edition '/books/{book_key}', such as 'OL1W', or
+            None if the edition is not linked to a work in the index.
+        """
+        with self.lock:
+            row = self.index.execute('SELECT work FROM editions WHERE key = ?',
+                                     (f'/books/{book_key}',)).fetchone()
+        return row[0].split('/')[-1] if row is not None else None
+
+    def get(self, book_key: str):
+        """
+            Returns the JSON of the work '/works/{book_key}' as a dict, or None if it is not
+            in the dump.
+        """
+        with self.lock:
+            row = self.index.execute('SELECT offset, length FROM works WHERE key = ?',
+                                     (f'/works/{book_key}',)).fetchone()
+        if row is None:
+            return None
+        line = os.pread(self.fd, row[1], row[0])
+        return json.loads(line.rstrip(b'\n').split(b'\t', 4)[4])
+
+    def close(self):
+        self.index.close()
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()